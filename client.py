@@ -1,78 +1,600 @@
+import asyncio
+import collections
+import shlex
 import socket
+import threading
+import time
 
-class RedisClient:
-    def __init__(self, host, port):
+ENCODING = 'utf-8'
+
+
+class ReplyError(Exception):
+    # an error reply from the server, the first word is the error code like in redis (WRONGTYPE, MOVED, ...)
+    @property
+    def code(self):
+        return str(self).split(" ", 1)[0]
+
+
+class WatchError(ReplyError):
+    pass
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+def encode_command(args):
+    # one RESP array of bulk strings. bytes are sent as they are, everything else as its str() in utf-8
+    out = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, (bytes, bytearray, memoryview)):
+            arg = str(arg).encode(ENCODING)
+        out.append(b"$%d\r\n" % len(arg))
+        out.append(arg)
+        out.append(b"\r\n")
+    return b"".join(out)
+
+
+def encode_commands(commands):
+    return b"".join(encode_command(args) for args in commands)
+
+
+class ReplyParser:
+    # incremental RESP2 parser, data goes in with feed() as it arrives, whole replies come out of get_reply().
+    # the sync and the asyncio connection both use it, so a reply can be any length and any number of replies
+    # can arrive in one read (pipelines)
+    INCOMPLETE = object()
+
+    def __init__(self, decode=True):
+        self.buffer = bytearray()
+        self.pos = 0
+        self.decode = decode
+
+    def feed(self, data):
+        if self.pos:
+            del self.buffer[:self.pos]
+            self.pos = 0
+        self.buffer += data
+
+    def get_reply(self):
+        # the next whole reply, or INCOMPLETE when more data is needed. error replies come back as ReplyError
+        # objects, the caller decides whether to raise them
+        try:
+            reply, self.pos = self.parse(self.pos)
+        except IndexError:
+            return self.INCOMPLETE
+        return reply
+
+    def parse(self, pos):
+        buffer = self.buffer
+        end = buffer.find(b"\r\n", pos)
+        if end < 0:
+            raise IndexError
+        kind, line = buffer[pos], bytes(buffer[pos + 1:end])
+        pos = end + 2
+        if kind == 43:  # +
+            return self.string(line), pos
+        if kind == 45:  # -
+            return ReplyError(line.decode(ENCODING, 'replace')), pos
+        if kind == 58:  # :
+            return int(line), pos
+        if kind == 36:  # $
+            length = int(line)
+            if length < 0:
+                return None, pos
+            if len(buffer) < pos + length + 2:
+                raise IndexError
+            return self.string(bytes(buffer[pos:pos + length])), pos + length + 2
+        if kind == 42:  # *
+            count = int(line)
+            if count < 0:
+                return None, pos
+            items = []
+            for _ in range(count):
+                item, pos = self.parse(pos)
+                items.append(item)
+            return items, pos
+        raise ConnectionError(f"Protocol error, unexpected reply {bytes(buffer[pos - 2 - len(line) - 1:end])[:32]!r}")
+
+    def string(self, data):
+        return data.decode(ENCODING, 'surrogateescape') if self.decode else data
+
+
+def check_replies(replies):
+    for reply in replies:
+        if isinstance(reply, ReplyError):
+            raise reply
+    return replies
+
+
+def pairs_to_dict(reply):
+    return dict(zip(reply[::2], reply[1::2])) if isinstance(reply, list) else reply
+
+
+# replies that are turned into something handier than what the server sent
+REPLY_CALLBACKS = {
+    "HGETALL": pairs_to_dict,
+}
+
+
+def convert_replies(commands, replies):
+    return [REPLY_CALLBACKS[str(args[0]).upper()](reply) if str(args[0]).upper() in REPLY_CALLBACKS else reply
+            for args, reply in zip(commands, replies)]
+
+
+def transaction_result(commands, replies):
+    # the replies of MULTI, one QUEUED (or queueing error) per command and EXEC
+    queue_errors = [reply for reply in replies[1:-1] if isinstance(reply, ReplyError)]
+    result = replies[-1]
+    if isinstance(result, ReplyError):
+        raise queue_errors[0] if queue_errors else result
+    if result is None:
+        raise WatchError("WATCH a watched key was changed, the transaction was not executed")
+    return convert_replies(commands, result)
+
+
+class Commands:
+    # the common commands for the clients and pipelines, anything else goes through execute_command. on a client
+    # they return the reply (a coroutine for the asyncio client), on a pipeline they queue the command
+
+    def ping(self):
+        return self.execute_command("PING")
+
+    def get(self, key):
+        return self.execute_command("GET", key)
+
+    def set(self, key, value, ex=None, px=None, nx=False, xx=False):
+        args = ["SET", key, value]
+        if ex is not None:
+            args += ["EX", ex]
+        if px is not None:
+            args += ["PX", px]
+        if nx:
+            args.append("NX")
+        if xx:
+            args.append("XX")
+        return self.execute_command(*args)
+
+    def mget(self, *keys):
+        return self.execute_command("MGET", *keys)
+
+    def mset(self, mapping):
+        return self.execute_command("MSET", *[item for pair in mapping.items() for item in pair])
+
+    def delete(self, *keys):
+        return self.execute_command("DEL", *keys)
+
+    def exists(self, *keys):
+        return self.execute_command("EXISTS", *keys)
+
+    def incr(self, key, amount=1):
+        return self.execute_command("INCRBY", key, amount)
+
+    def decr(self, key, amount=1):
+        return self.execute_command("DECRBY", key, amount)
+
+    def expire(self, key, seconds):
+        return self.execute_command("EXPIRE", key, seconds)
+
+    def ttl(self, key):
+        return self.execute_command("TTL", key)
+
+    def hset(self, key, mapping):
+        return self.execute_command("HSET", key, *[item for pair in mapping.items() for item in pair])
+
+    def hget(self, key, field):
+        return self.execute_command("HGET", key, field)
+
+    def hgetall(self, key):
+        return self.execute_command("HGETALL", key)
+
+    def lpush(self, key, *values):
+        return self.execute_command("LPUSH", key, *values)
+
+    def rpush(self, key, *values):
+        return self.execute_command("RPUSH", key, *values)
+
+    def lrange(self, key, start, stop):
+        return self.execute_command("LRANGE", key, start, stop)
+
+    def zadd(self, key, mapping):
+        return self.execute_command("ZADD", key, *[item for member, score in mapping.items() for item in (score, member)])
+
+    def zrange(self, key, start, stop, withscores=False):
+        return self.execute_command("ZRANGE", key, start, stop, *(["WITHSCORES"] if withscores else []))
+
+
+############# blocking client, a pool of connections shared by threads #####################################################
+
+class Connection:
+    def __init__(self, host, port, timeout=None, decode=True):
         self.host = host
         self.port = port
-        self.in_transaction = False
+        self.socket = socket.create_connection((host, port), timeout=timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.parser = ReplyParser(decode)
 
-    def connect(self):
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.connect((self.host, self.port))
-        print(f"Connected to Redis server at {self.host}:{self.port}")
+    def send_commands(self, commands):
+        self.socket.sendall(encode_commands(commands))
 
-    def send_command(self, command):
-        self.client_socket.send(command.encode('utf-8'))
+    def read_reply(self):
+        parser = self.parser
+        reply = parser.get_reply()
+        while reply is ReplyParser.INCOMPLETE:
+            data = self.socket.recv(65536)
+            if not data:
+                raise ConnectionError("Connection closed by the server")
+            parser.feed(data)
+            reply = parser.get_reply()
+        return reply
 
-    def receive_response(self):
-        response = self.client_socket.recv(1024).decode('utf-8')
-        return response
+    def execute(self, commands):
+        # one write for all commands, then one reply per command
+        self.send_commands(commands)
+        return [self.read_reply() for _ in commands]
 
     def close(self):
-        self.client_socket.close()
-        print("Connection closed")
+        try:
+            self.socket.close()
+        except OSError:
+            pass
 
-if __name__ == "__main__":
-    client = RedisClient('127.0.0.1', 6381)
-    client.connect()
 
-    while True:
-        command = input("Enter Redis command (or 'exit' to quit): ").strip()
+class ConnectionPool:
+    # thread safe. connections are made when needed up to max_connections, a thread that finds all of them busy
+    # waits up to timeout seconds for one to be released. the most recently released connection is handed out first
+    def __init__(self, host='127.0.0.1', port=6381, max_connections=50, timeout=10, socket_timeout=None, decode=True):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.socket_timeout = socket_timeout
+        self.decode = decode
+        self.idle = []
+        self.created = 0
+        self.condition = threading.Condition()
+
+    def get_connection(self):
+        deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+        with self.condition:
+            while not self.idle and self.created >= self.max_connections:
+                left = deadline - time.monotonic() if deadline is not None else None
+                if left is not None and left <= 0:
+                    raise PoolTimeoutError(f"No connection free after {self.timeout} seconds")
+                self.condition.wait(left)
+            if self.idle:
+                return self.idle.pop()
+            self.created += 1
+        try:
+            return Connection(self.host, self.port, self.socket_timeout, self.decode)
+        except OSError:
+            self.discard(None)
+            raise
+
+    def release(self, connection):
+        with self.condition:
+            self.idle.append(connection)
+            self.condition.notify()
+
+    def discard(self, connection):
+        # for connections in an unknown state (a socket error in the middle of a reply), never reused
+        if connection is not None:
+            connection.close()
+        with self.condition:
+            self.created -= 1
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            for connection in self.idle:
+                connection.close()
+            self.created -= len(self.idle)
+            self.idle.clear()
 
-        if command.lower() == 'exit':
-            break
 
-        if command.upper() == 'MULTI':
-            client.in_transaction = True
-            print("Entered transaction mode. Enter transaction commands.")
+class RedisClient(Commands):
+    def __init__(self, host='127.0.0.1', port=6381, pool=None, **pool_options):
+        self.pool = pool or ConnectionPool(host, port, **pool_options)
+        self.host = self.pool.host
+        self.port = self.pool.port
 
-            transaction_commands = []
-            while True:
-                transaction_command = input("Transaction command (or 'EXEC'/'DISCARD' to end transaction): ").strip()
-                if transaction_command.upper() in ['EXEC', 'DISCARD']:
-                    break
-                transaction_commands.append(transaction_command)
+    def execute_command(self, *args):
+        return convert_replies([args], check_replies(self.execute_many([args])))[0]
 
-            for transaction_command in transaction_commands:
-                client.send_command(transaction_command)
-                response = client.receive_response()
-                print(response)
+    def execute_many(self, commands):
+        # raw replies of all commands, errors included as ReplyError objects
+        connection = self.pool.get_connection()
+        try:
+            replies = connection.execute(commands)
+        except BaseException:
+            self.pool.discard(connection)
+            raise
+        self.pool.release(connection)
+        return replies
 
-            client.in_transaction = False
+    def pipeline(self, transaction=False):
+        return Pipeline(self, transaction)
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Pipeline(Commands):
+    # commands are collected and sent in one write when execute() is called, the replies come back as a list in
+    # the same order. with transaction=True they are wrapped in MULTI/EXEC so they run as one step on the server.
+    # watch() makes it a check-and-set: it sends WATCH right away on a connection the pipeline keeps until execute,
+    # and execute raises WatchError when a watched key changed in between
+    def __init__(self, client, transaction=False):
+        self.client = client
+        self.transaction = transaction
+        self.commands = []
+        self.watching = None
+
+    def execute_command(self, *args):
+        self.commands.append(args)
+        return self
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.reset()
+
+    def watch(self, *keys):
+        if self.watching is None:
+            self.watching = self.client.pool.get_connection()
+        self.run_on_watching([("WATCH", *keys)])
+        return self
+
+    def unwatch(self):
+        if self.watching is not None:
+            self.run_on_watching([("UNWATCH",)])
+            self.client.pool.release(self.watching)
+            self.watching = None
+
+    def immediate(self, *args):
+        # a command that runs right away on the watched connection, to read what the transaction is based on
+        if self.watching is None:
+            return self.client.execute_command(*args)
+        return convert_replies([args], check_replies(self.run_on_watching([args])))[0]
+
+    def run_on_watching(self, commands):
+        try:
+            return self.watching.execute(commands)
+        except BaseException:
+            self.client.pool.discard(self.watching)
+            self.watching = None
+            raise
+
+    def execute(self, raise_on_error=True):
+        commands, self.commands = self.commands, []
+        if self.transaction:
+            replies = transaction_result(commands, self.execute_transaction(commands))
+        elif self.watching is not None:
+            replies = convert_replies(commands, self.run_on_watching(commands))
+        else:
+            replies = convert_replies(commands, self.client.execute_many(commands)) if commands else []
+        return check_replies(replies) if raise_on_error else replies
+
+    def execute_transaction(self, commands):
+        wrapped = [("MULTI",)] + commands + [("EXEC",)]
+        if self.watching is None:
+            return self.client.execute_many(wrapped)
+        replies = self.run_on_watching(wrapped)
+        self.client.pool.release(self.watching)
+        self.watching = None
+        return replies
+
+    def reset(self):
+        self.commands = []
+        if self.watching is not None:
+            self.unwatch()
+
+
+############# asyncio client, same pool and pipelines with coroutines ########################################################
+
+class AsyncConnection:
+    def __init__(self, reader, writer, decode=True):
+        self.reader = reader
+        self.writer = writer
+        self.parser = ReplyParser(decode)
+
+    @classmethod
+    async def connect(cls, host, port, decode=True):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer, decode)
+
+    async def read_reply(self):
+        parser = self.parser
+        reply = parser.get_reply()
+        while reply is ReplyParser.INCOMPLETE:
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError("Connection closed by the server")
+            parser.feed(data)
+            reply = parser.get_reply()
+        return reply
+
+    async def execute(self, commands):
+        self.writer.write(encode_commands(commands))
+        await self.writer.drain()
+        return [await self.read_reply() for _ in commands]
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncConnectionPool:
+    # one pool per event loop, coroutines wait for a free connection instead of threads
+    def __init__(self, host='127.0.0.1', port=6381, max_connections=50, decode=True):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.decode = decode
+        self.idle = collections.deque()
+        self.slots = asyncio.Semaphore(max_connections)
+
+    async def get_connection(self):
+        await self.slots.acquire()
+        if self.idle:
+            return self.idle.pop()
+        try:
+            return await AsyncConnection.connect(self.host, self.port, self.decode)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, connection):
+        self.idle.append(connection)
+        self.slots.release()
+
+    def discard(self, connection):
+        connection.close()
+        self.slots.release()
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().close()
+
+
+class AsyncRedisClient(Commands):
+    def __init__(self, host='127.0.0.1', port=6381, pool=None, **pool_options):
+        self.pool = pool or AsyncConnectionPool(host, port, **pool_options)
+
+    async def execute_command(self, *args):
+        return convert_replies([args], check_replies(await self.execute_many([args])))[0]
+
+    async def execute_many(self, commands):
+        connection = await self.pool.get_connection()
+        try:
+            replies = await connection.execute(commands)
+        except BaseException:
+            self.pool.discard(connection)
+            raise
+        self.pool.release(connection)
+        return replies
+
+    def pipeline(self, transaction=False):
+        return AsyncPipeline(self, transaction)
+
+    def close(self):
+        self.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+class AsyncPipeline(Pipeline):
+    # the asyncio Pipeline, watch() keeps one AsyncConnection of the pool until execute() or reset() like the
+    # blocking one does
+    async def watch(self, *keys):
+        if self.watching is None:
+            self.watching = await self.client.pool.get_connection()
+        await self.run_on_watching([("WATCH", *keys)])
+        return self
+
+    async def unwatch(self):
+        if self.watching is not None:
+            await self.run_on_watching([("UNWATCH",)])
+            self.client.pool.release(self.watching)
+            self.watching = None
+
+    async def immediate(self, *args):
+        if self.watching is None:
+            return await self.client.execute_command(*args)
+        return convert_replies([args], check_replies(await self.run_on_watching([args])))[0]
+
+    async def run_on_watching(self, commands):
+        try:
+            return await self.watching.execute(commands)
+        except BaseException:
+            self.client.pool.discard(self.watching)
+            self.watching = None
+            raise
+
+    async def execute(self, raise_on_error=True):
+        commands, self.commands = self.commands, []
+        if self.transaction:
+            replies = transaction_result(commands, await self.execute_transaction(commands))
+        elif self.watching is not None:
+            replies = convert_replies(commands, await self.run_on_watching(commands))
         else:
-            if command.startswith("SET") and "EX" in command.upper():
-                # SET command with TTL
-                client.send_command(command)
-                response = client.receive_response()
-            elif command.startswith("TTL"):
-                # TTL command
-                client.send_command(command)
-                response = client.receive_response()
-                print(response)
-            elif command.startswith("INCR") or command.startswith("DECR"):
-                # INCR or DECR command
-                client.send_command(command)
-                response = client.receive_response()
-                print(response)
-            else:
-                if client.in_transaction:
-                    print("Transaction commands are not sent until 'EXEC' is issued.")
-                else:
-                    client.send_command(command)
-                    response = client.receive_response()
-                    print(response)
-
-    client.close()
+            replies = convert_replies(commands, await self.client.execute_many(commands)) if commands else []
+        return check_replies(replies) if raise_on_error else replies
+
+    async def execute_transaction(self, commands):
+        wrapped = [("MULTI",)] + commands + [("EXEC",)]
+        if self.watching is None:
+            return await self.client.execute_many(wrapped)
+        replies = await self.run_on_watching(wrapped)
+        self.client.pool.release(self.watching)
+        self.watching = None
+        return replies
+
+    async def reset(self):
+        self.commands = []
+        if self.watching is not None:
+            await self.unwatch()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.reset()
+
 
+def format_reply(reply, indent=""):
+    # redis-cli like output for the interactive prompt
+    if isinstance(reply, ReplyError):
+        return f"(error) {reply}"
+    if reply is None:
+        return "(nil)"
+    if isinstance(reply, int):
+        return f"(integer) {reply}"
+    if isinstance(reply, list):
+        if not reply:
+            return "(empty array)"
+        width = len(str(len(reply)))
+        lines = []
+        for i, item in enumerate(reply, 1):
+            prefix = f"{i:>{width}}) "
+            lines.append(indent + prefix + format_reply(item, indent + " " * len(prefix)).lstrip())
+        return "\n".join(lines)
+    return f'"{reply}"' if " " in reply or not reply else reply
 
 
+if __name__ == "__main__":
+    # interactive prompt on one connection, so MULTI/EXEC and WATCH work the way they do in redis-cli
+    connection = Connection('127.0.0.1', 6381)
+    print(f"Connected to Redis server at {connection.host}:{connection.port}")
+
+    while True:
+        try:
+            command = input("Enter Redis command (or 'exit' to quit): ").strip()
+        except EOFError:
+            break
+        if command.lower() == 'exit':
+            break
+        if not command:
+            continue
+        try:
+            args = shlex.split(command)
+        except ValueError as e:
+            print(f"Invalid command: {e}")
+            continue
+        print(format_reply(connection.execute([args])[0]))
+
+    connection.close()
+    print("Connection closed")
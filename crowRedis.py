@@ -1,444 +1,5018 @@
+import argparse
+import binascii
+import bisect
+import collections
+import contextlib
+import fnmatch
+import os
+import queue
+import random
+import selectors
 import socket
 import threading
 import time
 import heapq  # Import the heapq module for priority queue
+import http.server
+import itertools
+import math
+import mmap
+import operator
+import re
+import shlex
+import struct
+import sys
+import zlib
+
+try:
+    import resource  # not on windows, only used for INFO memory where /proc is missing
+except ImportError:
+    resource = None
+
+ENCODING = 'utf-8'
+ENCODING_ERRORS = 'surrogateescape'  # keeps binary values byte-exact when they come back out
+INLINE_MAX_SIZE = 64 * 1024  # same limit real redis puts on inline (non RESP) requests
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class CommandError(Exception):
+    # raised (or returned) by handlers, ends up as an error reply for the client
+    pass
+
+
+WRONGTYPE_ERROR = "WRONGTYPE Operation against a key holding the wrong kind of value"
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def int_encoded(value):
+    # a string that is exactly a 64 bit integer is stored as an int, anything else stays a string
+    if 0 < len(value) <= 20 and (value[0].isdigit() or value[0] == '-'):
+        try:
+            number = int(value)
+        except ValueError:
+            return value
+        if INT64_MIN <= number <= INT64_MAX and str(number) == value:
+            return number
+    return value
+
+
+def format_float(value):
+    # INCRBYFLOAT style, like redis no exponent and no trailing .0
+    text = repr(value)
+    if 'e' in text:
+        return ('%.17f' % value).rstrip('0').rstrip('.')
+    if text.endswith('.0'):
+        text = text[:-2]
+    return text
+
+
+def format_score(value):
+    # sorted set scores, shortest text that reads back as the same float (1e+20, inf, 0.5, 3)
+    text = repr(value)
+    return text[:-2] if text.endswith('.0') else text
+
+
+def value_type(value):
+    # what TYPE and SCAN TYPE call a value
+    if value is None:
+        return "none"
+    if isinstance(value, (str, int)):
+        return "string"
+    if isinstance(value, collections.deque):
+        return "list"
+    if isinstance(value, HashValue):
+        return "hash"
+    return "zset"
+
+
+class SimpleString(str):
+    # status replies like OK, everything else that is a str goes out as a bulk string
+    pass
+
+
+############# RESP2 framing, requests can be RESP arrays (real redis clients) or plain inline lines (client.py) ##############
+
+def parse_commands(buffer):
+    """Parse every complete request in buffer.
+
+    Returns (commands, consumed) where commands is a list of (parts, is_resp) and
+    consumed is how many bytes of buffer were used, a half received request is left
+    in the buffer for the next recv.
+    """
+    commands = []
+    pos = 0
+    size = len(buffer)
+    while pos < size:
+        if buffer[pos] == 42:  # '*', multibulk request
+            line_end = buffer.find(b"\r\n", pos)
+            if line_end == -1:
+                break
+            try:
+                count = int(buffer[pos + 1:line_end])
+            except ValueError:
+                raise ProtocolError("invalid multibulk length")
+            cursor = line_end + 2
+            parts = []
+            complete = True
+            for _ in range(count):
+                if cursor >= size:
+                    complete = False
+                    break
+                if buffer[cursor] != 36:  # '$'
+                    raise ProtocolError(f"expected '$', got '{chr(buffer[cursor])}'")
+                line_end = buffer.find(b"\r\n", cursor)
+                if line_end == -1:
+                    complete = False
+                    break
+                try:
+                    length = int(buffer[cursor + 1:line_end])
+                except ValueError:
+                    raise ProtocolError("invalid bulk length")
+                start = line_end + 2
+                if start + length + 2 > size:
+                    complete = False
+                    break
+                parts.append(bytes(buffer[start:start + length]).decode(ENCODING, ENCODING_ERRORS))
+                cursor = start + length + 2
+            if not complete:
+                break
+            pos = cursor
+            if parts:
+                commands.append((parts, True))
+        else:
+            line_end = buffer.find(b"\n", pos)
+            if line_end == -1:
+                if size - pos > INLINE_MAX_SIZE:
+                    raise ProtocolError("too big inline request")
+                break
+            line = bytes(buffer[pos:line_end]).decode(ENCODING, ENCODING_ERRORS)
+            pos = line_end + 1
+            parts = line.split()
+            if parts:
+                commands.append((parts, False))
+    return commands, pos
+
+
+def encode_command(parts):
+    # a request as a RESP array, this is also the record format of the AOF
+    out = [b"*%d\r\n" % len(parts)]
+    for part in parts:
+        data = str(part).encode(ENCODING, ENCODING_ERRORS)
+        out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(out)
+
+
+def encode_reply(reply, resp=True):
+    if not resp:
+        return (legacy_reply_text(reply) + "\n").encode(ENCODING, ENCODING_ERRORS)
+    if isinstance(reply, SimpleString):
+        return f"+{reply}\r\n".encode(ENCODING, ENCODING_ERRORS)
+    if isinstance(reply, CommandError):
+        message = str(reply)
+        if message.startswith("ERROR: "):
+            message = message[len("ERROR: "):]
+        code = message.split(" ", 1)[0]
+        if not (code.isalpha() and code.isupper()):
+            message = f"ERR {message}"
+        return f"-{message}\r\n".encode(ENCODING, ENCODING_ERRORS)
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, bool):
+        reply = int(reply)
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, (list, tuple)):
+        return b"*%d\r\n" % len(reply) + b"".join(encode_reply(item) for item in reply)
+    data = str(reply).encode(ENCODING, ENCODING_ERRORS)
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+def legacy_reply_text(reply):
+    # what the old line based protocol sent back, client.py just prints this
+    if reply is None:
+        return "nil"
+    if isinstance(reply, (list, tuple)):
+        return ' '.join(legacy_reply_text(item) for item in reply)
+    return str(reply)
+
+
+############# command table, every command lives here once: handler, arity, flags and where its keys are ###################
+
+class CommandSpec:
+    def __init__(self, name, handler, arity, flags, first_key, last_key, key_step):
+        self.name = name
+        self.handler = handler
+        self.arity = arity  # like redis, positive = exact number of parts, negative = at least that many
+        self.flags = flags
+        self.first_key = first_key
+        self.last_key = last_key
+        self.key_step = key_step
+        self.movable_keys = "movablekeys" in flags
+        self.readonly = "readonly" in flags
+        # keyless and not fast: may take shard locks of its own (KEYS, SCAN, SAVE, MIGRATE, ...), so EXEC and FCALL
+        # have to hold every shard lock around it, a lock taken out of index order could deadlock against them
+        self.keyspace_wide = first_key == 0 and "fast" not in flags
+        self.reset_stats()
+
+    def reset_stats(self):
+        # INFO commandstats. updated without a lock like the server's other counters, under threads an
+        # increment can get lost now and then, that is fine for stats
+        self.calls = 0
+        self.nanoseconds = 0
+        self.rejected_calls = 0  # refused before running: arity, READONLY, a cluster redirect, OOM, ...
+        self.failed_calls = 0  # ran and replied with an error
+
+    def arity_ok(self, count):
+        return count == self.arity if self.arity > 0 else count >= -self.arity
+
+    def keys(self, parts):
+        if self.first_key == 0:
+            return []
+        if self.movable_keys:
+            # FCALL name numkeys key [key ...] arg [arg ...], the key count sits right before the keys
+            try:
+                count = int(parts[self.first_key - 1])
+            except (ValueError, IndexError):
+                return []
+            return parts[self.first_key:self.first_key + max(count, 0)]
+        last_key = self.last_key if self.last_key >= 0 else len(parts) + self.last_key
+        return parts[self.first_key:last_key + 1:self.key_step]
+
+    def info(self):
+        return [self.name.lower(), self.arity, [SimpleString(flag) for flag in self.flags],
+                self.first_key, self.last_key, self.key_step]
+
+
+COMMANDS = {}
+SUBSCRIBED_COMMANDS = ("SUBSCRIBE", "PSUBSCRIBE", "UNSUBSCRIBE", "PUNSUBSCRIBE", "PING")  # all a subscriber may send
+
+
+def command(name, arity, flags="", first_key=1, last_key=1, key_step=1):
+    # registers a RedisServer method as the handler of a command
+    def register(handler):
+        COMMANDS[name] = CommandSpec(name, handler, arity, tuple(flags.split()), first_key, last_key, key_step)
+        return handler
+    return register
+
+
+############# SCAN index, the keys of one shard in hash buckets so a cursor can walk them a bucket at a time ################
+
+def reverse_bits(value, bits):
+    return int(format(value, f"0{bits}b")[::-1], 2) if bits else 0
+
+
+class ScanIndex:
+    # grows like linear hashing, one bucket is split every MAX_AVERAGE inserts, so unlike a dict resize there
+    # is never a pause. buckets are addressed by the low bits of the key hash, the cursor counts through them
+    # in reversed bit order like redis' dictScan, which is what keeps a cursor valid while the table grows:
+    # every key that is there for the whole walk is returned, maybe twice, never missed
+    MAX_AVERAGE = 64
+
+    def __init__(self, shard_count):
+        self.shard_count = shard_count  # keys of one shard share hash % shard_count, buckets use the bits above
+        self.buckets = [set()]
+        self.bits = 0  # 2 ** bits buckets, the first `split` of them already split into a second one at + 2 ** bits
+        self.split = 0
+        self.count = 0
+
+    def add(self, key):
+        # caller makes sure the key is new
+        key_hash = hash(key) // self.shard_count
+        index = key_hash & ((1 << self.bits) - 1)
+        if index < self.split:
+            index = key_hash & ((2 << self.bits) - 1)
+        buckets = self.buckets
+        buckets[index].add(key)
+        self.count += 1
+        if self.count > self.MAX_AVERAGE * len(buckets):
+            self.split_bucket()
+
+    def discard(self, key):
+        key_hash = hash(key) // self.shard_count
+        index = key_hash & ((1 << self.bits) - 1)
+        if index < self.split:
+            index = key_hash & ((2 << self.bits) - 1)
+        self.buckets[index].discard(key)
+        self.count -= 1
+
+    def split_bucket(self):
+        bucket = self.buckets[self.split]
+        shard_count, bit = self.shard_count, 1 << self.bits
+        moved = {key for key in bucket if hash(key) // shard_count & bit}
+        bucket -= moved
+        self.buckets.append(moved)  # lands at split + 2 ** bits
+        self.split += 1
+        if self.split == 1 << self.bits:
+            self.bits += 1
+            self.split = 0
+
+    def visit(self, cursor, keys):
+        # adds the keys of bucket `cursor` of the 2 ** bits table (and its split half) to keys,
+        # returns the next cursor, 0 after the last bucket
+        mask = (1 << self.bits) - 1
+        index = cursor & mask
+        keys.extend(self.buckets[index])
+        if index < self.split:
+            keys.extend(self.buckets[index + (1 << self.bits)])
+        cursor = reverse_bits(index, self.bits) + 1
+        if cursor > mask:
+            return 0
+        return reverse_bits(cursor, self.bits)
+
+
+############# striped keyspace, keys hash to one of N shards and every shard has its own lock ###############################
+
+class Keyspace:
+    # behaves like the old self.data dict, but independent keys do not fight over one lock
+    def __init__(self, shard_count=16):
+        self.shard_count = shard_count
+        self.shards = [{} for _ in range(shard_count)]
+        self.locks = [threading.RLock() for _ in range(shard_count)]  # reentrant so EXEC can hold them around handlers
+        # eviction bookkeeping, only filled while maxmemory needs it. access_clock(old clock or None) -> new clock
+        self.access_clock = None
+        self.clocks = [{} for _ in range(shard_count)]  # key -> packed LRU/LFU clock, one small int per key
+        self.sample_lists = [[] for _ in range(shard_count)]  # keys to draw eviction samples from, may hold stale keys
+        self.scan_indexes = [ScanIndex(shard_count) for _ in range(shard_count)]  # the keys again, in SCAN order
+        self.slot_keys = None  # cluster mode, per shard {hash slot: set of keys} so a slot can be migrated
+
+    def shard_index(self, key):
+        return hash(key) % self.shard_count
+
+    def shard(self, key):
+        return self.shards[hash(key) % self.shard_count]
+
+    def lock_for(self, key):
+        return self.locks[hash(key) % self.shard_count]
+
+    @contextlib.contextmanager
+    def locked(self, keys):
+        # multi key operations always take their shard locks in index order, so two of them can never deadlock
+        indexes = sorted({self.shard_index(key) for key in keys})
+        for index in indexes:
+            self.locks[index].acquire()
+        try:
+            yield
+        finally:
+            for index in reversed(indexes):
+                self.locks[index].release()
+
+    def locked_all(self):
+        return self.locked_indexes(range(self.shard_count))
+
+    @contextlib.contextmanager
+    def locked_indexes(self, indexes):
+        indexes = sorted(indexes)
+        for index in indexes:
+            self.locks[index].acquire()
+        try:
+            yield
+        finally:
+            for index in reversed(indexes):
+                self.locks[index].release()
+
+    def __getitem__(self, key):
+        return self.shards[hash(key) % self.shard_count][key]
+
+    def __setitem__(self, key, value):
+        index = hash(key) % self.shard_count
+        shard = self.shards[index]
+        if key not in shard:
+            self.scan_indexes[index].add(key)
+            if self.access_clock is not None:
+                self.track(index, key, None)
+            if self.slot_keys is not None:
+                self.slot_keys[index].setdefault(key_hash_slot(key), set()).add(key)
+        shard[key] = value
+
+    def __delitem__(self, key):
+        index = hash(key) % self.shard_count
+        del self.shards[index][key]
+        self.scan_indexes[index].discard(key)
+        if self.access_clock is not None:
+            self.clocks[index].pop(key, None)
+        if self.slot_keys is not None:
+            self.forget_slot(index, key)
+
+    def __contains__(self, key):
+        return key in self.shards[hash(key) % self.shard_count]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def __iter__(self):
+        for key, _ in self.items():
+            yield key
+
+    def get(self, key, default=None):
+        return self.shards[hash(key) % self.shard_count].get(key, default)
+
+    def pop(self, key, *default):
+        index = hash(key) % self.shard_count
+        if self.access_clock is not None:
+            self.clocks[index].pop(key, None)
+        shard = self.shards[index]
+        if key in shard:
+            self.scan_indexes[index].discard(key)
+            if self.slot_keys is not None:
+                self.forget_slot(index, key)
+        return shard.pop(key, *default)
+
+    def load(self, index, entries):
+        # bulk insert of a decoded snapshot shard, caller holds the shard lock
+        shard = self.shards[index]
+        scan_index = self.scan_indexes[index]
+        for key in entries:
+            if key not in shard:
+                scan_index.add(key)
+                if self.slot_keys is not None:
+                    self.slot_keys[index].setdefault(key_hash_slot(key), set()).add(key)
+        shard.update(entries)
+
+    def items(self):
+        # copies one shard at a time under its own lock, never the whole keyspace at once
+        for index, shard in enumerate(self.shards):
+            with self.locks[index]:
+                items = list(shard.items())
+            yield from items
+
+    def clear(self):
+        for index, shard in enumerate(self.shards):
+            with self.locks[index]:
+                shard.clear()
+                self.clocks[index].clear()
+                self.sample_lists[index].clear()
+                self.scan_indexes[index] = ScanIndex(self.shard_count)
+                if self.slot_keys is not None:
+                    self.slot_keys[index].clear()
+
+    def forget_slot(self, index, key):
+        slot = key_hash_slot(key)
+        keys = self.slot_keys[index][slot]
+        keys.discard(key)
+        if not keys:
+            del self.slot_keys[index][slot]
+
+    def enable_slot_index(self):
+        slot_keys = [{} for _ in range(self.shard_count)]
+        with self.locked_all():
+            for index, shard in enumerate(self.shards):
+                for key in shard:
+                    slot_keys[index].setdefault(key_hash_slot(key), set()).add(key)
+            self.slot_keys = slot_keys
+
+    def keys_in_slot(self, slot, count=None):
+        keys = []
+        for index in range(self.shard_count):
+            with self.locks[index]:
+                keys.extend(itertools.islice(self.slot_keys[index].get(slot, ()), count))
+            if count is not None and len(keys) >= count:
+                return keys[:count]
+        return keys
+
+    def track(self, index, key, old_clock):
+        clocks = self.clocks[index]
+        if old_clock is None and key not in clocks:
+            sample_list = self.sample_lists[index]
+            sample_list.append(key)
+            if len(sample_list) > 2 * len(clocks) + 1024:
+                sample_list[:] = list(clocks)  # too many deleted keys piled up, start over from the live ones
+                sample_list.append(key)
+        clocks[key] = self.access_clock(old_clock)
+
+    def touch(self, key):
+        # a command used the key, moves its access clock
+        index = hash(key) % self.shard_count
+        with self.locks[index]:
+            if key in self.shards[index]:
+                self.track(index, key, self.clocks[index].get(key))
+
+    def enable_access_tracking(self, access_clock):
+        self.access_clock = access_clock
+        for index, shard in enumerate(self.shards):
+            with self.locks[index]:
+                for key in shard:
+                    if key not in self.clocks[index]:
+                        self.track(index, key, None)
+
+    def sample(self, count):
+        # up to count random keys of one random shard. a busy shard gives nothing instead of waiting,
+        # eviction can run while the caller holds other shard locks (EXEC)
+        index = random.randrange(self.shard_count)
+        if not self.locks[index].acquire(blocking=False):
+            return []
+        try:
+            shard, clocks, sample_list = self.shards[index], self.clocks[index], self.sample_lists[index]
+            keys = []
+            for _ in range(count * 2):
+                if not sample_list or len(keys) == count:
+                    break
+                i = random.randrange(len(sample_list))
+                key = sample_list[i]
+                if key in shard and key in clocks:
+                    keys.append(key)
+                else:
+                    sample_list[i] = sample_list[-1]  # deleted key, swap remove it
+                    sample_list.pop()
+            return keys
+        finally:
+            self.locks[index].release()
+
+    def scan(self, cursor, count):
+        # SCAN over all shards: cursor = bucket cursor * shard_count + shard. walks whole buckets until it has
+        # count keys, taking one shard lock per bucket so other commands get in between. returns (cursor, keys),
+        # cursor 0 once every shard is done
+        index, bucket_cursor = cursor % self.shard_count, cursor // self.shard_count
+        keys = []
+        visits = 0
+        while len(keys) < count and visits < count * 10:  # empty buckets count too, bounds the work per call
+            with self.locks[index]:
+                bucket_cursor = self.scan_indexes[index].visit(bucket_cursor, keys)
+            visits += 1
+            if bucket_cursor == 0:
+                index += 1
+                if index == self.shard_count:
+                    return 0, keys
+        return bucket_cursor * self.shard_count + index, keys
+
+
+############# hash type, small hashes are one flat list like redis' listpack and turn into a dict once they grow ###############
+
+class HashValue:
+    # compact: entries = [field, value, field, value, ...], a scan over a few dozen strings beats a dict
+    # on memory and is still fast. past the limits the fields move into a dict and stay there
+    MAX_COMPACT_ENTRIES = 128
+    MAX_COMPACT_LENGTH = 64
+    __slots__ = ("entries", "table", "scan_index")
+
+    def __init__(self, pairs=()):
+        self.entries = []
+        self.table = None
+        self.scan_index = None  # the dict's fields again in HSCAN order, built by the first HSCAN
+        for field, value in pairs:
+            self.set(field, value)
+
+    def __len__(self):
+        return len(self.table) if self.table is not None else len(self.entries) // 2
+
+    def find(self, field):
+        entries = self.entries
+        for i in range(0, len(entries), 2):
+            if entries[i] == field:
+                return i
+        return -1
+
+    def get(self, field):
+        if self.table is not None:
+            return self.table.get(field)
+        i = self.find(field)
+        return self.entries[i + 1] if i >= 0 else None
+
+    def __contains__(self, field):
+        if self.table is not None:
+            return field in self.table
+        return self.find(field) >= 0
+
+    def set(self, field, value):
+        # returns True when the field is new
+        if self.table is not None:
+            is_new = field not in self.table
+            self.table[field] = value
+            if is_new and self.scan_index is not None:
+                self.scan_index.add(field)
+            return is_new
+        i = self.find(field)
+        if i >= 0:
+            self.entries[i + 1] = value
+            is_new = False
+        else:
+            self.entries = self.entries + [field, value]  # exact size, += would over allocate like any growing list
+            is_new = True
+        if (len(self.entries) > 2 * self.MAX_COMPACT_ENTRIES
+                or len(field) > self.MAX_COMPACT_LENGTH or len(value) > self.MAX_COMPACT_LENGTH):
+            self.table = dict(self.items())
+            self.entries = []
+        return is_new
+
+    def delete(self, field):
+        if self.table is not None:
+            if self.table.pop(field, None) is None:
+                return False
+            if self.scan_index is not None:
+                self.scan_index.discard(field)
+            return True
+        i = self.find(field)
+        if i < 0:
+            return False
+        del self.entries[i:i + 2]
+        return True
+
+    def items(self):
+        if self.table is not None:
+            return self.table.items()
+        return zip(self.entries[::2], self.entries[1::2])
+
+    def is_compact(self):
+        return self.table is None
+
+    def scan(self, cursor, count):
+        # dict encoding only, the same bucket walk as the keyspace SCAN: a field that is there for the whole
+        # walk is returned even when others are added or deleted in between. returns (cursor, fields)
+        if self.scan_index is None:
+            self.scan_index = ScanIndex(1)
+            for field in self.table:
+                self.scan_index.add(field)
+        fields = []
+        visits = 0
+        while True:
+            cursor = self.scan_index.visit(cursor, fields)
+            visits += 1
+            if cursor == 0 or len(fields) >= count or visits >= count * 10:  # empty buckets count too
+                return cursor, fields
+
+    def copy(self):
+        copied = HashValue()
+        copied.entries = list(self.entries)
+        copied.table = dict(self.table) if self.table is not None else None
+        return copied
+
+
+############# sorted set type, a skiplist ordered by (score, member) plus a member -> score dict, like redis' zset ##############
+
+class SkipListNode:
+    __slots__ = ("member", "score", "forward", "span", "backward")
+
+    def __init__(self, level, score, member):
+        self.member = member
+        self.score = score
+        self.forward = [None] * level
+        self.span = [0] * level  # how many nodes forward[i] jumps over, ranks are sums of spans
+        self.backward = None
+
+
+class SkipList:
+    MAX_LEVEL = 32
+    P = 0.25
+
+    def __init__(self):
+        self.header = SkipListNode(self.MAX_LEVEL, 0, None)
+        self.tail = None
+        self.length = 0
+        self.level = 1
+
+    def random_level(self):
+        level = 1
+        while level < self.MAX_LEVEL and random.random() < self.P:
+            level += 1
+        return level
+
+    def insert(self, score, member):
+        # caller makes sure the member is not in the list yet
+        update = [None] * self.MAX_LEVEL
+        rank = [0] * self.MAX_LEVEL
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            rank[i] = 0 if i == self.level - 1 else rank[i + 1]
+            node = x.forward[i]
+            while node is not None and (node.score < score or (node.score == score and node.member < member)):
+                rank[i] += x.span[i]
+                x = node
+                node = x.forward[i]
+            update[i] = x
+        level = self.random_level()
+        if level > self.level:
+            for i in range(self.level, level):
+                rank[i] = 0
+                update[i] = self.header
+                update[i].span[i] = self.length
+            self.level = level
+        x = SkipListNode(level, score, member)
+        for i in range(level):
+            x.forward[i] = update[i].forward[i]
+            update[i].forward[i] = x
+            x.span[i] = update[i].span[i] - (rank[0] - rank[i])
+            update[i].span[i] = (rank[0] - rank[i]) + 1
+        for i in range(level, self.level):
+            update[i].span[i] += 1
+        x.backward = None if update[0] is self.header else update[0]
+        if x.forward[0] is not None:
+            x.forward[0].backward = x
+        else:
+            self.tail = x
+        self.length += 1
+        return x
+
+    def extend_sorted(self, items):
+        # bulk load of (member, score) already in order into an empty list, every node is linked at
+        # the tail so there is no search per insert
+        last = [self.header] * self.MAX_LEVEL
+        last_rank = [0] * self.MAX_LEVEL
+        previous = None
+        rank = 0
+        for member, score in items:
+            rank += 1
+            level = self.random_level()
+            node = SkipListNode(level, score, member)
+            for i in range(level):
+                last[i].forward[i] = node
+                last[i].span[i] = rank - last_rank[i]
+                last[i] = node
+                last_rank[i] = rank
+            node.backward = previous
+            previous = node
+            self.level = max(self.level, level)
+        for i in range(self.level):
+            last[i].span[i] = rank - last_rank[i]
+        self.tail = previous
+        self.length = rank
+
+    def delete(self, score, member):
+        update = [None] * self.MAX_LEVEL
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            node = x.forward[i]
+            while node is not None and (node.score < score or (node.score == score and node.member < member)):
+                x = node
+                node = x.forward[i]
+            update[i] = x
+        x = x.forward[0]
+        if x is None or x.score != score or x.member != member:
+            return False
+        for i in range(self.level):
+            if update[i].forward[i] is x:
+                update[i].span[i] += x.span[i] - 1
+                update[i].forward[i] = x.forward[i]
+            else:
+                update[i].span[i] -= 1
+        if x.forward[0] is not None:
+            x.forward[0].backward = x.backward
+        else:
+            self.tail = x.backward
+        while self.level > 1 and self.header.forward[self.level - 1] is None:
+            self.level -= 1
+        self.length -= 1
+        return True
+
+    def rank(self, score, member):
+        # 1 based rank of the member, 0 if it is not there
+        rank = 0
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            node = x.forward[i]
+            while node is not None and (node.score < score or (node.score == score and node.member <= member)):
+                rank += x.span[i]
+                x = node
+                node = x.forward[i]
+            if x is not self.header and x.member == member:
+                return rank
+        return 0
+
+    def node_by_rank(self, rank):
+        # 1 based, walks the spans down so it is O(log n) like every other lookup
+        traversed = 0
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and traversed + x.span[i] <= rank:
+                traversed += x.span[i]
+                x = x.forward[i]
+            if traversed == rank:
+                return x if x is not self.header else None
+        return None
+
+    def first_from(self, low, exclusive):
+        # first node with score >= low (> low when exclusive)
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            node = x.forward[i]
+            while node is not None and (node.score < low or (exclusive and node.score == low)):
+                x = node
+                node = x.forward[i]
+        return x.forward[0]
+
+
+class SortedSetValue:
+    __slots__ = ("scores", "skiplist", "scan_index")
+
+    def __init__(self, items=()):
+        self.scores = dict(items)  # member -> score, O(1) ZSCORE and membership
+        # (score, member) order for ranks and ranges. built on first use, so loading and copying
+        # a big sorted set is only a dict copy
+        self.skiplist = None
+        self.scan_index = None  # the members again in ZSCAN order, also built on first use
+
+    def __len__(self):
+        return len(self.scores)
+
+    def ordered(self):
+        if self.skiplist is None:
+            self.skiplist = SkipList()
+            self.skiplist.extend_sorted(sorted(self.scores.items(), key=lambda item: (item[1], item[0])))
+        return self.skiplist
+
+    def score(self, member):
+        return self.scores.get(member)
+
+    def set(self, member, score):
+        # returns True when the member is new
+        current = self.scores.get(member)
+        if current == score:
+            return False
+        if self.skiplist is not None:
+            if current is not None:
+                self.skiplist.delete(current, member)
+            self.skiplist.insert(score, member)
+        if current is None and self.scan_index is not None:
+            self.scan_index.add(member)
+        self.scores[member] = score
+        return current is None
+
+    def remove(self, member):
+        score = self.scores.pop(member, None)
+        if score is None:
+            return False
+        if self.skiplist is not None:
+            self.skiplist.delete(score, member)
+        if self.scan_index is not None:
+            self.scan_index.discard(member)
+        return True
+
+    def scan(self, cursor, count):
+        # like HashValue.scan, buckets of members so a score change or a ZREM between calls never skips a member
+        if self.scan_index is None:
+            self.scan_index = ScanIndex(1)
+            for member in self.scores:
+                self.scan_index.add(member)
+        members = []
+        visits = 0
+        while True:
+            cursor = self.scan_index.visit(cursor, members)
+            visits += 1
+            if cursor == 0 or len(members) >= count or visits >= count * 10:
+                return cursor, members
+
+    def rank(self, member):
+        score = self.scores.get(member)
+        if score is None:
+            return None
+        return self.ordered().rank(score, member) - 1
+
+    def range_by_rank(self, start, stop, reverse=False):
+        # 0 based inclusive ranks, already clamped by the caller
+        skiplist = self.ordered()
+        result = []
+        if reverse:
+            node = skiplist.node_by_rank(len(self) - start)
+            for _ in range(stop - start + 1):
+                result.append((node.member, node.score))
+                node = node.backward
+        else:
+            node = skiplist.node_by_rank(start + 1)
+            for _ in range(stop - start + 1):
+                result.append((node.member, node.score))
+                node = node.forward[0]
+        return result
+
+    def range_by_score(self, low, low_exclusive, high, high_exclusive, offset=0, count=-1):
+        result = []
+        node = self.ordered().first_from(low, low_exclusive)
+        while node is not None and offset > 0:
+            node = node.forward[0]
+            offset -= 1
+        while node is not None and count != 0:
+            if node.score > high or (high_exclusive and node.score == high):
+                break
+            result.append((node.member, node.score))
+            node = node.forward[0]
+            count -= 1
+        return result
+
+    def copy(self):
+        return SortedSetValue(self.scores)
+
+
+############# server side functions, a tiny command language that FUNCTION LOAD compiles and FCALL runs atomically ##########
+
+FUNCTION_OPERATORS = {"==": operator.eq, "!=": operator.ne, "<": operator.lt, "<=": operator.le,
+                      ">": operator.gt, ">=": operator.ge}
+FUNCTION_OPERAND = re.compile(r"(KEYS|ARGV)\[(\d+)\]|\$(\d+)")
+
+
+class ServerFunction:
+    """A named list of statements, compiled once when it is loaded.
+
+    One statement per line or separated by ';':
+        GET KEYS[1]              any command. KEYS[n] and ARGV[n] are the FCALL keys and arguments,
+        SET KEYS[1] ARGV[1]      $n is the reply of the n-th statement, all of them counted from 1
+        IF $1 == nil RETURN 0    IF a op b in front of a statement only runs it when the comparison holds,
+                                 op is one of == != < <= > >=, nil stands for a missing value
+        ERROR text               stops the function with an error reply
+        RETURN $2                stops the function with that reply
+    Without RETURN the reply of the last statement is the result.
+    """
+
+    def __init__(self, name, body):
+        self.name = name
+        self.body = body
+        self.statements = []  # (condition or None, "RETURN" / "ERROR" / CommandSpec, operands)
+        self.writes = False  # FCALL_RO only runs functions without write commands
+        self.keyspace_wide = False  # FCALL takes every shard lock, see CommandSpec.keyspace_wide
+        for line in body.splitlines():
+            lexer = shlex.shlex(line, posix=True, punctuation_chars=";")
+            lexer.whitespace_split = True
+            try:
+                tokens = list(lexer)
+            except ValueError as e:
+                raise CommandError(f"ERROR: {e} in function {name}")
+            statement = []
+            for token in tokens + [";"]:
+                if token != ";":
+                    statement.append(token)
+                elif statement:
+                    self.statements.append(self.compile(statement))
+                    statement = []
+        if not self.statements:
+            raise CommandError(f"ERROR: function {name} has no statements")
+
+    def compile(self, tokens):
+        condition = None
+        if tokens[0].upper() == "IF":
+            if len(tokens) < 5 or tokens[2] not in FUNCTION_OPERATORS:
+                raise CommandError("ERROR: IF needs 'IF a op b statement', op is one of == != < <= > >=")
+            condition = (self.operand(tokens[1]), tokens[2], self.operand(tokens[3]))
+            tokens = tokens[4:]
+        keyword = tokens[0].upper()
+        if keyword == "RETURN":
+            if len(tokens) != 2:
+                raise CommandError("ERROR: RETURN takes one value")
+            kind, value = self.operand(tokens[1])
+            if kind == "":
+                value = int_encoded(value)  # RETURN 1 replies with an integer, like a number returned from lua
+            return condition, "RETURN", [(kind, value)]
+        if keyword == "ERROR":
+            return condition, "ERROR", [("", " ".join(tokens[1:]) or "function failed")]
+        spec = COMMANDS.get(keyword)
+        if spec is None:
+            raise CommandError(f"ERROR: unknown command '{tokens[0]}' in function {self.name}")
+        if "noscript" in spec.flags:
+            raise CommandError(f"ERROR: the {spec.name} command can not be used in a function")
+        if not spec.arity_ok(len(tokens)):
+            raise CommandError(f"ERROR: wrong number of arguments for {spec.name} in function {self.name}")
+        if "write" in spec.flags:
+            self.writes = True
+        if spec.keyspace_wide:
+            self.keyspace_wide = True
+        return condition, spec, [self.operand(token) for token in tokens[1:]]
+
+    def operand(self, token):
+        # ("KEYS", n) / ("ARGV", n) / ("$", n) with n counted from 1, ("nil", None) or ("", literal text)
+        match = FUNCTION_OPERAND.fullmatch(token)
+        if match is None:
+            return ("nil", None) if token == "nil" else ("", token)
+        if match.group(3) is not None:
+            number = int(match.group(3))
+            if not 1 <= number <= len(self.statements):
+                raise CommandError(f"ERROR: {token} does not refer to an earlier statement")
+            return "$", number
+        return match.group(1), int(match.group(2))
+
+
+############# pub/sub pattern index, PSUBSCRIBE patterns in a trie keyed by their literal prefix ##############################
+
+class PatternNode:
+    __slots__ = ("children", "patterns")
+
+    def __init__(self):
+        self.children = {}  # next prefix character -> PatternNode
+        self.patterns = {}  # pattern -> tuple of subscribed clients. replaced on every change, never changed in place
+
+
+class PatternTrie:
+    # a PUBLISH walks down the channel name and only runs fnmatch on patterns whose literal prefix (everything
+    # before the first glob character) the channel starts with. changes are copy on write under the caller's lock,
+    # so PUBLISH reads the trie without taking any lock
+    def __init__(self):
+        self.root = PatternNode()
+        self.count = 0  # patterns with at least one subscriber, PUBSUB NUMPAT
+
+    @staticmethod
+    def prefix(pattern):
+        for i, char in enumerate(pattern):
+            if char in "*?[\\":
+                return pattern[:i]
+        return pattern
+
+    def add(self, pattern, client):
+        node = self.root
+        for char in self.prefix(pattern):
+            child = node.children.get(char)
+            if child is None:
+                child = node.children[char] = PatternNode()
+            node = child
+        clients = node.patterns.get(pattern, ())
+        if not clients:
+            self.count += 1
+        node.patterns = {**node.patterns, pattern: clients + (client,)}
+
+    def remove(self, pattern, client):
+        prefix = self.prefix(pattern)
+        path = [self.root]
+        for char in prefix:
+            path.append(path[-1].children[char])
+        node = path[-1]
+        patterns = dict(node.patterns)
+        clients = tuple(subscriber for subscriber in patterns[pattern] if subscriber is not client)
+        if clients:
+            patterns[pattern] = clients
+        else:
+            del patterns[pattern]
+            self.count -= 1
+        node.patterns = patterns
+        for char, parent, child in reversed(list(zip(prefix, path, path[1:]))):
+            if child.children or child.patterns:
+                break
+            del parent.children[char]
+
+    def match(self, channel):
+        # (pattern, clients) for every pattern the channel matches
+        if not self.count:
+            return []
+        matches = []
+        node = self.root
+        for i in range(len(channel) + 1):
+            for pattern, clients in node.patterns.items():
+                if fnmatch.fnmatchcase(channel, pattern):
+                    matches.append((pattern, clients))
+            if i == len(channel):
+                break
+            node = node.children.get(channel[i])
+            if node is None:
+                break
+        return matches
+
+    def patterns(self):
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            yield from node.patterns
+            nodes.extend(node.children.values())
+
+
+############# maxmemory, approximate sizes and the access clocks the eviction policies look at ###############################
+
+EVICTION_POLICIES = ("noeviction", "allkeys-lru", "allkeys-lfu", "allkeys-random",
+                     "volatile-lru", "volatile-lfu", "volatile-ttl", "volatile-random")
+LRU_CLOCK_MAX = (1 << 24) - 1  # 24 bit clock in seconds, like redis it wraps after ~194 days
+LFU_INIT_VAL = 5  # new keys start with a small counter so they are not evicted right away
+LFU_LOG_FACTOR = 10
+LFU_DECAY_MINUTES = 1
+
+
+def lru_clock(old_clock=None):
+    return int(time.time()) & LRU_CLOCK_MAX
+
+
+def lfu_clock(old_clock=None):
+    # 16 bits of minutes since the last decay + an 8 bit logarithmic access counter, redis' layout
+    minutes = int(time.time() // 60) & 0xFFFF
+    if old_clock is None:
+        return (minutes << 8) | LFU_INIT_VAL
+    counter = lfu_decayed_counter(old_clock, minutes)
+    if counter < 255:
+        base = max(counter - LFU_INIT_VAL, 0)
+        if random.random() < 1.0 / (base * LFU_LOG_FACTOR + 1):
+            counter += 1
+    return (minutes << 8) | counter
+
+
+def lfu_decayed_counter(clock, minutes=None):
+    if minutes is None:
+        minutes = int(time.time() // 60) & 0xFFFF
+    periods = ((minutes - (clock >> 8)) & 0xFFFF) // LFU_DECAY_MINUTES
+    return max((clock & 0xFF) - periods, 0)
+
+
+def estimate_size(key, value):
+    # rough bytes one key costs. O(1) even for big values, containers count as their length times
+    # the size of their first element plus the per element overhead
+    if value is None:
+        return 0
+    size = 100 + len(key)  # the key object and its dict slot
+    if isinstance(value, str):
+        return size + 50 + len(value)
+    if isinstance(value, int):
+        return size + 32
+    if isinstance(value, collections.deque):
+        return size + 64 + (len(value) * (58 + len(value[0])) if value else 0)
+    if isinstance(value, HashValue):
+        field, field_value = next(iter(value.items()), ("", ""))
+        per_field = 100 + len(field) + len(field_value) + (0 if value.is_compact() else 40)
+        return size + 64 + len(value) * per_field
+    if isinstance(value, SortedSetValue):
+        member = next(iter(value.scores), "")
+        return size + 64 + len(value) * (250 + len(member))  # member, score, dict slot and skiplist node
+    return size
+
+
+def parse_memory(text):
+    # '100mb', '1gb', '512kb' or plain bytes, for --maxmemory
+    text = text.strip().lower()
+    for suffix, factor in (("gb", 1024 ** 3), ("mb", 1024 ** 2), ("kb", 1024), ("b", 1)):
+        if text.endswith(suffix):
+            return int(text[:-len(suffix)]) * factor
+    return int(text)
+
+
+############# binary snapshot format ###################################################################################
+#
+#   header:  b"CROWRDB" + version (1 byte)
+#   entry:   [EXPIRE_MS + int64 unix ms]  type tag (1 byte)  key (uint32 len + bytes)  value
+#            string value = uint32 len + bytes, int value = int64, list value = uint32 count + that many strings,
+#            hash value = uint32 field count + field, value, field, value, ... as strings,
+#            sorted set value = uint32 member count + (member string + float64 score) for each member
+#   trailer: EOF + crc32 (uint32) of everything before it
+#
+# all numbers are little endian
+
+SNAPSHOT_MAGIC = b"CROWRDB"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_TYPE_STRING = 0
+SNAPSHOT_TYPE_LIST = 1
+SNAPSHOT_TYPE_INT = 2
+SNAPSHOT_TYPE_HASH = 3
+SNAPSHOT_TYPE_ZSET = 4
+SNAPSHOT_OPCODE_EXPIRE_MS = 0xFC
+SNAPSHOT_OPCODE_EOF = 0xFF
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def encode_snapshot_entries(entries):
+    # (key, value, expire_at) entries in the snapshot entry format, also the payload format of DUMP/RESTORE
+    pack = struct.pack
+    out = []
+    for key, value, expire_at in entries:
+        if expire_at is not None:
+            out.append(pack("<Bq", SNAPSHOT_OPCODE_EXPIRE_MS, int(expire_at * 1000)))
+        key_data = key.encode(ENCODING, ENCODING_ERRORS)
+        if isinstance(value, collections.deque):
+            out.append(pack("<BI", SNAPSHOT_TYPE_LIST, len(key_data)) + key_data + pack("<I", len(value)))
+            for item in value:
+                item_data = str(item).encode(ENCODING, ENCODING_ERRORS)
+                out.append(pack("<I", len(item_data)) + item_data)
+        elif isinstance(value, HashValue):
+            out.append(pack("<BI", SNAPSHOT_TYPE_HASH, len(key_data)) + key_data + pack("<I", len(value)))
+            for pair in value.items():
+                for item in pair:
+                    item_data = item.encode(ENCODING, ENCODING_ERRORS)
+                    out.append(pack("<I", len(item_data)) + item_data)
+        elif isinstance(value, SortedSetValue):
+            out.append(pack("<BI", SNAPSHOT_TYPE_ZSET, len(key_data)) + key_data + pack("<I", len(value)))
+            for member, score in value.scores.items():
+                member_data = member.encode(ENCODING, ENCODING_ERRORS)
+                out.append(pack("<I", len(member_data)) + member_data + pack("<d", score))
+        elif isinstance(value, int):
+            out.append(pack("<BI", SNAPSHOT_TYPE_INT, len(key_data)) + key_data + pack("<q", value))
+        else:
+            value_data = value.encode(ENCODING, ENCODING_ERRORS)
+            out.append(pack("<BI", SNAPSHOT_TYPE_STRING, len(key_data)) + key_data
+                       + pack("<I", len(value_data)) + value_data)
+    return b"".join(out)
+
+
+class SnapshotWriter:
+    # streams entries into a temp file and only renames it over the real snapshot once it is complete
+    def __init__(self, filename):
+        self.filename = filename
+        self.temp_filename = f"temp-{os.getpid()}-{threading.get_ident()}.crdb"
+        self.file = open(self.temp_filename, 'wb', buffering=1024 * 1024)
+        self.crc = 0
+        self.entries = 0
+        self.write(SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]))
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.file.write(data)
+
+    def write_entries(self, entries):
+        # encodes a whole batch of (key, value, expire_at) and writes it as one chunk
+        self.write(encode_snapshot_entries(entries))
+        self.entries += len(entries)
+
+    def close(self):
+        self.write(bytes([SNAPSHOT_OPCODE_EOF]))
+        self.file.write(struct.pack("<I", self.crc & 0xFFFFFFFF))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.temp_filename, self.filename)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.temp_filename):
+            os.remove(self.temp_filename)
+
+
+def decode_snapshot_entries(view, pos, end):
+    """Yield (key, value, expire_at) for the entries in view[pos:end], the inverse of encode_snapshot_entries."""
+    unpack_from = struct.unpack_from
+    while pos < end:
+        expire_at = None
+        tag = view[pos]
+        if tag == SNAPSHOT_OPCODE_EXPIRE_MS:
+            (expire_ms,) = unpack_from("<q", view, pos + 1)
+            expire_at = expire_ms / 1000
+            pos += 9
+            tag = view[pos]
+        (length,) = unpack_from("<I", view, pos + 1)
+        pos += 5
+        key = str(view[pos:pos + length], ENCODING, ENCODING_ERRORS)
+        pos += length
+        if tag == SNAPSHOT_TYPE_STRING:
+            (length,) = unpack_from("<I", view, pos)
+            value = str(view[pos + 4:pos + 4 + length], ENCODING, ENCODING_ERRORS)
+            pos += 4 + length
+        elif tag == SNAPSHOT_TYPE_INT:
+            (value,) = unpack_from("<q", view, pos)
+            pos += 8
+        elif tag == SNAPSHOT_TYPE_LIST:
+            (count,) = unpack_from("<I", view, pos)
+            pos += 4
+            value = collections.deque()
+            for _ in range(count):
+                (length,) = unpack_from("<I", view, pos)
+                value.append(str(view[pos + 4:pos + 4 + length], ENCODING, ENCODING_ERRORS))
+                pos += 4 + length
+        elif tag == SNAPSHOT_TYPE_HASH:
+            (count,) = unpack_from("<I", view, pos)
+            pos += 4
+            items = []
+            for _ in range(2 * count):
+                (length,) = unpack_from("<I", view, pos)
+                items.append(str(view[pos + 4:pos + 4 + length], ENCODING, ENCODING_ERRORS))
+                pos += 4 + length
+            value = HashValue(zip(items[::2], items[1::2]))
+        elif tag == SNAPSHOT_TYPE_ZSET:
+            (count,) = unpack_from("<I", view, pos)
+            pos += 4
+            scores = {}
+            for _ in range(count):
+                (length,) = unpack_from("<I", view, pos)
+                member = str(view[pos + 4:pos + 4 + length], ENCODING, ENCODING_ERRORS)
+                (scores[member],) = unpack_from("<d", view, pos + 4 + length)
+                pos += 12 + length
+            value = SortedSetValue(scores)
+        else:
+            raise SnapshotError(f"unknown type tag {tag}")
+        yield key, value, expire_at
+
+
+def read_snapshot(filename):
+    """Yield (key, value, expire_at) for every entry of a binary snapshot.
+
+    The file is mmapped and checked against its CRC trailer before anything is yielded,
+    a truncated or corrupted snapshot raises SnapshotError.
+    """
+    with open(filename, 'rb') as snapshot_file:
+        if os.fstat(snapshot_file.fileno()).st_size == 0:
+            raise SnapshotError("empty snapshot file")
+        with mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                header_size = len(SNAPSHOT_MAGIC) + 1
+                if bytes(view[:len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC:
+                    raise SnapshotError("not a crowRedis snapshot")
+                if view[len(SNAPSHOT_MAGIC)] != SNAPSHOT_VERSION:
+                    raise SnapshotError(f"unsupported snapshot version {view[len(SNAPSHOT_MAGIC)]}")
+                if len(view) < header_size + 5 or view[-5] != SNAPSHOT_OPCODE_EOF:
+                    raise SnapshotError("snapshot is truncated")
+                (stored_crc,) = struct.unpack_from("<I", view, len(view) - 4)
+                if zlib.crc32(view[:-4]) & 0xFFFFFFFF != stored_crc:
+                    raise SnapshotError("snapshot checksum mismatch")
+
+                yield from decode_snapshot_entries(view, header_size, len(view) - 5)
+            finally:
+                view.release()
+
+
+############# AOF writer, one open file, records are buffered and a background flusher group commits them #################
+
+class AofWriter:
+    FSYNC_POLICIES = ("always", "everysec", "no")
+
+    def __init__(self, filename, appendfsync="everysec", flush_interval=0.1):
+        if appendfsync not in self.FSYNC_POLICIES:
+            raise ValueError(f"appendfsync must be one of {', '.join(self.FSYNC_POLICIES)}")
+        self.filename = filename
+        self.appendfsync = appendfsync
+        self.flush_interval = flush_interval  # everysec/no: how long records may sit in the buffer
+        self.file = open(filename, 'ab')
+        self.size = self.base_size = self.file.tell()  # base_size = size right after open/rewrite, for auto rewrite
+        self.rewrite_buffer = None  # list while a BGREWRITEAOF is running
+        self.write_lock = threading.Lock()
+        self.buffer = []
+        self.buffer_size = 0
+        self.appended_seq = 0  # sequence number of the last record handed to append()
+        self.flushed_seq = 0  # every record up to this one is written (and fsynced if the policy says so)
+        self.last_fsync = time.time()
+        self.closed = False
+        self.condition = threading.Condition()
+        self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+
+    def append(self, record):
+        with self.condition:
+            self.buffer.append(record)
+            self.buffer_size += len(record)
+            self.appended_seq += 1
+            if self.rewrite_buffer is not None:
+                self.rewrite_buffer.append(record)
+            # 'always' writers are waiting on the disk, so wake the flusher now, others wait for the interval
+            if self.appendfsync == "always" or self.buffer_size >= 1024 * 1024:
+                self.condition.notify_all()
+            return self.appended_seq
+
+    def wait_for(self, seq):
+        # blocks until record seq is durable, every writer waiting at the same time shares one write+fsync
+        with self.condition:
+            while self.flushed_seq < seq and not self.closed:
+                self.condition.wait()
+
+    def flush_loop(self):
+        while True:
+            with self.condition:
+                if not self.buffer and not self.closed:
+                    timeout = None if self.appendfsync == "always" else self.flush_interval
+                    self.condition.wait(timeout)
+                if self.closed and not self.buffer:
+                    return
+                if not self.buffer:
+                    continue
+            # write_lock keeps a rewrite switchover from happening between taking the records and writing them
+            with self.write_lock:
+                with self.condition:
+                    records, self.buffer, self.buffer_size = self.buffer, [], 0
+                    seq = self.appended_seq
+                if records:
+                    self.write_records(records)
+                with self.condition:
+                    self.flushed_seq = max(self.flushed_seq, seq)
+                    self.condition.notify_all()
+
+    def write_records(self, records):
+        self.file.write(b"".join(records))
+        self.file.flush()
+        self.size = self.file.tell()
+        now = time.time()
+        if self.appendfsync == "always" or (self.appendfsync == "everysec" and now - self.last_fsync >= 1):
+            os.fsync(self.file.fileno())
+            self.last_fsync = now
+
+    def start_rewrite(self):
+        # from here on every record is also kept for the rewritten file
+        with self.condition:
+            self.rewrite_buffer = []
+
+    def finish_rewrite(self, temp_filename):
+        # everything appended while the rewrite ran goes after the rewritten base, then the new file replaces the old one
+        with self.write_lock:
+            with self.condition:
+                with open(temp_filename, 'ab') as temp_file:
+                    temp_file.write(b"".join(self.rewrite_buffer))
+                    temp_file.flush()
+                    os.fsync(temp_file.fileno())
+                os.replace(temp_filename, self.filename)
+                self.file.close()
+                self.file = open(self.filename, 'ab')
+                self.size = self.base_size = self.file.tell()
+                # the records still waiting in the buffer were part of rewrite_buffer, they are on disk now
+                self.buffer, self.buffer_size = [], 0
+                self.flushed_seq = self.appended_seq
+                self.rewrite_buffer = None
+                self.condition.notify_all()
+
+    def abort_rewrite(self):
+        with self.condition:
+            self.rewrite_buffer = None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.flusher.join()
+        if self.appendfsync != "no":
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+
+############# replication, replicas get a snapshot once and then the same records the AOF gets ############################
+#
+#   replica -> primary:  REPLCONF listening-port <port>, PSYNC <replid> <offset>   (PSYNC ? -1 the first time)
+#   primary -> replica:  +FULLRESYNC <replid> <offset>, $<len> snapshot file, $<len> FUNCTION LOAD records, then the stream
+#                   or:  +CONTINUE <replid>, then the stream from the replica's offset on, straight out of the backlog
+#   replica -> primary:  REPLCONF ACK <offset> once a second
+#
+# an offset counts bytes of the write stream, it is how much of it a server has produced (primary) or applied (replica)
+
+class ReplicationBacklog:
+    # the newest bytes of the write stream in a fixed size ring, a replica that reconnects and only missed
+    # what is still in here gets just that instead of a whole new snapshot
+    def __init__(self, size):
+        self.buffer = bytearray(size)
+        self.size = size
+        self.pos = 0  # where the next byte goes
+        self.length = 0  # how many bytes of history the ring holds, at most size
+
+    def append(self, data):
+        count = len(data)
+        if count >= self.size:
+            self.buffer[:] = data[count - self.size:]
+            self.pos, self.length = 0, self.size
+            return
+        first = min(count, self.size - self.pos)
+        self.buffer[self.pos:self.pos + first] = data[:first]
+        self.buffer[:count - first] = data[first:]
+        self.pos = (self.pos + count) % self.size
+        self.length = min(self.length + count, self.size)
+
+    def tail(self, count):
+        # the last count bytes, caller checked count <= length
+        start = (self.pos - count) % self.size
+        if start + count <= self.size:
+            return bytes(self.buffer[start:start + count])
+        return bytes(self.buffer[start:]) + bytes(self.buffer[:self.pos])
+
+
+class ReplicaLink:
+    # the primary's end of one replica, writers append the stream to buffer and the link's thread sends it
+    def __init__(self, client, replid, offset):
+        self.client = client
+        self.replid = replid  # what the replica asked for in PSYNC
+        self.offset = offset
+        self.buffer = bytearray()  # guarded by the server's repl_lock
+        self.closed = False
+        self.ack_offset = 0
+        self.selector = selectors.DefaultSelector()  # only to see if an ACK arrived without blocking the sends
+        self.selector.register(client.socket, selectors.EVENT_READ)
+
+    def close(self):
+        # from any thread, a send the link's thread is stuck in fails right away
+        self.closed = True
+        try:
+            self.client.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class ServerConnection:
+    # an outgoing connection to another crowRedis server (a replica's master, a cluster node), the socket plus
+    # whatever was received and not used yet
+    def __init__(self, sock):
+        self.socket = sock
+        self.buffer = bytearray()
+
+    @classmethod
+    def connect(cls, host, port, timeout=5):
+        return cls(socket.create_connection((host, port), timeout=timeout))
+
+    def call(self, *parts):
+        self.socket.sendall(encode_command(parts))
+        return self.read_reply()
+
+    def read_reply(self):
+        # one RESP reply, errors come back as CommandError instead of being raised
+        line = self.read_line()
+        kind, rest = line[:1], line[1:]
+        if kind == "+":
+            return SimpleString(rest)
+        if kind == "-":
+            return CommandError(rest)
+        if kind == ":":
+            return int(rest)
+        if kind == "$":
+            if int(rest) < 0:
+                return None
+            return self.read_exact(int(rest) + 2)[:-2].decode(ENCODING, ENCODING_ERRORS)
+        if kind == "*":
+            return None if int(rest) < 0 else [self.read_reply() for _ in range(int(rest))]
+        raise ProtocolError(f"unexpected reply '{line[:32]}'")
+
+    def close(self):
+        self.socket.close()
+
+    def fill(self):
+        data = self.socket.recv(65536)
+        if not data:
+            raise ConnectionError("connection closed by the server")
+        self.buffer += data
+
+    def read_line(self):
+        end = self.buffer.find(b"\r\n")
+        while end == -1:
+            self.fill()
+            end = self.buffer.find(b"\r\n")
+        line = bytes(self.buffer[:end]).decode(ENCODING, ENCODING_ERRORS)
+        del self.buffer[:end + 2]
+        return line
+
+    def read_bulk(self, out=None):
+        # a $<len> payload, into out (a file) when given, the snapshot can be bigger than we want in memory
+        line = self.read_line()
+        if not line.startswith("$"):
+            raise ProtocolError(f"expected a bulk payload, got '{line[:32]}'")
+        return self.read_exact(int(line[1:]), out)
+
+    def read_exact(self, left, out=None):
+        chunks = []
+        while left:
+            if not self.buffer:
+                self.fill()
+            chunk = bytes(self.buffer[:left])
+            del self.buffer[:len(chunk)]
+            left -= len(chunk)
+            if out is not None:
+                out.write(chunk)
+            else:
+                chunks.append(chunk)
+        return b"".join(chunks)
+
+
+############# cluster, keys map to 16384 hash slots and every slot belongs to one node (one crowRedis process) ############
+
+CLUSTER_SLOTS = 16384
+
+
+def key_hash_slot(key):
+    # CRC16 (XMODEM, the one redis uses, binascii has it in C) of the key, or of its {hash tag} so related keys
+    # can be put in one slot on purpose
+    start = key.find("{")
+    if start != -1:
+        end = key.find("}", start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return binascii.crc_hqx(key.encode(ENCODING, ENCODING_ERRORS), 0) & (CLUSTER_SLOTS - 1)
+
+
+def slot_ranges(slots):
+    # sorted slot numbers -> [(first, last), ...]
+    ranges = []
+    for slot in slots:
+        if ranges and ranges[-1][1] == slot - 1:
+            ranges[-1][1] = slot
+        else:
+            ranges.append([slot, slot])
+    return [tuple(item) for item in ranges]
+
+
+class ClusterNode:
+    # what one node knows about another (or itself), the slots live in the server's slot table
+    def __init__(self, node_id, host, port, config_epoch=0):
+        self.id = node_id
+        self.host = host
+        self.port = port
+        self.config_epoch = config_epoch  # the newest epoch wins when two nodes claim the same slot
+        self.connected = True  # did the last poll of this node work
+        self.pong_received = 0  # unix ms of the last successful poll
+
+    def address(self):
+        return f"{self.host}:{self.port}"
+
+
+class ClientConnection:
+    # Per socket state, the read buffer for request framing and the reply buffer that
+    # gets flushed once per batch of pipelined commands
+    def __init__(self, sock, address):
+        self.socket = sock
+        self.address = address
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.pending = collections.deque()  # parsed commands waiting to run, in arrival order
+        self.resp = False  # replies follow the protocol of the request being answered
+        self.wants_write = False
+        self.blocked = None  # the BlockedClient while this connection waits in BLPOP & co (event loop mode)
+        self.multi = None  # commands queued since MULTI, None outside of a transaction
+        self.multi_error = False  # a command could not be queued, EXEC discards the transaction
+        self.watched = {}  # key -> its version at WATCH time
+        self.in_exec = False  # blocking commands return right away inside EXEC
+        self.channels = set()  # SUBSCRIBE
+        self.patterns = set()  # PSUBSCRIBE
+        # threaded mode, a publisher pokes push_wakeup after queueing a message so the subscriber's thread sends it
+        self.push_wakeup = None
+        self.push_wakeup_reader = None
+        self.push_selector = None
+        self.push_pending = False
+        self.replica = None  # ReplicaLink once this connection sent PSYNC, from then on it only carries the stream
+        self.asking = False  # cluster mode, ASKING lets the next command use a slot this node is importing
+        self.listening_port = None  # REPLCONF listening-port, what ROLE shows for a replica
+
+    def feed(self, data):
+        self.inbuf += data
+        commands, consumed = parse_commands(self.inbuf)
+        if consumed:
+            del self.inbuf[:consumed]
+        self.pending.extend(commands)
+
+    def reply(self, value):
+        self.outbuf += encode_reply(value, self.resp)
+
+    def push(self, data):
+        # an already encoded pub/sub message, called from the publisher's thread
+        self.outbuf += data
+        if self.push_wakeup is not None and not self.push_pending:
+            self.push_pending = True
+            try:
+                self.push_wakeup.send(b"\0")
+            except OSError:
+                pass
+
+    def fileno(self):
+        return self.socket.fileno()
+
+
+BLOCKED = object()  # handler result meaning the client is parked, its reply comes when it is woken up
+
+
+class BlockedClient:
+    # a client parked by BLPOP/BRPOP/BLMOVE until one of its keys gets an element or the timeout runs out
+    def __init__(self, client, keys, left, destination=None, to_left=True, deadline=None):
+        self.client = client
+        self.keys = keys
+        self.left = left  # pop from the head or the tail
+        self.destination = destination  # BLMOVE pushes the element here instead of returning [key, value]
+        self.to_left = to_left
+        self.deadline = deadline  # absolute time, None = wait forever
+        self.done = False
+        self.result = None
+        self.event = threading.Event()  # threaded mode, the handler thread sleeps on this
+
 
 class RedisServer:
-    def __init__(self, host, port):
+    def __init__(self, host, port, shard_count=16, appendfsync="everysec"):
         self.host = host
         self.port = port
-        self.data = {}  # Data store for key-value pairs
-        self.lock = threading.Lock()
+        self.data = Keyspace(shard_count)  # Data store for key-value pairs, split in lock striped shards
+        self.mode = "threaded"
         self.snapshot_interval = 60  # Snapshot interval in seconds
         self.last_snapshot_time = time.time()
         self.aof_filename = 'redis_aof.log'
-        self.load_aof()
-        self.in_transaction = False
-        self.transaction_commands = []
+        self.snapshot_filename = 'dump.crdb'
+        self.dirty = 0  # writes since the last successful snapshot
+        self.last_save_time = time.time()  # LASTSAVE
+        self.bgsave_use_fork = hasattr(os, 'fork')
+        self.bgsave_lock = threading.Lock()
+        self.bgsave_in_progress = False
+        self.bgsave_started_at = None
+        self.bgsave_keys_total = 0
+        self.bgsave_keys_written = 0
+        self.last_bgsave_status = "ok"
+        self.aof_loaded = False
         self.aof_enabled = False
-        self.current_transaction = []
-        self.ttl_check_interval = 1  # TTL check interval in seconds
-        self.ttl_data = {} 
+        self.appendfsync = appendfsync
+        self.aof_writer = None
+        self.aof_seq = threading.local()  # last AOF record each thread wrote, for appendfsync always
+        self.aof_rewrite_lock = threading.Lock()
+        self.aof_rewrite_in_progress = False
+        self.aof_rewrite_percentage = 100  # auto rewrite once the AOF doubled since the last rewrite...
+        self.aof_rewrite_min_size = 64 * 1024 * 1024  # ...and is at least this big
+        self.ttl_check_interval = 0.1  # upper bound on how long a due key waits for the expiry cycle
+        self.expire_batch_size = 1000  # max keys one expiry cycle removes, so a mass expiry can not stall clients
+        self.ttl_data = {}  # key -> absolute expire time, the source of truth for TTLs
+        self.expiry_heap = []  # (expire_at, key), may hold stale entries for keys whose TTL changed
+        self.expiry_lock = threading.Lock()
+        # guards the four below, always taken after any shard lock. reentrant because a BLMOVE
+        # hand off signals its destination while the waiter queues are held
+        self.blocked_lock = threading.RLock()
+        self.blocked_keys = {}  # key -> deque of BlockedClient, first come first served
+        self.ready_keys = set()  # keys that got pushed to while someone was blocked on them
+        self.unblocked_clients = collections.deque()  # event loop mode, woken clients with pending commands to resume
+        self.blocked_timeouts = []  # event loop mode, heap of (deadline, id, BlockedClient)
+        self.lazyfree_queue = queue.SimpleQueue()  # values UNLINK removed, freed off the client path
+        self.lazyfree_thread = None
+        self.maxmemory = 0  # bytes, 0 = no limit
+        self.maxmemory_policy = "noeviction"
+        self.maxmemory_samples = 5  # keys sampled per eviction round, more = closer to true LRU/LFU but slower
+        self.shard_memory = [0] * shard_count  # approximate bytes per shard, only kept while maxmemory is set
+        self.eviction_pool = []  # (score, key) best eviction candidates seen so far, best last
+        self.eviction_pool_size = 16
+        self.eviction_lock = threading.Lock()
+        self.functions = {}  # name -> ServerFunction, FUNCTION LOAD / FCALL
+        self.pubsub_lock = threading.Lock()  # (un)subscribes, PUBLISH reads the indexes without it
+        self.pubsub_channels = {}  # channel -> tuple of subscribed clients, replaced on every change
+        self.pubsub_patterns = PatternTrie()
+        self.pubsub_output_limit = 32 * 1024 * 1024  # a subscriber with more unsent messages is disconnected
+        # key -> [version, clients watching it], only for WATCHed keys. both only change under the key's shard lock
+        self.watched_keys = {}
+        self.replid = os.urandom(20).hex()  # names this server's write stream, a PSYNC for another one is a full sync
+        self.master_repl_offset = 0  # bytes of the stream produced (primary) or applied (replica)
+        self.repl_backlog = None  # ReplicationBacklog, made when the first replica connects
+        self.repl_backlog_size = 1024 * 1024
+        self.repl_lock = threading.Lock()  # guards the backlog, the offset and every link's buffer, taken after shard locks
+        self.repl_condition = threading.Condition(self.repl_lock)  # link threads wait here for more stream
+        self.replicas = []  # ReplicaLink of every attached replica
+        self.repl_output_limit = 256 * 1024 * 1024  # a replica with more unsent stream is disconnected
+        self.master_host = None  # set = this server is a read only replica of master_host:master_port
+        self.master_port = None
+        self.master_replid = None  # the stream this replica follows, None = the next sync is a full one
+        self.master_link_status = "connect"
+        self.master_socket = None
+        self.replication_epoch = 0  # bumped by REPLICAOF, the sync thread of an older epoch stops
+        self.cluster_enabled = False
+        self.cluster_config_file = 'nodes.conf'
+        self.cluster_lock = threading.Lock()  # changes to the nodes, the slot table and the epochs
+        self.myself = None  # this node's ClusterNode
+        self.cluster_nodes = {}  # node id -> ClusterNode, myself included
+        self.slots = [None] * CLUSTER_SLOTS  # slot -> the ClusterNode serving it, read without the lock
+        self.migrating_slots = {}  # slot -> ClusterNode it is moving to, while this node still owns it
+        self.importing_slots = {}  # slot -> ClusterNode it is coming from, ASKING clients may use it already
+        self.current_epoch = 0  # highest config epoch seen anywhere in the cluster
+        self.cluster_meets = set()  # (host, port) of CLUSTER MEETs the cluster thread has not done yet
+        self.cluster_poll_interval = 1  # seconds between two rounds of asking every node for its view
+        self.start_time = time.time()
+        self.clients = set()  # ClientConnection of every connected client, replicas leave it once they PSYNC
+        self.metrics_server = None  # the HTTP server of --metrics-port
+        self.reset_stats()
+
+        # The AOF has every write, so when there is one it alone rebuilds the data, replaying it on
+        # top of a snapshot would apply list pushes twice. Without an AOF the snapshot is loaded.
+        if os.path.exists(self.aof_filename) and os.path.getsize(self.aof_filename) > 0:
+            self.load_aof()
+        else:
+            self.load_snapshot()
+        self.reset_stats()  # what the AOF replay ran is not what clients asked for
+
+    def reset_stats(self):
+        # the INFO stats and commandstats counters
+        for spec in COMMANDS.values():
+            spec.reset_stats()
+        self.keyspace_hits = 0
+        self.keyspace_misses = 0
+        self.expired_keys = 0
+        self.evicted_keys = 0
+        self.total_connections_received = 0
+        self.net_input_bytes = 0
+        self.net_output_bytes = 0
+
+    def start(self, mode="threaded"):
+        self.mode = mode
+        if mode == "eventloop":
+            self.start_event_loop()
+            return
+
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server_socket.bind((self.host, self.port))
+            server_socket.listen(socket.SOMAXCONN)
+
+            print(f"Server listening on {self.host}:{self.port}")
+
+            # one expiry thread for the whole server, not one per connection
+            self.ttl_thread = threading.Thread(target=self.check_ttl, daemon=True)
+            self.ttl_thread.start()
+
+            while True:
+                try:
+                    client_socket, client_address = server_socket.accept()
+                    print(f"Accepted connection from {client_address[0]}:{client_address[1]}")
+                    self.total_connections_received += 1
+                    threading.Thread(target=self.handle_client, args=(client_socket, client_address), daemon=True).start()
+                except Exception as e:
+                    print(f"Error accepting client connection: {e}")
+
+    def handle_client(self, client_socket, client_address=None):
+        client = ClientConnection(client_socket, client_address)
+        self.clients.add(client)
+        try:
+            while True:
+                if client.channels or client.patterns:
+                    request = self.wait_as_subscriber(client)
+                else:
+                    request = client_socket.recv(65536)
+                if not request:
+                    break
+                self.net_input_bytes += len(request)
+
+                try:
+                    client.feed(request)
+                except ProtocolError as e:
+                    client.reply(CommandError(f"Protocol error: {e}"))
+                    client_socket.sendall(client.outbuf)
+                    break
+
+                self.run_pending(client)
+                # every reply of the pipelined batch goes out in one write
+                self.send_replies(client)
+                if client.replica is not None:
+                    self.clients.discard(client)
+                    self.serve_replica(client.replica)  # PSYNC, this thread sends the write stream from now on
+                    break
+        except Exception as e:
+            print(f"Error handling client: {e}")
+        finally:
+            self.clients.discard(client)
+            self.unwatch(client)
+            self.unsubscribe_all(client)
+            client_socket.close()
+
+    def server_cron(self):
+        # Check if it's time to create a snapshot, only when something changed since the last one
+        if time.time() - self.last_snapshot_time >= self.snapshot_interval and self.dirty > 0:
+            self.last_snapshot_time = time.time()
+            self.start_bgsave()
+        self.check_aof_rewrite()
+
+    def run_pending(self, client):
+        # a blocked client keeps the rest of its pipeline queued until it is woken up
+        while client.pending and client.blocked is None:
+            parts, client.resp = client.pending.popleft()
+            reply = self.dispatch_command(client, parts)
+            if reply is not BLOCKED:
+                client.reply(reply)
+            if self.ready_keys:
+                self.serve_blocked_clients()
+
+    def send_replies(self, client):
+        # threaded mode, replies for writes only leave once the AOF policy says they are safe
+        if client.outbuf:
+            self.wait_for_aof()
+            # a copy, publishers may append to a subscriber's buffer while this thread sends it
+            data = bytes(client.outbuf)
+            client.socket.sendall(data)
+            del client.outbuf[:len(data)]
+            self.net_output_bytes += len(data)
+
+############# single threaded event loop mode, one selector for every client socket, no thread per connection ##############
+
+    def start_event_loop(self):
+        self.selector = selectors.DefaultSelector()
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((self.host, self.port))
+        server_socket.listen(socket.SOMAXCONN)
+        server_socket.setblocking(False)
+        self.selector.register(server_socket, selectors.EVENT_READ, None)
+
+        print(f"Server listening on {self.host}:{self.port} (event loop mode)")
+
+        next_ttl_check = time.time() + self.next_expiry_in()
+        self.clients_with_replies = []
+        try:
+            while True:
+                wake_at = next_ttl_check
+                if self.blocked_timeouts:
+                    wake_at = min(wake_at, self.blocked_timeouts[0][0])
+                timeout = max(0, wake_at - time.time())
+                for key, events in self.selector.select(timeout):
+                    if key.data is None:
+                        self.accept_connection(server_socket)
+                        continue
+                    client = key.data
+                    if events & selectors.EVENT_READ:
+                        self.read_from_client(client)
+                    if events & selectors.EVENT_WRITE and client.socket.fileno() != -1:
+                        self.write_to_client(client)
+
+                self.expire_blocked_clients()
+                # clients a push (or a timeout) woke up answer now and carry on with their pipeline
+                while self.unblocked_clients:
+                    client = self.unblocked_clients.popleft()
+                    if client.socket.fileno() == -1:
+                        continue
+                    self.run_pending(client)
+                    if client.outbuf:
+                        self.clients_with_replies.append(client)
+
+                # one AOF group commit for everything this round wrote, then the replies go out
+                if self.clients_with_replies:
+                    self.wait_for_aof()
+                    for client in self.clients_with_replies:
+                        if client.socket.fileno() != -1:
+                            self.write_to_client(client)
+                    self.clients_with_replies = []
+
+                # the only background task in this mode, expiry runs between client events
+                if time.time() >= next_ttl_check:
+                    more_due = self.remove_expired_keys()
+                    self.server_cron()
+                    # more due keys left means come straight back after serving the ready clients
+                    next_ttl_check = time.time() + (0 if more_due else self.next_expiry_in())
+        finally:
+            self.selector.close()
+            server_socket.close()
+
+    def accept_connection(self, server_socket):
+        try:
+            client_socket, client_address = server_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            print(f"Error accepting client connection: {e}")
+            return
+        client_socket.setblocking(False)
+        client = ClientConnection(client_socket, client_address)
+        self.selector.register(client_socket, selectors.EVENT_READ, client)
+        self.clients.add(client)
+        self.total_connections_received += 1
+
+    def read_from_client(self, client):
+        try:
+            request = client.socket.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            request = b""
+        if not request:
+            self.close_client(client)
+            return
+        self.net_input_bytes += len(request)
+
+        try:
+            client.feed(request)
+            self.run_pending(client)
+            if client.replica is not None:
+                # PSYNC, the replica gets its own thread and leaves the event loop for good
+                self.selector.unregister(client.socket)
+                self.clients.discard(client)
+                client.socket.setblocking(True)
+                threading.Thread(target=self.serve_replica, args=(client.replica,), daemon=True).start()
+                return
+        except ProtocolError as e:
+            client.reply(CommandError(f"Protocol error: {e}"))
+            self.write_to_client(client)
+            self.close_client(client)
+            return
+        except Exception as e:
+            print(f"Error handling client: {e}")
+            self.close_client(client)
+            return
+        if client.outbuf:
+            self.clients_with_replies.append(client)
+
+    def write_to_client(self, client):
+        if client.outbuf:
+            try:
+                sent = client.socket.send(client.outbuf)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.close_client(client)
+                return
+            del client.outbuf[:sent]
+            self.net_output_bytes += sent
+
+        # only ask for write events while there is something left to flush
+        wants_write = bool(client.outbuf)
+        if wants_write != client.wants_write:
+            client.wants_write = wants_write
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if wants_write else 0)
+            self.selector.modify(client.socket, events, client)
+
+    def close_client(self, client):
+        try:
+            self.selector.unregister(client.socket)
+        except (KeyError, ValueError):
+            pass
+        if client.blocked is not None:
+            with self.blocked_lock:
+                self.unblock(client.blocked)
+            client.blocked = None
+        self.clients.discard(client)
+        self.unwatch(client)
+        self.unsubscribe_all(client)
+        client.socket.close()
+
+##############################################################################################################################
+
+    def dispatch_command(self, client, parts):
+        spec = COMMANDS.get(parts[0].upper())
+        if spec is None or not spec.arity_ok(len(parts)):
+            if client is not None and client.multi is not None:
+                client.multi_error = True  # EXEC refuses a transaction that lost a command
+            if spec is None:
+                return CommandError("Invalid command")
+            spec.rejected_calls += 1
+            return CommandError(f"Invalid {spec.name} command")
+        keys = spec.keys(parts)
+        if client is not None:
+            if (self.master_host is not None and "write" in spec.flags
+                    and (spec.name != "FUNCTION" or parts[1].upper() != "LIST")):
+                # only the master's stream (client None) writes to a replica, FUNCTION LIST is the one read
+                if client.multi is not None:
+                    client.multi_error = True
+                spec.rejected_calls += 1
+                return CommandError("READONLY You can't write against a read only replica.")
+            if self.cluster_enabled:
+                redirect = self.cluster_redirect(client, spec, keys)
+                if redirect is not None:
+                    if client.multi is not None:
+                        client.multi_error = True
+                    spec.rejected_calls += 1
+                    return redirect
+            if client.multi is not None and spec.name not in ("EXEC", "DISCARD", "MULTI", "WATCH"):
+                client.multi.append(parts)
+                return SimpleString("QUEUED")
+            if (client.channels or client.patterns) and spec.name not in SUBSCRIBED_COMMANDS:
+                spec.rejected_calls += 1
+                return CommandError(f"ERROR: Can't execute '{spec.name.lower()}': only (P)SUBSCRIBE / "
+                                    "(P)UNSUBSCRIBE / PING are allowed in this context")
+        if self.ttl_data:
+            for key in keys:
+                self.expire_if_needed(key)
+        if self.maxmemory:
+            if ("denyoom" in spec.flags and client is not None and self.used_memory() > self.maxmemory
+                    and not self.evict_until_fits()):
+                spec.rejected_calls += 1
+                return CommandError("OOM command not allowed when used memory > 'maxmemory'.")
+            if self.data.access_clock is not None:
+                for key in keys:
+                    self.data.touch(key)
+        if spec.readonly:
+            # what redis counts on every read lookup, a key that exists is a hit
+            for key in keys:
+                if key in self.data:
+                    self.keyspace_hits += 1
+                else:
+                    self.keyspace_misses += 1
+        started = time.perf_counter_ns()
+        try:
+            if (self.migrating_slots and client is not None and keys and "blocking" not in spec.flags
+                    and key_hash_slot(keys[0]) in self.migrating_slots):
+                reply = self.call_migrating(spec, client, parts, keys)
+            elif keys and "write" in spec.flags and "blocking" not in spec.flags:
+                # blocking pops do their own accounting and WATCH signalling, they must not hold locks while they wait
+                reply = self.call_write(spec, client, parts, keys)
+            else:
+                reply = spec.handler(self, client, parts)
+        except CommandError as e:
+            reply = e
+        spec.calls += 1
+        spec.nanoseconds += time.perf_counter_ns() - started
+        if isinstance(reply, CommandError):
+            spec.failed_calls += 1
+        return reply
+
+    def call_write(self, spec, client, parts, keys):
+        # the dispatcher holds the shard locks around a write (they are reentrant, the handler takes them again),
+        # so the used memory and the WATCH versions move together with the write, nobody sees one without the other
+        if len(keys) > 1:
+            with self.data.locked(keys), self.memory_accounting(keys):
+                try:
+                    return spec.handler(self, client, parts)
+                finally:
+                    if self.watched_keys:
+                        for key in keys:
+                            self.signal_modified_key(key)
+        # the common single key write, same thing without the context manager overhead
+        key = keys[0]
+        index = self.data.shard_index(key)
+        with self.data.locks[index]:
+            shard = self.data.shards[index]
+            before = estimate_size(key, shard.get(key)) if self.maxmemory else 0
+            try:
+                return spec.handler(self, client, parts)
+            finally:
+                if self.maxmemory:
+                    self.shard_memory[index] += estimate_size(key, shard.get(key)) - before
+                if self.watched_keys:
+                    self.signal_modified_key(key)
+
+    def call_migrating(self, spec, client, parts, keys):
+        # a key of a slot that is moving to another node. the ASK check is done again under the keys' shard locks and
+        # they stay held until the command is done, MIGRATE moves keys under the same locks, so a command never
+        # runs against a key that left in between (and a write never brings one back)
+        with self.data.locked(keys):
+            redirect = self.cluster_redirect(client, spec, keys)
+            if redirect is not None:
+                return redirect
+            if "write" in spec.flags:
+                return self.call_write(spec, client, parts, keys)
+            return spec.handler(self, client, parts)
+
+    @command("COMMAND", -1, "loading stale", 0, 0, 0)
+    def handle_command_info(self, client, parts):
+        if len(parts) == 1:
+            return [spec.info() for spec in COMMANDS.values()]
+        subcommand = parts[1].upper()
+        if subcommand == "COUNT":
+            return len(COMMANDS)
+        if subcommand == "INFO":
+            return [COMMANDS[name.upper()].info() if name.upper() in COMMANDS else None for name in parts[2:]]
+        if subcommand == "DOCS":
+            return []  # redis-cli asks for this on startup, we have no docs to give
+        return CommandError("Invalid COMMAND command")
+
+    @command("PING", -1, "fast stale", 0, 0, 0)
+    def handle_ping(self, client, parts):
+        if client is not None and (client.channels or client.patterns):
+            return ["pong", parts[1] if len(parts) == 2 else ""]  # subscribed connections get it as a push
+        if len(parts) == 1:
+            return SimpleString("PONG")
+        elif len(parts) == 2:
+            return parts[1]
+        return CommandError("Invalid PING command")
+
+############# basic stuff to set,get, delete data from RAM, bit simlistic for now , TTL support added.  #############################
+
+    def parse_set(self, client, parts):
+        # SET key value [EX seconds|PX ms|EXAT unix-seconds|PXAT unix-ms] [NX|XX], returns
+        # (key, value, expire_at, condition). RESP requests have the value in one part and unknown options are a
+        # syntax error, inline clients send a value with spaces as several words so those words are the value
+        key = parts[1]
+        inline = client is not None and not client.resp
+        value_parts = [parts[2]]
+        expire_at = None
+        condition = None
+        i = 3
+
+        while i < len(parts):
+            option = parts[i].upper()
+            if option in ("EX", "PX", "EXAT", "PXAT") and i + 1 < len(parts) and expire_at is None:
+                try:
+                    amount = int(parts[i + 1])
+                except ValueError:
+                    raise CommandError("Invalid TTL value")
+                if option == "EX":
+                    expire_at = time.time() + amount
+                elif option == "PX":
+                    expire_at = time.time() + amount / 1000
+                elif option == "EXAT":
+                    expire_at = amount
+                else:
+                    expire_at = amount / 1000
+                i += 2  # Skip both the option and its TTL
+            elif option in ("NX", "XX") and condition is None:
+                condition = option
+                i += 1
+            elif inline:
+                value_parts.append(parts[i])
+                i += 1
+            else:
+                raise CommandError("ERROR: syntax error")
+        return key, ' '.join(value_parts), expire_at, condition
+
+    @command("SET", -3, "write denyoom")
+    def handle_set(self, client, parts):
+        key, value, expire_at, condition = self.parse_set(client, parts)
+
+        with self.data.lock_for(key):
+            if condition is not None and (key in self.data) != (condition == "XX"):
+                return None  # NX on a key that exists, XX on one that doesn't, nothing is set
+            self.data[key] = int_encoded(value)
+            if expire_at is not None:
+                self.set_expiry(key, expire_at)
+                # absolute time in the log, so a replay much later does not give the key a fresh TTL
+                self.append_to_aof(["SET", key, value, "PXAT", str(int(expire_at * 1000))])
+            else:
+                self.clear_expiry(key)  # Remove any existing TTL for this key
+                self.append_to_aof(["SET", key, value])
+        return SimpleString("OK")
+
+    @command("GET", 2, "readonly fast")
+    def handle_get(self, client, parts):
+        key = parts[1]
+        with self.data.lock_for(key):
+            value = self.data.get(key)
+        if not isinstance(value, (str, int)) and value is not None:
+            return CommandError(WRONGTYPE_ERROR)
+        if isinstance(value, int):
+            return str(value)  # int encoded, still a bulk string for the client
+        return value
+
+    def delete_keys(self, keys, command_name):
+        # the whole batch under one lock round, logged as one record of the keys that really existed.
+        # returns the removed values
+        deleted = []
+        removed = []
+        with self.data.locked(keys):
+            for key in keys:
+                if key in self.data:
+                    removed.append(self.data.pop(key))
+                    self.clear_expiry(key)
+                    deleted.append(key)
+            if deleted:
+                self.append_to_aof([command_name] + deleted)
+        return removed
+
+    @command("DEL", -2, "write", 1, -1, 1)
+    def handle_del(self, client, parts):
+        return len(self.delete_keys(parts[1:], "DEL"))
+
+    @command("UNLINK", -2, "write fast", 1, -1, 1)
+    def handle_unlink(self, client, parts):
+        removed = self.delete_keys(parts[1:], "UNLINK")
+        # big values are dropped by the lazyfree thread, freeing a million element list is not the client's problem
+        big = [value for value in removed if isinstance(value, collections.deque) and len(value) > 64]
+        if big:
+            self.lazy_free(big)
+        return len(removed)
+
+    def lazy_free(self, values):
+        if self.lazyfree_thread is None:
+            self.lazyfree_thread = threading.Thread(target=self.lazyfree_loop, daemon=True)
+            self.lazyfree_thread.start()
+        self.lazyfree_queue.put(values)
+
+    def lazyfree_loop(self):
+        while True:
+            values = self.lazyfree_queue.get()
+            values.clear()  # the last references go away here
+
+    @command("EXISTS", -2, "readonly fast", 1, -1, 1)
+    def handle_exists(self, client, parts):
+        keys = parts[1:]
+        with self.data.locked(keys):
+            return sum(1 for key in keys if key in self.data)  # like redis, a key given twice counts twice
+
+    @command("MGET", -2, "readonly fast", 1, -1, 1)
+    def handle_mget(self, client, parts):
+        keys = parts[1:]
+        with self.data.locked(keys):
+            values = [self.data.get(key) for key in keys]
+        # lists and hashes are not strings, MGET answers nil for them instead of an error
+        return [str(value) if isinstance(value, int) else value if isinstance(value, str) else None
+                for value in values]
+
+    def parse_pairs(self, parts, start=1):
+        if (len(parts) - start) % 2:
+            raise CommandError(f"Invalid {parts[0].upper()} command")
+        return list(zip(parts[start::2], parts[start + 1::2]))
+
+    def set_pairs(self, pairs):
+        # caller holds the shard locks, plain SET semantics so any old TTL goes away
+        for key, value in pairs:
+            self.data[key] = int_encoded(value)
+            self.clear_expiry(key)
+
+    @command("MSET", -3, "write denyoom", 1, -1, 2)
+    def handle_mset(self, client, parts):
+        pairs = self.parse_pairs(parts)
+        with self.data.locked([key for key, _ in pairs]):
+            self.set_pairs(pairs)
+            self.append_to_aof(parts)
+        return SimpleString("OK")
+
+    @command("MSETNX", -3, "write denyoom", 1, -1, 2)
+    def handle_msetnx(self, client, parts):
+        pairs = self.parse_pairs(parts)
+        keys = [key for key, _ in pairs]
+        with self.data.locked(keys):
+            if any(key in self.data for key in keys):
+                return 0  # all or nothing
+            self.set_pairs(pairs)
+            self.append_to_aof(parts)
+        return 1
+
+    @command("TYPE", 2, "readonly fast")
+    def handle_type(self, client, parts):
+        key = parts[1]
+        with self.data.lock_for(key):
+            return SimpleString(value_type(self.data.get(key)))
+
+    ##################### keyspace iteration, SCAN walks a few hash buckets per call, KEYS is the same walk in one go
+
+    @command("SCAN", -2, "readonly", 0, 0, 0)
+    def handle_scan(self, client, parts):
+        # SCAN cursor [MATCH pattern] [COUNT count] [TYPE type]
+        cursor, match, count, type_filter = self.parse_scan_args(parts, 1, with_type=True)
+        cursor, keys = self.data.scan(cursor, count)
+        return [str(cursor), self.filter_scanned(keys, match, type_filter)]
+
+    @command("KEYS", 2, "readonly", 0, 0, 0)
+    def handle_keys(self, client, parts):
+        # still only one shard lock at a time for one bucket, but the reply is the whole keyspace.
+        # jobs that walk big keyspaces should use SCAN
+        cursor, found = 0, []
+        while True:
+            cursor, keys = self.data.scan(cursor, 1000)
+            found.extend(self.filter_scanned(keys, parts[1], None))
+            if cursor == 0:
+                return found
+
+    def filter_scanned(self, keys, match, type_filter):
+        # expired keys that were not removed yet are skipped like lazy expiry would
+        now = time.time()
+        found = []
+        for key in keys:
+            if match is not None and not fnmatch.fnmatchcase(key, match):
+                continue
+            expire_at = self.ttl_data.get(key)
+            if expire_at is not None and expire_at <= now:
+                continue
+            if type_filter is not None and value_type(self.data.get(key)) != type_filter:
+                continue
+            found.append(key)
+        return found
+
+    def parse_scan_args(self, parts, cursor_index, with_type=False):
+        # cursor [MATCH pattern] [COUNT count] [TYPE type], returns (cursor, pattern or None, count, type or None)
+        cursor = self.parse_int(parts[cursor_index])
+        if cursor < 0:
+            raise CommandError("ERROR: invalid cursor")
+        match, count, type_filter = None, 10, None
+        i = cursor_index + 1
+        while i < len(parts):
+            option = parts[i].upper()
+            if i + 1 >= len(parts) or option not in (("MATCH", "COUNT", "TYPE") if with_type else ("MATCH", "COUNT")):
+                raise CommandError("ERROR: syntax error")
+            if option == "MATCH":
+                match = parts[i + 1]
+            elif option == "TYPE":
+                type_filter = parts[i + 1].lower()
+            else:
+                count = self.parse_int(parts[i + 1])
+                if count < 1:
+                    raise CommandError("ERROR: syntax error")
+            i += 2
+        return cursor, match, count, type_filter
+
+############# maxmemory, keys are evicted before a write that needs memory once the limit is reached ##########################
+
+    def configure_maxmemory(self, maxmemory, policy="noeviction", samples=5):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f"maxmemory policy must be one of {', '.join(EVICTION_POLICIES)}")
+        self.maxmemory = maxmemory
+        self.maxmemory_policy = policy
+        self.maxmemory_samples = samples
+        if not maxmemory:
+            return
+        if policy.endswith("-lfu"):
+            self.data.enable_access_tracking(lfu_clock)
+        elif policy.startswith("allkeys-") or policy == "volatile-lru":
+            self.data.enable_access_tracking(lru_clock)
+        # whatever was loaded before the limit was known gets counted once, from here on writes keep it up to date
+        for index, shard in enumerate(self.data.shards):
+            with self.data.locks[index]:
+                self.shard_memory[index] = sum(estimate_size(key, value) for key, value in shard.items())
+
+    def used_memory(self):
+        return sum(self.shard_memory)
+
+    @contextlib.contextmanager
+    def memory_accounting(self, keys):
+        # caller holds the shard locks of keys. whatever the block does to them moves used memory by the
+        # difference of their size estimates
+        if not self.maxmemory:
+            yield
+            return
+        keys = list(dict.fromkeys(keys))
+        before = [estimate_size(key, self.data.get(key)) for key in keys]
+        try:
+            yield
+        finally:
+            for key, size in zip(keys, before):
+                self.shard_memory[self.data.shard_index(key)] += estimate_size(key, self.data.get(key)) - size
+
+    def forget_memory(self, key, value):
+        # caller holds the key's shard lock, for keys that go away outside of a command (expiry)
+        if self.maxmemory and value is not None:
+            self.shard_memory[self.data.shard_index(key)] -= estimate_size(key, value)
+
+    def evict_until_fits(self):
+        # False when used memory stays over the limit, noeviction or nothing left that may be evicted
+        if self.maxmemory_policy == "noeviction":
+            return False
+        volatile = self.maxmemory_policy.startswith("volatile-")
+        with self.eviction_lock:
+            misses = 0
+            while self.used_memory() > self.maxmemory:
+                key = self.eviction_candidate(volatile)
+                # busy shards are skipped, never wait for a lock here, EXEC may hold some of them
+                lock = self.data.lock_for(key) if key is not None else None
+                if lock is None or not lock.acquire(blocking=False):
+                    misses += 1
+                    if misses > 16:
+                        return False
+                    continue
+                try:
+                    value = self.data.get(key)
+                    if value is None or (volatile and key not in self.ttl_data):
+                        continue
+                    del self.data[key]
+                    self.clear_expiry(key)
+                    self.forget_memory(key, value)
+                    self.signal_modified_key(key)
+                    self.append_to_aof(["DEL", key])  # replay must not bring evicted keys back
+                    self.evicted_keys += 1
+                finally:
+                    lock.release()
+        return True
+
+    def eviction_candidate(self, volatile):
+        # approximated LRU/LFU like redis: a few random samples per round go into a small pool of the best
+        # candidates seen so far, and the best one of the pool is evicted
+        self.fill_eviction_pool(volatile)
+        while self.eviction_pool:
+            _, key = self.eviction_pool.pop()
+            if key in self.data and (not volatile or key in self.ttl_data):
+                return key
+        return None
+
+    def fill_eviction_pool(self, volatile):
+        if volatile:
+            # keys with a TTL are exactly the ones in the expiry heap, sampled from there
+            heap = self.expiry_heap
+            keys = []
+            for _ in range(self.maxmemory_samples):
+                try:
+                    expire_at, key = heap[random.randrange(len(heap))]
+                except (IndexError, ValueError):
+                    break
+                if self.ttl_data.get(key) == expire_at:
+                    keys.append(key)
+        else:
+            keys = self.data.sample(self.maxmemory_samples)
+        pool = self.eviction_pool
+        for key in keys:
+            if any(pooled == key for _, pooled in pool):
+                continue
+            score = self.eviction_score(key)
+            if score is None:
+                continue
+            if len(pool) < self.eviction_pool_size:
+                bisect.insort(pool, (score, key))
+            elif score > pool[0][0]:
+                pool.pop(0)
+                bisect.insort(pool, (score, key))
+
+    def eviction_score(self, key):
+        # higher = better to evict
+        policy = self.maxmemory_policy
+        if policy.endswith("-random"):
+            return random.random()
+        if policy == "volatile-ttl":
+            expire_at = self.ttl_data.get(key)
+            return -expire_at if expire_at is not None else None
+        clock = self.data.clocks[self.data.shard_index(key)].get(key)
+        if clock is None:
+            return None
+        if policy.endswith("-lfu"):
+            return 255 - lfu_decayed_counter(clock)
+        return (lru_clock() - clock) & LRU_CLOCK_MAX  # idle seconds
+
+############# TTL engine, a min heap of (expire_at, key) so the expiry cycle only ever looks at keys that are due ##############
+
+    def set_expiry(self, key, expire_at):
+        # caller holds the key's shard lock. old heap entries for the key are not removed here,
+        # they just stop matching self.ttl_data and get skipped when they reach the top
+        self.ttl_data[key] = expire_at
+        with self.expiry_lock:
+            heap = self.expiry_heap
+            heapq.heappush(heap, (expire_at, key))
+            if len(heap) > 2 * len(self.ttl_data) + 1024:
+                # TTLs that were changed or cleared piled up, start over from the live ones. the copy is one
+                # C level call, a TTL set meanwhile by another thread is in it or pushes its entry after this
+                heap[:] = [(expire_at, key) for key, expire_at in self.ttl_data.copy().items()]
+                heapq.heapify(heap)
+
+    def clear_expiry(self, key):
+        self.ttl_data.pop(key, None)
+
+    def expire_if_needed(self, key):
+        # lazy expiry, a key that is past its TTL is never served even if the expiry cycle did not get to it yet.
+        # replicas leave it to the master, its DEL comes down the stream
+        expire_at = self.ttl_data.get(key)
+        if expire_at is not None and expire_at <= time.time() and self.master_host is None:
+            with self.data.lock_for(key):
+                if self.ttl_data.get(key) == expire_at:
+                    self.delete_expired(key)
+
+    def delete_expired(self, key):
+        # caller holds the key's shard lock. the DEL is logged like an eviction, so replicas (which do not expire
+        # keys on their own) and the AOF drop the key at the same point in the stream
+        self.forget_memory(key, self.data.pop(key, None))
+        del self.ttl_data[key]
+        self.signal_modified_key(key)
+        self.append_to_aof(["DEL", key])
+        self.expired_keys += 1
+
+    def check_ttl(self):
+        # threaded mode background thread, expiry plus the periodic jobs so no client thread ever runs them
+        while True:
+            more_due = self.remove_expired_keys()
+            self.server_cron()
+            if not more_due:
+                # No need to send a response here,cause as it's a server-side operation
+                time.sleep(self.ttl_check_interval)
+
+    def remove_expired_keys(self):
+        # pops at most expire_batch_size due keys, returns True when there are more due keys waiting
+        current_time = time.time()
+        if self.master_host is not None:
+            return False
+        for _ in range(self.expire_batch_size):
+            with self.expiry_lock:
+                if not self.expiry_heap or self.expiry_heap[0][0] > current_time:
+                    return False
+                expire_at, key = heapq.heappop(self.expiry_heap)
+            with self.data.lock_for(key):
+                if self.ttl_data.get(key) == expire_at:  # stale heap entries are skipped
+                    self.delete_expired(key)
+        return True
+
+    def next_expiry_in(self):
+        # seconds until the next key is due, capped at the check interval, the event loop uses it as select timeout
+        with self.expiry_lock:
+            if not self.expiry_heap:
+                return self.ttl_check_interval
+            return min(max(0, self.expiry_heap[0][0] - time.time()), self.ttl_check_interval)
+
+    def remaining_ttl(self, key):
+        # -2 = no such key, -1 = no TTL, otherwise seconds left as a float
+        if key not in self.data:
+            return -2
+        expire_at = self.ttl_data.get(key)
+        if expire_at is None:
+            return -1
+        return max(0, expire_at - time.time())
+
+    def handle_expire_generic(self, parts, unit, absolute):
+        key = parts[1]
+        try:
+            amount = int(parts[2])
+        except ValueError:
+            return CommandError("ERROR: Value is not an integer")
+        expire_at = amount / unit if absolute else time.time() + amount / unit
+        with self.data.lock_for(key):
+            if key not in self.data:
+                return 0
+            self.set_expiry(key, expire_at)
+            self.append_to_aof(["PEXPIREAT", key, str(int(expire_at * 1000))])
+        return 1
+
+    @command("EXPIRE", 3, "write fast")
+    def handle_expire(self, client, parts):
+        return self.handle_expire_generic(parts, 1, False)
+
+    @command("PEXPIRE", 3, "write fast")
+    def handle_pexpire(self, client, parts):
+        return self.handle_expire_generic(parts, 1000, False)
+
+    @command("EXPIREAT", 3, "write fast")
+    def handle_expireat(self, client, parts):
+        return self.handle_expire_generic(parts, 1, True)
+
+    @command("PEXPIREAT", 3, "write fast")
+    def handle_pexpireat(self, client, parts):
+        return self.handle_expire_generic(parts, 1000, True)
+
+    @command("TTL", 2, "readonly fast")
+    def handle_ttl(self, client, parts):
+        key = parts[1]
+        with self.data.lock_for(key):
+            remaining = self.remaining_ttl(key)
+        return remaining if remaining < 0 else int(remaining + 0.5)
+
+    @command("PTTL", 2, "readonly fast")
+    def handle_pttl(self, client, parts):
+        key = parts[1]
+        with self.data.lock_for(key):
+            remaining = self.remaining_ttl(key)
+        return remaining if remaining < 0 else int(remaining * 1000)
+
+    @command("PERSIST", 2, "write fast")
+    def handle_persist(self, client, parts):
+        key = parts[1]
+        with self.data.lock_for(key):
+            if key not in self.data or key not in self.ttl_data:
+                return 0
+            self.clear_expiry(key)
+            self.append_to_aof(["PERSIST", key])
+        return 1
+
+##############Atomic Increment and decrement #####################################################################
+# counters are kept as python ints, so a hit is one addition with no parse/format round trip
+
+    def incr_by(self, parts, amount):
+        key = parts[1]
+        with self.data.lock_for(key):
+            value = self.data.get(key, 0)  # a missing counter starts at 0
+            if not isinstance(value, int):
+                if not isinstance(value, str):
+                    return CommandError(WRONGTYPE_ERROR)
+                value = int_encoded(value)
+                if not isinstance(value, int):
+                    return CommandError("ERROR: value is not an integer or out of range")
+            result = value + amount
+            if not INT64_MIN <= result <= INT64_MAX:
+                return CommandError("ERROR: increment or decrement would overflow")
+            self.data[key] = result
+            self.append_to_aof(parts)
+            return result
+
+    @command("INCR", 2, "write denyoom fast")
+    def handle_incr(self, client, parts):
+        return self.incr_by(parts, 1)
+
+    @command("DECR", 2, "write denyoom fast")
+    def handle_decr(self, client, parts):
+        return self.incr_by(parts, -1)
+
+    @command("INCRBY", 3, "write denyoom fast")
+    def handle_incrby(self, client, parts):
+        return self.incr_by(parts, self.parse_int(parts[2]))
+
+    @command("DECRBY", 3, "write denyoom fast")
+    def handle_decrby(self, client, parts):
+        return self.incr_by(parts, -self.parse_int(parts[2]))
+
+    @command("INCRBYFLOAT", 3, "write denyoom fast")
+    def handle_incrbyfloat(self, client, parts):
+        key = parts[1]
+        try:
+            amount = float(parts[2])
+        except ValueError:
+            return CommandError("ERROR: value is not a valid float")
+        with self.data.lock_for(key):
+            value = self.data.get(key, 0)
+            if not isinstance(value, (str, int)):
+                return CommandError(WRONGTYPE_ERROR)
+            try:
+                result = float(value) + amount
+            except ValueError:
+                return CommandError("ERROR: value is not a valid float")
+            if math.isnan(result) or math.isinf(result):
+                return CommandError("ERROR: increment would produce NaN or Infinity")
+            text = format_float(result)
+            self.data[key] = int_encoded(text)
+            # logged as the resulting value, replaying float additions could round differently
+            expire_at = self.ttl_data.get(key)
+            if expire_at is None:
+                self.append_to_aof(["SET", key, text])
+            else:
+                self.append_to_aof(["SET", key, text, "PXAT", str(int(expire_at * 1000))])
+            return text
+
+
+########## this are is for our persistance funtionality , like snapshot and AOF ,big bois stuff hehe
+
+    @command("SAVE", 1, "admin noscript", 0, 0, 0)
+    def handle_save(self, client, parts):
+        dirty = self.dirty
+        self.save_snapshot()
+        self.dirty -= dirty
+        self.last_save_time = time.time()
+        return SimpleString("OK")
+
+    @command("BGSAVE", -1, "admin noscript", 0, 0, 0)
+    def handle_bgsave(self, client, parts):
+        if not self.start_bgsave():
+            return CommandError(f"ERROR: Background save already in progress "
+                                f"({self.bgsave_keys_written}/{self.bgsave_keys_total} keys written)")
+        return SimpleString("Background saving started")
+
+    @command("LASTSAVE", 1, "fast", 0, 0, 0)
+    def handle_lastsave(self, client, parts):
+        return int(self.last_save_time)
+
+    def start_bgsave(self):
+        with self.bgsave_lock:
+            if self.bgsave_in_progress:
+                return False
+            self.bgsave_in_progress = True
+        self.bgsave_started_at = time.time()
+        self.bgsave_keys_written = 0
+        dirty = self.dirty
+        try:
+            if self.bgsave_use_fork:
+                self.fork_bgsave(dirty)
+            else:
+                items = self.point_in_time_view()
+                self.bgsave_keys_total = len(items)
+                threading.Thread(target=self.bgsave_from_view, args=(items, dirty), daemon=True).start()
+        except Exception as e:
+            print(f"Error starting background save: {e}")
+            self.finish_bgsave(False, dirty)
+            return False
+        return True
+
+    def fork_bgsave(self, dirty):
+        # the child gets a copy on write image of the keyspace taken with every shard locked, so it is one
+        # consistent moment, and the parent only pays for the fork itself
+        read_fd, write_fd = os.pipe()
+        with self.data.locked_all():
+            self.bgsave_keys_total = sum(len(shard) for shard in self.data.shards)
+            pid = os.fork()
+            if pid == 0:
+                self.bgsave_child(read_fd, write_fd)
+        os.close(write_fd)
+        print(f"Background saving started by pid {pid}")
+        threading.Thread(target=self.wait_for_bgsave_child, args=(pid, read_fd, dirty), daemon=True).start()
+
+    def bgsave_child(self, read_fd, write_fd):
+        # runs in the forked child, it owns a private copy of the data so no locks are needed (or safe) here
+        code = 1
+        try:
+            os.close(read_fd)
+            writer = SnapshotWriter(self.snapshot_filename)
+            written = 0
+            for shard in self.data.shards:
+                writer.write_entries([(key, value, self.ttl_data.get(key)) for key, value in shard.items()])
+                written += len(shard)
+                os.write(write_fd, b"%d\n" % written)  # progress for the parent
+            writer.close()
+            code = 0
+        finally:
+            os._exit(code)
+
+    def wait_for_bgsave_child(self, pid, read_fd, dirty):
+        with os.fdopen(read_fd, 'rb') as progress:
+            for line in progress:
+                self.bgsave_keys_written = int(line)
+        _, status = os.waitpid(pid, 0)
+        self.finish_bgsave(os.waitstatus_to_exitcode(status) == 0, dirty)
+
+    def bgsave_from_view(self, items, dirty):
+        # no fork available, so the view was copied under the shard locks and is written from a thread
+        writer = SnapshotWriter(self.snapshot_filename)
+        try:
+            for i in range(0, len(items), 10000):
+                writer.write_entries(items[i:i + 10000])
+                self.bgsave_keys_written = min(i + 10000, len(items))
+            writer.close()
+        except Exception as e:
+            print(f"Error in background save: {e}")
+            writer.abort()
+            self.finish_bgsave(False, dirty)
+            return
+        self.finish_bgsave(True, dirty)
+
+    def finish_bgsave(self, ok, dirty):
+        if ok:
+            self.dirty -= dirty
+            self.last_save_time = time.time()
+            print(f"Background saving done, {self.bgsave_keys_written} keys in "
+                  f"{time.time() - self.bgsave_started_at:.2f} seconds")
+        else:
+            print("Background saving failed")
+        self.last_bgsave_status = "ok" if ok else "err"
+        with self.bgsave_lock:
+            self.bgsave_in_progress = False
+
+    def save_snapshot(self):
+        # copies and writes one shard at a time, so a save only ever blocks a single shard
+        writer = SnapshotWriter(self.snapshot_filename)
+        try:
+            for index, shard in enumerate(self.data.shards):
+                with self.data.locks[index]:
+                    entries = [(key, self.copy_value(value), self.ttl_data.get(key)) for key, value in shard.items()]
+                writer.write_entries(entries)
+            writer.close()
+        except Exception:
+            writer.abort()
+            raise
+
+    def load_snapshot(self):
+        if os.path.exists(self.snapshot_filename):
+            try:
+                self.load_binary_snapshot()
+            except SnapshotError as e:
+                print(f"Error loading snapshot {self.snapshot_filename}: {e}")
+            return
+        self.load_text_snapshot()
+
+    def load_binary_snapshot(self, filename=None, replace=False):
+        # entries are decoded fully (and the CRC checked) before anything touches self.data. replace is a
+        # replica's full sync, the old data goes away in the same locked step the new data comes in
+        filename = filename or self.snapshot_filename
+        now = time.time()
+        shards = [{} for _ in self.data.shards]
+        expiries = {}
+        shard_count = self.data.shard_count
+        for key, value, expire_at in read_snapshot(filename):
+            # a replica keeps what its master still has, the master's DEL removes it once it expires
+            if expire_at is not None:
+                if expire_at <= now and not replace:
+                    continue
+                expiries[key] = expire_at
+            shards[hash(key) % shard_count][key] = value
+        with self.data.locked_all():
+            if replace:
+                for key in self.watched_keys:
+                    self.signal_modified_key(key)
+                self.data.clear()
+                self.ttl_data.clear()
+            for index, entries in enumerate(shards):
+                self.data.load(index, entries)
+                if self.maxmemory:
+                    self.shard_memory[index] = sum(estimate_size(key, value) for key, value in entries.items())
+            self.ttl_data.update(expiries)
+            with self.expiry_lock:
+                if replace:
+                    self.expiry_heap.clear()
+                self.expiry_heap.extend((expire_at, key) for key, expire_at in expiries.items())
+                heapq.heapify(self.expiry_heap)
+        print(f"Loaded {sum(len(entries) for entries in shards)} keys from {filename}")
+
+    def load_text_snapshot(self):
+        # the old 'SET key value' snapshot format, only read when there is no binary snapshot yet
+        try:
+            with open('redis_snapshot.txt', 'r') as snapshot_file:
+                for line in snapshot_file:
+                    parts = line.strip().split()
+                    if len(parts) >= 3 and parts[0] == "SET":
+                        key, value = parts[1], ' '.join(parts[2:])
+                        self.data[key] = value
+        except FileNotFoundError:
+            pass
+
+    def load_aof(self):
+        try:
+            with open(self.aof_filename, 'rb') as aof_file:
+                # same parser as the network path, so old text lines and RESP records both replay
+                commands, _ = parse_commands(aof_file.read())
+        except FileNotFoundError:
+            return
+        aof_enabled, self.aof_enabled = self.aof_enabled, False  # replayed commands must not be logged again
+        try:
+            for parts, _ in commands:
+                self.handle_command(parts)
+        finally:
+            self.aof_enabled = aof_enabled
+        self.aof_loaded = True
+
+    def handle_command(self, parts):
+        # AOF replay goes through the same command table as the clients, only write commands matter here
+        spec = COMMANDS.get(parts[0].upper())
+        if spec is None or "write" not in spec.flags:
+            return
+        reply = self.dispatch_command(None, parts)
+        if isinstance(reply, CommandError):
+            print(f"Skipping AOF record {' '.join(parts)}: {reply}")
+
+    def enable_aof(self):
+        if self.aof_writer is None:
+            self.aof_writer = AofWriter(self.aof_filename, self.appendfsync)
+        self.aof_enabled = True
+
+    def disable_aof(self):
+        self.aof_enabled = False
+        if self.aof_writer is not None:
+            self.aof_writer.close()  # flushes whatever is still buffered
+            self.aof_writer = None
+
+    def append_to_aof(self, parts):
+        self.dirty += 1  # every write goes through here, so this also counts changes since the last snapshot
+        record = None
+        if self.aof_enabled and self.aof_writer is not None:
+            # only a buffer append under the shard lock, the file write happens on the flusher thread
+            record = encode_command(parts)
+            self.aof_seq.value = self.aof_writer.append(record)
+        if self.repl_backlog is not None:
+            # the replicas' write stream is the AOF record stream, encoded once for both
+            self.feed_replicas(record or encode_command(parts))
+
+    def wait_for_aof(self):
+        # appendfsync always: hold the reply until this thread's last record is on disk
+        seq = getattr(self.aof_seq, 'value', 0)
+        if seq and self.aof_writer is not None and self.aof_writer.appendfsync == "always":
+            self.aof_writer.wait_for(seq)
+
+    def recover_from_aof(self):
+        # __init__ already replayed the log, doing it twice would push every list element twice
+        if self.aof_enabled and not self.aof_loaded:
+            self.load_aof()
+
+############# AOF rewrite, the log gets replaced by the shortest list of commands that builds the current data ###########
+
+    def copy_value(self, value):
+        # values the handlers mutate in place have to be copied for a point in time view
+        if isinstance(value, collections.deque):
+            return collections.deque(value)
+        if isinstance(value, (HashValue, SortedSetValue)):
+            return value.copy()
+        return value
+
+    def point_in_time_view(self, while_locked=None):
+        # every shard locked at once, so the copy is one consistent moment. only references are copied
+        # for immutable values, which keeps the pause short. while_locked runs at that same moment
+        with self.data.locked_all():
+            items = []
+            for shard in self.data.shards:
+                for key, value in shard.items():
+                    items.append((key, self.copy_value(value), self.ttl_data.get(key)))
+            if while_locked is not None:
+                while_locked()
+        return items
+
+    def rewrite_records(self, key, value, expire_at):
+        if isinstance(value, collections.deque):
+            # big lists are split so no single record gets huge
+            items = iter(value)
+            while True:
+                chunk = list(itertools.islice(items, 64))
+                if not chunk:
+                    break
+                yield ["RPUSH", key] + chunk
+        elif isinstance(value, HashValue):
+            pairs = iter(value.items())
+            while True:
+                chunk = [item for pair in itertools.islice(pairs, 64) for item in pair]
+                if not chunk:
+                    break
+                yield ["HSET", key] + chunk
+        elif isinstance(value, SortedSetValue):
+            pairs = iter(value.scores.items())
+            while True:
+                chunk = [item for member, score in itertools.islice(pairs, 64) for item in (repr(score), member)]
+                if not chunk:
+                    break
+                yield ["ZADD", key] + chunk
+        else:
+            yield ["SET", key, value]
+        if expire_at is not None:
+            yield ["PEXPIREAT", key, str(int(expire_at * 1000))]
+
+    @command("BGREWRITEAOF", 1, "admin noscript", 0, 0, 0)
+    def handle_bgrewriteaof(self, client, parts):
+        if self.aof_writer is None:
+            return CommandError("ERROR: AOF is disabled")
+        if not self.start_aof_rewrite():
+            return CommandError("ERROR: Background append only file rewriting already in progress")
+        return SimpleString("Background append only file rewriting started")
+
+    def start_aof_rewrite(self):
+        with self.aof_rewrite_lock:
+            if self.aof_rewrite_in_progress:
+                return False
+            self.aof_rewrite_in_progress = True
+        functions = []
+
+        def start_rewrite():
+            functions.extend(self.functions.values())
+            self.aof_writer.start_rewrite()
+        items = self.point_in_time_view(start_rewrite)
+        threading.Thread(target=self.rewrite_aof, args=(items, functions), daemon=True).start()
+        return True
+
+    def rewrite_aof(self, items, functions=()):
+        writer = self.aof_writer
+        temp_filename = f"temp-rewriteaof-{os.getpid()}.aof"
+        try:
+            with open(temp_filename, 'wb') as temp_file:
+                for function in functions:
+                    temp_file.write(encode_command(["FUNCTION", "LOAD", "REPLACE", function.name, function.body]))
+                for key, value, expire_at in items:
+                    for parts in self.rewrite_records(key, value, expire_at):
+                        temp_file.write(encode_command(parts))
+            writer.finish_rewrite(temp_filename)
+            print(f"AOF rewrite done, {len(items)} keys, {writer.size} bytes")
+        except Exception as e:
+            print(f"Error rewriting AOF: {e}")
+            writer.abort_rewrite()
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+        finally:
+            self.aof_rewrite_in_progress = False
+
+    def check_aof_rewrite(self):
+        writer = self.aof_writer
+        if writer is None or self.aof_rewrite_in_progress or writer.size < self.aof_rewrite_min_size:
+            return
+        if writer.size >= writer.base_size * (1 + self.aof_rewrite_percentage / 100):
+            print(f"AOF grew to {writer.size} bytes, starting automatic rewrite")
+            self.start_aof_rewrite()
 
+################################ ayo, this is to handle those complex transactions, dont you dare mess this up
 
+    # transaction state lives on the connection, so every client can have its own MULTI going. EXEC runs the
+    # queue with the shard locks of all its keys held, WATCH makes it a check-and-set on the watched keys' versions
 
-        # Initialize with loading data from snapshot file
-        self.load_snapshot()
+    @command("MULTI", 1, "noscript fast", 0, 0, 0)
+    def handle_multi(self, client, parts):
+        if client.multi is not None:
+            return CommandError("ERROR: MULTI calls can not be nested")
+        client.multi = []
+        client.multi_error = False
+        return SimpleString("OK")
 
-    def start(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-            server_socket.bind((self.host, self.port))
-            server_socket.listen()
+    @command("EXEC", 1, "noscript", 0, 0, 0)
+    def handle_exec(self, client, parts):
+        if client.multi is None:
+            return CommandError("ERROR: EXEC without MULTI")
+        commands, client.multi = client.multi, None
+        if client.multi_error:
+            self.unwatch(client)
+            return CommandError("EXECABORT Transaction discarded because of previous errors.")
+        keys = list(client.watched)
+        for queued in commands:
+            keys.extend(COMMANDS[queued[0].upper()].keys(queued))
+        if any(self.keyspace_wide(queued) for queued in commands):
+            locks = self.data.locked_all()
+        else:
+            locks = self.data.locked(keys)
+        try:
+            with locks:
+                for key in client.watched:
+                    self.expire_if_needed(key)  # a watched key that expired meanwhile counts as changed
+                if any(self.watched_keys[key][0] != version for key, version in client.watched.items()):
+                    return None  # a watched key changed, nothing runs and the client retries
+                client.in_exec = True
+                try:
+                    return [self.dispatch_command(client, queued) for queued in commands]
+                finally:
+                    client.in_exec = False
+        finally:
+            self.unwatch(client)
 
-            print(f"Server listening on {self.host}:{self.port}")
+    def keyspace_wide(self, parts):
+        # a queued FCALL is keyspace wide when its function is
+        spec = COMMANDS[parts[0].upper()]
+        if spec.movable_keys:
+            function = self.functions.get(parts[1])
+            return function is not None and function.keyspace_wide
+        return spec.keyspace_wide
 
-            while True:
-                try:
-                    client_socket, client_address = server_socket.accept()
-                    print(f"Accepted connection from {client_address[0]}:{client_address[1]}")
-                    threading.Thread(target=self.handle_client, args=(client_socket,)).start()
-                    self.ttl_thread = threading.Thread(target=self.check_ttl)
-                    self.ttl_thread.start()
-                except Exception as e:
-                    print(f"Error accepting client connection: {e}")
+    @command("DISCARD", 1, "noscript fast", 0, 0, 0)
+    def handle_discard(self, client, parts):
+        if client.multi is None:
+            return CommandError("ERROR: DISCARD without MULTI")
+        client.multi = None
+        self.unwatch(client)
+        return SimpleString("OK")
+
+    @command("WATCH", -2, "noscript fast", 1, -1, 1)
+    def handle_watch(self, client, parts):
+        if client.multi is not None:
+            return CommandError("ERROR: WATCH inside MULTI is not allowed")
+        keys = parts[1:]
+        # versions are read under the shard locks, a write either finished and moved the version or has not started
+        with self.data.locked(keys):
+            for key in keys:
+                if key not in client.watched:
+                    entry = self.watched_keys.setdefault(key, [0, 0])
+                    entry[1] += 1
+                    client.watched[key] = entry[0]
+        return SimpleString("OK")
+
+    @command("UNWATCH", 1, "noscript fast", 0, 0, 0)
+    def handle_unwatch(self, client, parts):
+        self.unwatch(client)
+        return SimpleString("OK")
+
+    def unwatch(self, client):
+        if not client.watched:
+            return
+        with self.data.locked(client.watched):
+            for key in client.watched:
+                entry = self.watched_keys[key]
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.watched_keys[key]
+        client.watched.clear()
+
+    def signal_modified_key(self, key):
+        # caller holds the key's shard lock. moves the version, so the EXEC of everyone watching the key fails
+        entry = self.watched_keys.get(key)
+        if entry is not None:
+            entry[0] += 1
+
+    ##################### funtions for LPUSH,RPUSH,LPOP,RPOP,LRANGE with flages , ^^w^^
+    # lists are collections.deque, so pushes and pops at both ends are O(1) no matter how long the list is
 
-    def handle_client(self, client_socket):
+    def get_list(self, key, create=False):
+        # caller holds the key's shard lock
+        value = self.data.get(key)
+        if value is None:
+            if create:
+                value = self.data[key] = collections.deque()
+            return value
+        if not isinstance(value, collections.deque):
+            raise CommandError(WRONGTYPE_ERROR)
+        return value
+
+    def remove_if_empty(self, key, value):
+        # like redis, a list that loses its last element is gone and so is its TTL
+        if not value:
+            del self.data[key]
+            self.clear_expiry(key)
+
+    def list_range(self, length, start, stop):
+        # redis style inclusive range with negative indexes counted from the end, clamped to the list
+        if start < 0:
+            start = max(length + start, 0)
+        if stop < 0:
+            stop += length
+        return start, min(stop, length - 1)
+
+    def parse_int(self, value):
         try:
-            while True:
-                request = client_socket.recv(1024).decode('utf-8')
-                if not request:
-                    break
+            return int(value)
+        except ValueError:
+            raise CommandError("ERROR: value is not an integer or out of range")
 
-                parts = request.strip().split()
-                command = parts[0].upper()
-
-                if command == "SET":
-                    self.handle_set(client_socket, parts)
-                elif command == "GET":
-                    self.handle_get(client_socket, parts)
-                elif command == "DEL":
-                    self.handle_del(client_socket, parts)
-                elif command == "SAVE":
-                    self.handle_save(client_socket)
-                elif command == "MULTI":
-                    self.handle_transaction(client_socket)
-                elif command == "LPUSH":
-                    self.handle_lpush(client_socket, parts)
-                elif command == "RPUSH":
-                    self.handle_rpush(client_socket, parts)
-                elif command == "LPOP":
-                    self.handle_lpop(client_socket, parts)
-                elif command == "RPOP":
-                    self.handle_rpop(client_socket, parts)
-                elif command == "LRANGE":
-                    self.handle_lrange(client_socket, parts)
-                elif command == "INCR":    
-                    self.handle_incr(client_socket, parts)  # Add this line
-                elif command == "DECR":
-                    self.handle_decr(client_socket, parts)  # Add this line
-                else:
-                    client_socket.send(b"Invalid command\n")
+    @command("LPUSH", -3, "write denyoom fast")
+    def handle_lpush(self, client, parts):
+        key = parts[1]
+        values = parts[2:]
+        with self.data.lock_for(key):
+            value = self.get_list(key, create=True)
+            value.extendleft(values)  # one by one, so LPUSH k a b c gives c b a like redis
+            self.append_to_aof(["LPUSH", key] + values)
+            self.signal_key_ready(key)
+            return len(value)
 
-                # Check if it's time to create a snapshot
-                if time.time() - self.last_snapshot_time >= self.snapshot_interval:
-                    self.save_snapshot()
-                    self.last_snapshot_time = time.time()
-        except Exception as e:
-            print(f"Error handling client: {e}")
-        finally:
-            client_socket.close()
-            
-############# basic stuff to set,get, delete data from RAM, bit simlistic for now , TTL support added.  ############################# 
+    @command("RPUSH", -3, "write denyoom fast")
+    def handle_rpush(self, client, parts):
+        key = parts[1]
+        values = parts[2:]
+        with self.data.lock_for(key):
+            value = self.get_list(key, create=True)
+            value.extend(values)
+            self.append_to_aof(["RPUSH", key] + values)
+            self.signal_key_ready(key)
+            return len(value)
+
+    def handle_pop(self, parts, left):
+        key = parts[1]
+        count = None
+        if len(parts) == 3:
+            count = self.parse_int(parts[2])
+            if count < 0:
+                return CommandError("ERROR: value is out of range, must be positive")
+        with self.data.lock_for(key):
+            value = self.get_list(key)
+            if not value:
+                return None
+            pop = value.popleft if left else value.pop
+            if count is None:
+                popped = pop()
+            else:
+                popped = [pop() for _ in range(min(count, len(value)))]
+            self.remove_if_empty(key, value)
+            self.append_to_aof(parts)
+            return popped
 
-    def handle_set(self, client_socket, parts):
-        if len(parts) >= 3:
-            key, value = parts[1], ' '.join(parts[2:])
-            ttl = None
-            i = 2  # Start from the third element
+    @command("LPOP", -2, "write fast")
+    def handle_lpop(self, client, parts):
+        if len(parts) > 3:
+            return CommandError("Invalid LPOP command")
+        return self.handle_pop(parts, True)
 
-            while i < len(parts):
-                if parts[i].upper() == "EX" and i + 1 < len(parts):
-                    try:
-                        ttl = int(parts[i + 1])
-                        i += 2  # Skip both "EX" and TTL
-                    except ValueError:
-                        client_socket.send(b"Invalid TTL value\n")
-                        return
-                else:
-                    i += 1
+    @command("RPOP", -2, "write fast")
+    def handle_rpop(self, client, parts):
+        if len(parts) > 3:
+            return CommandError("Invalid RPOP command")
+        return self.handle_pop(parts, False)
 
-            with self.lock:
-                self.data[key] = value
-                if ttl is not None:
-                    self.ttl_data[key] = time.time() + ttl  # Set TTL value
-                else:
-                    if key in self.ttl_data:
-                        del self.ttl_data[key]  # Remove any existing TTL for this key
-                self.append_to_aof(f"SET {key} {value}")
-            client_socket.send(b"OK\n")
-        else:
-            client_socket.send(b"Invalid SET command\n")
-            
-    def check_ttl(self):
-        while True:
-            current_time = time.time()
-            keys_to_remove = [key for key, ttl in self.ttl_data.items() if ttl < current_time]
-            for key in keys_to_remove:
-                with self.lock:
-                    if key in self.data:
-                        del self.data[key]
-                    if key in self.ttl_data:
-                        del self.ttl_data[key]
-
-            # No need to send a response here,cause as it's a server-side operation
-            time.sleep(self.ttl_check_interval)
-
-
-    def handle_get(self, client_socket, parts):
-        if len(parts) == 2:
-            key = parts[1]
-            with self.lock:
-                value = self.data.get(key, "nil")
-            client_socket.send(f"{value}\n".encode('utf-8'))
+    @command("LLEN", 2, "readonly fast")
+    def handle_llen(self, client, parts):
+        key = parts[1]
+        with self.data.lock_for(key):
+            value = self.get_list(key)
+            return len(value) if value else 0
+
+    @command("LINDEX", 3, "readonly")
+    def handle_lindex(self, client, parts):
+        key = parts[1]
+        index = self.parse_int(parts[2])
+        with self.data.lock_for(key):
+            value = self.get_list(key)
+            if not value or not -len(value) <= index < len(value):
+                return None
+            return value[index]  # deque indexing walks in from whichever end is nearer
+
+    @command("LRANGE", 4, "readonly")
+    def handle_lrange(self, client, parts):
+        key = parts[1]
+        start = self.parse_int(parts[2])
+        stop = self.parse_int(parts[3])
+        with self.data.lock_for(key):
+            value = self.get_list(key)
+            if not value:
+                return []
+            length = len(value)
+            start, stop = self.list_range(length, start, stop)
+            if start > stop:
+                return []
+            # only walk the elements up to the range, coming in from the nearer end
+            if start <= length - 1 - stop:
+                return list(itertools.islice(value, start, stop + 1))
+            result = list(itertools.islice(reversed(value), length - 1 - stop, length - start))
+            result.reverse()
+            return result
+
+    @command("LTRIM", 4, "write")
+    def handle_ltrim(self, client, parts):
+        key = parts[1]
+        start = self.parse_int(parts[2])
+        stop = self.parse_int(parts[3])
+        with self.data.lock_for(key):
+            value = self.get_list(key)
+            if not value:
+                return SimpleString("OK")
+            length = len(value)
+            start, stop = self.list_range(length, start, stop)
+            if start > stop:
+                value.clear()
+            elif stop - start + 1 < length // 2:
+                # keeping the smaller part, cheaper to copy it out than to pop everything else
+                value = self.data[key] = collections.deque(itertools.islice(value, start, stop + 1))
+            else:
+                for _ in range(start):
+                    value.popleft()
+                for _ in range(length - 1 - stop):
+                    value.pop()
+            self.remove_if_empty(key, value)
+            self.append_to_aof(["LTRIM", key, parts[2], parts[3]])
+        return SimpleString("OK")
+
+    @command("LMOVE", 5, "write denyoom", 1, 2, 1)
+    def handle_lmove(self, client, parts):
+        source, destination = parts[1], parts[2]
+        left, to_left = self.parse_directions(parts[3], parts[4])
+        with self.data.locked([source, destination]):
+            value = self.get_list(source)
+            self.get_list(destination)  # WRONGTYPE before anything is popped
+            if not value:
+                return None
+            return self.pop_for_client(source, value, left, destination, to_left)
+
+############# blocking pops, clients wait on a per key queue and a push hands them the element, nobody polls ###############
+
+    def parse_directions(self, where_from, where_to):
+        where_from, where_to = where_from.upper(), where_to.upper()
+        if where_from not in ("LEFT", "RIGHT") or where_to not in ("LEFT", "RIGHT"):
+            raise CommandError("ERROR: syntax error")
+        return where_from == "LEFT", where_to == "LEFT"
+
+    def parse_timeout(self, value):
+        try:
+            timeout = float(value)
+        except ValueError:
+            raise CommandError("ERROR: timeout is not a float or out of range")
+        if timeout < 0:
+            raise CommandError("ERROR: timeout is negative")
+        return timeout
+
+    def pop_for_client(self, key, value, left, destination=None, to_left=True):
+        # caller holds the shard locks of key and destination. logged as the plain pop/move it turned into,
+        # a replay must never block
+        item = value.popleft() if left else value.pop()
+        self.remove_if_empty(key, value)
+        if self.watched_keys:
+            self.signal_modified_key(key)
+            if destination is not None:
+                self.signal_modified_key(destination)
+        if destination is None:
+            self.append_to_aof(["LPOP" if left else "RPOP", key])
+            return [key, item]
+        target = self.get_list(destination, create=True)
+        if to_left:
+            target.appendleft(item)
         else:
-            client_socket.send(b"Invalid GET command\n")
+            target.append(item)
+        self.append_to_aof(["LMOVE", key, destination, "LEFT" if left else "RIGHT", "LEFT" if to_left else "RIGHT"])
+        self.signal_key_ready(destination)
+        return item
 
-    def handle_del(self, client_socket, parts):
-        if len(parts) == 2:
-            key = parts[1]
-            with self.lock:
-                if key in self.data:
-                    del self.data[key]
-                    self.append_to_aof(f"DEL {key}")
-                    client_socket.send(b"1\n")  # Key deleted successfully
-                else:
-                    client_socket.send(b"0\n")  # Key not found
+    def blocking_pop(self, client, keys, left, timeout, destination=None, to_left=True):
+        keys = list(dict.fromkeys(keys))
+        lock_keys = keys if destination is None else keys + [destination]
+        with self.data.locked(lock_keys), self.memory_accounting(lock_keys):
+            if destination is not None:
+                self.get_list(destination)
+            for key in keys:
+                value = self.get_list(key)
+                if value:
+                    return self.pop_for_client(key, value, left, destination, to_left)
+            if client is None or client.in_exec:
+                return None  # not a connection (replay, script) or inside EXEC, nothing may wait there
+            # registered while the shard locks are still held, so a push can not slip in between
+            deadline = time.time() + timeout if timeout else None
+            waiter = BlockedClient(client, keys, left, destination, to_left, deadline)
+            with self.blocked_lock:
+                for key in keys:
+                    self.blocked_keys.setdefault(key, collections.deque()).append(waiter)
+
+        if self.mode == "eventloop":
+            client.blocked = waiter
+            if deadline is not None:
+                heapq.heappush(self.blocked_timeouts, (deadline, id(waiter), waiter))
+            return BLOCKED
+
+        # threaded mode, this connection's thread sleeps. replies of earlier pipelined commands go out first
+        self.send_replies(client)
+        while not waiter.event.wait(self.blocked_wait_slice(deadline)):
+            if (deadline is not None and time.time() >= deadline) or self.client_gone(client):
+                break
+        with self.blocked_lock:
+            if not waiter.done:
+                self.unblock(waiter)
+        return waiter.result
+
+    def blocked_wait_slice(self, deadline):
+        # wake up once a second even without a deadline, to notice a client that hung up
+        if deadline is None:
+            return 1.0
+        return max(0, min(1.0, deadline - time.time()))
+
+    def client_gone(self, client):
+        if not hasattr(socket, "MSG_DONTWAIT"):
+            return False
+        try:
+            return client.socket.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            return True
+
+    def unblock(self, waiter, result=None):
+        # caller holds self.blocked_lock
+        waiter.done = True
+        waiter.result = result
+        for key in waiter.keys:
+            waiters = self.blocked_keys.get(key)
+            if waiters is None:
+                continue
+            try:
+                waiters.remove(waiter)
+            except ValueError:
+                pass
+            if not waiters:
+                del self.blocked_keys[key]
+
+    def wake(self, waiter):
+        if self.mode == "eventloop":
+            client = waiter.client
+            client.blocked = None
+            client.reply(waiter.result)
+            self.unblocked_clients.append(client)
         else:
-            client_socket.send(b"Invalid DEL command\n")
-            
-##############Atomic Increment and decrement #####################################################################
+            waiter.event.set()
 
-            
-    def handle_incr(self, client_socket, parts):
-        if len(parts) == 2:
-            key = parts[1]
-            with self.lock:
-                if key in self.data:
+    def signal_key_ready(self, key):
+        # caller holds the key's shard lock. the waiters are served after the command, see run_pending
+        if key in self.blocked_keys:
+            with self.blocked_lock:
+                self.ready_keys.add(key)
+
+    def serve_blocked_clients(self):
+        while True:
+            with self.blocked_lock:
+                if not self.ready_keys:
+                    return
+                key = self.ready_keys.pop()
+            self.serve_blocked_key(key)
+
+    def serve_blocked_key(self, key):
+        # oldest waiter first, as long as the list has elements. the waiter's shard locks are taken
+        # fresh for every hand off, so a BLMOVE into another shard keeps the lock order
+        while True:
+            with self.blocked_lock:
+                waiters = self.blocked_keys.get(key)
+                if not waiters:
+                    return
+                waiter = waiters[0]
+            lock_keys = [key] if waiter.destination is None else [key, waiter.destination]
+            with self.data.locked(lock_keys), self.memory_accounting(lock_keys):
+                with self.blocked_lock:
+                    if waiter.done:
+                        continue  # timed out or gone meanwhile, look at the next one
                     try:
-                        current_value = int(self.data[key])
-                    except ValueError:
-                        client_socket.send(b"ERROR: Value is not an integer\n")
-                        return
-                    self.data[key] = str(current_value + 1)
-                    client_socket.send(f"{self.data[key]}\n".encode('utf-8'))
+                        value = self.get_list(key)
+                        if not value:
+                            return
+                        if waiter.destination is not None:
+                            self.get_list(waiter.destination)
+                        result = self.pop_for_client(key, value, waiter.left, waiter.destination, waiter.to_left)
+                    except CommandError as e:
+                        if waiter.destination is None:
+                            return  # the key is not a list anymore, the waiters keep waiting
+                        result = e
+                    self.unblock(waiter, result)
+            self.wake(waiter)
+
+    def expire_blocked_clients(self):
+        # event loop mode, answers nil to the blocked clients whose timeout ran out
+        now = time.time()
+        while self.blocked_timeouts and self.blocked_timeouts[0][0] <= now:
+            _, _, waiter = heapq.heappop(self.blocked_timeouts)
+            with self.blocked_lock:
+                if waiter.done:
+                    continue
+                self.unblock(waiter)
+            self.wake(waiter)
+
+    @command("BLPOP", -3, "write blocking", 1, -2, 1)
+    def handle_blpop(self, client, parts):
+        timeout = self.parse_timeout(parts[-1])
+        return self.blocking_pop(client, parts[1:-1], True, timeout)
+
+    @command("BRPOP", -3, "write blocking", 1, -2, 1)
+    def handle_brpop(self, client, parts):
+        timeout = self.parse_timeout(parts[-1])
+        return self.blocking_pop(client, parts[1:-1], False, timeout)
+
+    @command("BLMOVE", 6, "write denyoom blocking", 1, 2, 1)
+    def handle_blmove(self, client, parts):
+        left, to_left = self.parse_directions(parts[3], parts[4])
+        timeout = self.parse_timeout(parts[5])
+        return self.blocking_pop(client, [parts[1]], left, timeout, parts[2], to_left)
+
+    ##################### hash commands, HSET HGET HDEL and friends
+
+    def get_hash(self, key, create=False):
+        # caller holds the key's shard lock
+        value = self.data.get(key)
+        if value is None:
+            if create:
+                value = self.data[key] = HashValue()
+            return value
+        if not isinstance(value, HashValue):
+            raise CommandError(WRONGTYPE_ERROR)
+        return value
+
+    @command("HSET", -4, "write denyoom fast")
+    def handle_hset(self, client, parts):
+        pairs = self.parse_pairs(parts, 2)
+        key = parts[1]
+        with self.data.lock_for(key):
+            value = self.get_hash(key, create=True)
+            added = sum(value.set(field, field_value) for field, field_value in pairs)
+            self.append_to_aof(parts)
+        return added
+
+    @command("HGET", 3, "readonly fast")
+    def handle_hget(self, client, parts):
+        key = parts[1]
+        with self.data.lock_for(key):
+            value = self.get_hash(key)
+            return value.get(parts[2]) if value is not None else None
+
+    @command("HMGET", -3, "readonly fast")
+    def handle_hmget(self, client, parts):
+        key = parts[1]
+        with self.data.lock_for(key):
+            value = self.get_hash(key)
+            if value is None:
+                return [None] * len(parts[2:])
+            return [value.get(field) for field in parts[2:]]
+
+    @command("HDEL", -3, "write fast")
+    def handle_hdel(self, client, parts):
+        key = parts[1]
+        with self.data.lock_for(key):
+            value = self.get_hash(key)
+            if value is None:
+                return 0
+            deleted = [field for field in parts[2:] if value.delete(field)]
+            if not value:
+                del self.data[key]
+                self.clear_expiry(key)
+            if deleted:
+                self.append_to_aof(["HDEL", key] + deleted)
+        return len(deleted)
+
+    @command("HLEN", 2, "readonly fast")
+    def handle_hlen(self, client, parts):
+        key = parts[1]
+        with self.data.lock_for(key):
+            value = self.get_hash(key)
+            return len(value) if value is not None else 0
+
+    @command("HEXISTS", 3, "readonly fast")
+    def handle_hexists(self, client, parts):
+        key = parts[1]
+        with self.data.lock_for(key):
+            value = self.get_hash(key)
+            return int(value is not None and parts[2] in value)
+
+    @command("HINCRBY", 4, "write denyoom fast")
+    def handle_hincrby(self, client, parts):
+        key, field = parts[1], parts[2]
+        amount = self.parse_int(parts[3])
+        with self.data.lock_for(key):
+            value = self.get_hash(key)
+            current = value.get(field) if value is not None else None
+            if current is None:
+                current = 0
+            else:
+                current = int_encoded(current)
+                if not isinstance(current, int):
+                    return CommandError("ERROR: hash value is not an integer")
+            result = current + amount
+            if not INT64_MIN <= result <= INT64_MAX:
+                return CommandError("ERROR: increment or decrement would overflow")
+            if value is None:
+                value = self.get_hash(key, create=True)
+            value.set(field, str(result))
+            self.append_to_aof(parts)
+        return result
+
+    @command("HGETALL", 2, "readonly")
+    def handle_hgetall(self, client, parts):
+        key = parts[1]
+        with self.data.lock_for(key):
+            value = self.get_hash(key)
+            if value is None:
+                return []
+            return [item for pair in value.items() for item in pair]
+
+    @command("HSCAN", -3, "readonly")
+    def handle_hscan(self, client, parts):
+        key = parts[1]
+        cursor, match, count, _ = self.parse_scan_args(parts, 2)
+        with self.data.lock_for(key):
+            value = self.get_hash(key)
+            if value is None:
+                return ["0", []]
+            if value.is_compact():
+                # small hashes come back in one go like in redis, the cursor is always 0
+                next_cursor, pairs = 0, list(value.items())
+            else:
+                next_cursor, fields = value.scan(cursor, count)
+                pairs = [(field, value.table[field]) for field in fields]
+        found = [item for field, field_value in pairs if match is None or fnmatch.fnmatchcase(field, match)
+                 for item in (field, field_value)]
+        return [str(next_cursor), found]
+
+    ##################### sorted set commands, ZADD ZRANGE ZRANK and friends
+
+    def get_zset(self, key, create=False):
+        # caller holds the key's shard lock
+        value = self.data.get(key)
+        if value is None:
+            if create:
+                value = self.data[key] = SortedSetValue()
+            return value
+        if not isinstance(value, SortedSetValue):
+            raise CommandError(WRONGTYPE_ERROR)
+        return value
+
+    def parse_score(self, value):
+        try:
+            score = float(value)
+        except ValueError:
+            raise CommandError("ERROR: value is not a valid float")
+        if math.isnan(score):
+            raise CommandError("ERROR: value is not a valid float")
+        return score
+
+    def parse_score_bound(self, value):
+        # ZRANGEBYSCORE bounds, '(' in front means exclusive, -inf and +inf work through float()
+        exclusive = value.startswith("(")
+        try:
+            score = float(value[1:] if exclusive else value)
+        except ValueError:
+            raise CommandError("ERROR: min or max is not a float")
+        if math.isnan(score):
+            raise CommandError("ERROR: min or max is not a float")
+        return score, exclusive
+
+    def zset_reply(self, pairs, withscores):
+        if not withscores:
+            return [member for member, _ in pairs]
+        return [item for member, score in pairs for item in (member, format_score(score))]
+
+    @command("ZADD", -4, "write denyoom fast")
+    def handle_zadd(self, client, parts):
+        key = parts[1]
+        flags = set()
+        i = 2
+        while i < len(parts) and parts[i].upper() in ("NX", "XX", "GT", "LT", "CH", "INCR"):
+            flags.add(parts[i].upper())
+            i += 1
+        args = parts[i:]
+        if not args or len(args) % 2:
+            return CommandError("ERROR: syntax error")
+        if "NX" in flags and "XX" in flags:
+            return CommandError("ERR XX and NX options at the same time are not compatible")  # XX alone would pass for an error code
+        if ("GT" in flags and "LT" in flags) or (("GT" in flags or "LT" in flags) and "NX" in flags):
+            return CommandError("ERROR: GT, LT, and/or NX options at the same time are not compatible")
+        if "INCR" in flags and len(args) != 2:
+            return CommandError("ERROR: INCR option supports a single increment-element pair")
+        pairs = [(self.parse_score(args[j]), args[j + 1]) for j in range(0, len(args), 2)]
+
+        added = changed = 0
+        result = None
+        with self.data.lock_for(key):
+            value = self.get_zset(key)
+            for score, member in pairs:
+                current = value.score(member) if value is not None else None
+                if current is None:
+                    if "XX" in flags:
+                        continue
+                    new_score = score
                 else:
-                    client_socket.send(b"0\n")  # Key not found
+                    if "NX" in flags:
+                        continue
+                    new_score = current + score if "INCR" in flags else score
+                    if math.isnan(new_score):
+                        return CommandError("ERROR: resulting score is not a number (NaN)")
+                    if ("GT" in flags and new_score <= current) or ("LT" in flags and new_score >= current):
+                        continue
+                if value is None:
+                    value = self.get_zset(key, create=True)
+                if value.set(member, new_score):
+                    added += 1
+                elif current != new_score:
+                    changed += 1
+                result = new_score
+            if added or changed:
+                self.append_to_aof(parts)
+        if "INCR" in flags:
+            return format_score(result) if result is not None else None
+        return added + changed if "CH" in flags else added
+
+    @command("ZINCRBY", 4, "write denyoom fast")
+    def handle_zincrby(self, client, parts):
+        key, member = parts[1], parts[3]
+        increment = self.parse_score(parts[2])
+        with self.data.lock_for(key):
+            value = self.get_zset(key, create=True)
+            score = (value.score(member) or 0.0) + increment
+            if math.isnan(score):
+                self.remove_if_empty(key, value)
+                return CommandError("ERROR: resulting score is not a number (NaN)")
+            value.set(member, score)
+            self.append_to_aof(parts)
+        return format_score(score)
+
+    @command("ZSCORE", 3, "readonly fast")
+    def handle_zscore(self, client, parts):
+        key = parts[1]
+        with self.data.lock_for(key):
+            value = self.get_zset(key)
+            score = value.score(parts[2]) if value is not None else None
+        return format_score(score) if score is not None else None
+
+    @command("ZCARD", 2, "readonly fast")
+    def handle_zcard(self, client, parts):
+        key = parts[1]
+        with self.data.lock_for(key):
+            value = self.get_zset(key)
+            return len(value) if value is not None else 0
+
+    @command("ZRANK", 3, "readonly fast")
+    def handle_zrank(self, client, parts):
+        key = parts[1]
+        with self.data.lock_for(key):
+            value = self.get_zset(key)
+            return value.rank(parts[2]) if value is not None else None
+
+    @command("ZRANGE", -4, "readonly")
+    def handle_zrange(self, client, parts):
+        # ZRANGE key start stop [REV] [WITHSCORES], ranks like LRANGE
+        key = parts[1]
+        start = self.parse_int(parts[2])
+        stop = self.parse_int(parts[3])
+        options = {option.upper() for option in parts[4:]}
+        if not options <= {"REV", "WITHSCORES"}:
+            return CommandError("ERROR: syntax error")
+        with self.data.lock_for(key):
+            value = self.get_zset(key)
+            if value is None:
+                return []
+            start, stop = self.list_range(len(value), start, stop)
+            if start > stop:
+                return []
+            pairs = value.range_by_rank(start, stop, "REV" in options)
+        return self.zset_reply(pairs, "WITHSCORES" in options)
+
+    @command("ZRANGEBYSCORE", -4, "readonly")
+    def handle_zrangebyscore(self, client, parts):
+        # ZRANGEBYSCORE key min max [WITHSCORES] [LIMIT offset count]
+        key = parts[1]
+        low, low_exclusive = self.parse_score_bound(parts[2])
+        high, high_exclusive = self.parse_score_bound(parts[3])
+        withscores = False
+        offset, count = 0, -1
+        i = 4
+        while i < len(parts):
+            option = parts[i].upper()
+            if option == "WITHSCORES":
+                withscores = True
+                i += 1
+            elif option == "LIMIT" and i + 2 < len(parts):
+                offset, count = self.parse_int(parts[i + 1]), self.parse_int(parts[i + 2])
+                i += 3
+            else:
+                return CommandError("ERROR: syntax error")
+        if offset < 0:
+            return []
+        with self.data.lock_for(key):
+            value = self.get_zset(key)
+            if value is None:
+                return []
+            pairs = value.range_by_score(low, low_exclusive, high, high_exclusive, offset, count)
+        return self.zset_reply(pairs, withscores)
+
+    @command("ZREM", -3, "write fast")
+    def handle_zrem(self, client, parts):
+        key = parts[1]
+        with self.data.lock_for(key):
+            value = self.get_zset(key)
+            if value is None:
+                return 0
+            removed = [member for member in parts[2:] if value.remove(member)]
+            self.remove_if_empty(key, value)
+            if removed:
+                self.append_to_aof(["ZREM", key] + removed)
+        return len(removed)
+
+    @command("ZPOPMIN", -2, "write fast")
+    def handle_zpopmin(self, client, parts):
+        key = parts[1]
+        if len(parts) > 3:
+            return CommandError("ERROR: syntax error")
+        count = self.parse_int(parts[2]) if len(parts) == 3 else 1
+        with self.data.lock_for(key):
+            value = self.get_zset(key)
+            if value is None or count <= 0:
+                return []
+            pairs = value.range_by_rank(0, min(count, len(value)) - 1)
+            for member, _ in pairs:
+                value.remove(member)
+            self.remove_if_empty(key, value)
+            self.append_to_aof(parts)
+        return self.zset_reply(pairs, True)
+
+    @command("ZSCAN", -3, "readonly")
+    def handle_zscan(self, client, parts):
+        # a bucket walk over the members like HSCAN, not ranks, ranks move under the cursor on every ZADD and ZREM
+        key = parts[1]
+        cursor, match, count, _ = self.parse_scan_args(parts, 2)
+        with self.data.lock_for(key):
+            value = self.get_zset(key)
+            if value is None:
+                return ["0", []]
+            if len(value) <= HashValue.MAX_COMPACT_ENTRIES:
+                next_cursor, pairs = 0, value.range_by_rank(0, len(value) - 1)  # small ones in one go, like listpacks
+            else:
+                next_cursor, members = value.scan(cursor, count)
+                pairs = [(member, value.scores[member]) for member in members]
+        found = [item for member, score in pairs if match is None or fnmatch.fnmatchcase(member, match)
+                 for item in (member, format_score(score))]
+        return [str(next_cursor), found]
+
+    ##################### server side functions, FUNCTION LOAD stores them, FCALL runs one under its keys' shard locks
+
+    @command("FUNCTION", -2, "write noscript", 0, 0, 0)
+    def handle_function(self, client, parts):
+        # FUNCTION LOAD [REPLACE] name body | DELETE name | FLUSH | LIST
+        subcommand = parts[1].upper()
+        if subcommand == "LOAD":
+            args = parts[2:]
+            replace = bool(args) and args[0].upper() == "REPLACE"
+            if replace:
+                args = args[1:]
+            if len(args) != 2:
+                return CommandError("ERROR: syntax error, FUNCTION LOAD [REPLACE] name body")
+            name, body = args
+            function = ServerFunction(name, body)
+            if not replace and name in self.functions:
+                return CommandError(f"ERROR: Function {name} already exists")
+            self.functions[name] = function
+            # always logged with REPLACE, a rewrite that already copied the function may replay it twice
+            self.append_to_aof(["FUNCTION", "LOAD", "REPLACE", name, body])
+            return name
+        if subcommand == "DELETE" and len(parts) == 3:
+            if self.functions.pop(parts[2], None) is None:
+                return CommandError("ERROR: Function not found")
+            self.append_to_aof(parts)
+            return SimpleString("OK")
+        if subcommand == "FLUSH" and len(parts) == 2:
+            self.functions.clear()
+            self.append_to_aof(parts)
+            return SimpleString("OK")
+        if subcommand == "LIST" and len(parts) == 2:
+            return [["name", function.name, "writes", int(function.writes), "code", function.body]
+                    for function in list(self.functions.values())]
+        return CommandError(f"ERROR: unknown FUNCTION subcommand or wrong number of arguments for '{parts[1]}'")
+
+    @command("FCALL", -3, "noscript denyoom movablekeys", 3, 3, 1)
+    def handle_fcall(self, client, parts):
+        return self.fcall(parts, readonly=False)
+
+    @command("FCALL_RO", -3, "readonly noscript movablekeys", 3, 3, 1)
+    def handle_fcall_ro(self, client, parts):
+        return self.fcall(parts, readonly=True)
+
+    def fcall(self, parts, readonly):
+        # FCALL name numkeys key [key ...] arg [arg ...]
+        function = self.functions.get(parts[1])
+        if function is None:
+            return CommandError("ERROR: Function not found")
+        numkeys = self.parse_int(parts[2])
+        if not 0 <= numkeys <= len(parts) - 3:
+            return CommandError("ERROR: Number of keys can't be greater than number of args")
+        if readonly and function.writes:
+            return CommandError(f"ERROR: function {function.name} writes, it can not be called with FCALL_RO")
+        if function.writes and self.master_host is not None:
+            return CommandError("READONLY You can't write against a read only replica.")
+        keys, args = parts[3:3 + numkeys], parts[3 + numkeys:]
+        # same locking as EXEC, all declared keys for the whole run, every shard when a statement locks on its own.
+        # the statements go through dispatch_command, so every write is logged to the AOF as itself and a replay
+        # never needs the function
+        with self.data.locked_all() if function.keyspace_wide else self.data.locked(keys):
+            return self.run_function(function, keys, args)
+
+    def run_function(self, function, keys, args):
+        declared = set(keys)
+        replies = []
+        for condition, action, operands in function.statements:
+            if condition is not None:
+                left, op, right = condition
+                if not self.function_condition(self.function_value(left, keys, args, replies), op,
+                                               self.function_value(right, keys, args, replies)):
+                    replies.append(None)
+                    continue
+            values = [self.function_value(operand, keys, args, replies) for operand in operands]
+            if action == "RETURN":
+                return values[0]
+            if action == "ERROR":
+                return CommandError(values[0])
+            parts = [action.name] + [self.function_argument(value) for value in values]
+            for key in action.keys(parts):
+                if key not in declared:
+                    return CommandError(f"ERROR: function {function.name} accessed key '{key}' that was not passed to FCALL")
+            reply = self.dispatch_command(None, parts)
+            if isinstance(reply, CommandError):
+                return reply  # like a failing redis.call, the statements before it stay applied
+            replies.append(reply)
+        return replies[-1]
+
+    def function_value(self, operand, keys, args, replies):
+        kind, value = operand
+        if kind == "":
+            return value
+        if kind == "nil":
+            return None
+        if kind == "$":
+            return replies[value - 1]
+        values = keys if kind == "KEYS" else args
+        if value > len(values):
+            raise CommandError(f"ERROR: {kind}[{value}] but only {len(values)} {kind.lower()} were passed")
+        return values[value - 1]
+
+    def function_argument(self, value):
+        if isinstance(value, (list, tuple)):
+            raise CommandError("ERROR: a multi value reply can not be used as a command argument")
+        if value is None:
+            raise CommandError("ERROR: nil can not be used as a command argument")
+        return str(value)
+
+    def function_condition(self, left, op, right):
+        if left is None or right is None:
+            if op in ("==", "!="):
+                return FUNCTION_OPERATORS[op](left is None, right is None)
+            return False
+        try:
+            left, right = float(left), float(right)  # numbers compare as numbers, so 10 > 9 and 1 == 1.0
+        except (TypeError, ValueError):
+            if op not in ("==", "!="):
+                raise CommandError(f"ERROR: {op} needs two numbers")
+            left, right = str(left), str(right)
+        return FUNCTION_OPERATORS[op](left, right)
+
+    ##################### pub/sub, a channel -> subscribers index plus the pattern trie. a message is encoded once and
+    # the same bytes go into every subscriber's output buffer, PUBLISH never waits for a subscriber
+
+    @command("SUBSCRIBE", -2, "pubsub noscript", 0, 0, 0)
+    def handle_subscribe(self, client, parts):
+        if client.in_exec:
+            return CommandError("ERROR: Command not allowed inside a transaction")
+        replies = []
+        with self.pubsub_lock:
+            for channel in parts[1:]:
+                if channel not in client.channels:
+                    client.channels.add(channel)
+                    self.pubsub_channels[channel] = self.pubsub_channels.get(channel, ()) + (client,)
+                replies.append(["subscribe", channel, len(client.channels) + len(client.patterns)])
+        return self.pubsub_replies(client, replies)
+
+    @command("PSUBSCRIBE", -2, "pubsub noscript", 0, 0, 0)
+    def handle_psubscribe(self, client, parts):
+        if client.in_exec:
+            return CommandError("ERROR: Command not allowed inside a transaction")
+        replies = []
+        with self.pubsub_lock:
+            for pattern in parts[1:]:
+                if pattern not in client.patterns:
+                    client.patterns.add(pattern)
+                    self.pubsub_patterns.add(pattern, client)
+                replies.append(["psubscribe", pattern, len(client.channels) + len(client.patterns)])
+        return self.pubsub_replies(client, replies)
+
+    @command("UNSUBSCRIBE", -1, "pubsub noscript", 0, 0, 0)
+    def handle_unsubscribe(self, client, parts):
+        channels = parts[1:] or list(client.channels)
+        if not channels:
+            return ["unsubscribe", None, len(client.patterns)]
+        return self.pubsub_replies(client, self.unsubscribe_channels(client, channels))
+
+    @command("PUNSUBSCRIBE", -1, "pubsub noscript", 0, 0, 0)
+    def handle_punsubscribe(self, client, parts):
+        patterns = parts[1:] or list(client.patterns)
+        if not patterns:
+            return ["punsubscribe", None, len(client.channels)]
+        return self.pubsub_replies(client, self.unsubscribe_patterns(client, patterns))
+
+    def pubsub_replies(self, client, replies):
+        # one reply per channel like redis, all but the last go straight into the output buffer
+        for reply in replies[:-1]:
+            client.reply(reply)
+        return replies[-1]
+
+    def unsubscribe_channels(self, client, channels):
+        replies = []
+        with self.pubsub_lock:
+            for channel in channels:
+                if channel in client.channels:
+                    client.channels.discard(channel)
+                    subscribers = tuple(subscriber for subscriber in self.pubsub_channels[channel]
+                                        if subscriber is not client)
+                    if subscribers:
+                        self.pubsub_channels[channel] = subscribers
+                    else:
+                        del self.pubsub_channels[channel]
+                replies.append(["unsubscribe", channel, len(client.channels) + len(client.patterns)])
+        return replies
+
+    def unsubscribe_patterns(self, client, patterns):
+        replies = []
+        with self.pubsub_lock:
+            for pattern in patterns:
+                if pattern in client.patterns:
+                    client.patterns.discard(pattern)
+                    self.pubsub_patterns.remove(pattern, client)
+                replies.append(["punsubscribe", pattern, len(client.channels) + len(client.patterns)])
+        return replies
+
+    def unsubscribe_all(self, client):
+        # the connection is going away
+        if client.channels:
+            self.unsubscribe_channels(client, list(client.channels))
+        if client.patterns:
+            self.unsubscribe_patterns(client, list(client.patterns))
+        if client.push_selector is not None:
+            client.push_selector.close()
+            client.push_wakeup.close()
+            client.push_wakeup_reader.close()
+
+    @command("PUBLISH", 3, "pubsub fast", 0, 0, 0)
+    def handle_publish(self, client, parts):
+        channel, message = parts[1], parts[2]
+        receivers = 0
+        subscribers = self.pubsub_channels.get(channel)
+        if subscribers:
+            receivers += self.deliver(subscribers, ["message", channel, message])
+        for pattern, subscribers in self.pubsub_patterns.match(channel):
+            receivers += self.deliver(subscribers, ["pmessage", pattern, channel, message])
+        return receivers
+
+    def deliver(self, subscribers, message):
+        encoded = {}  # RESP or plain text, whatever the subscribers speak, each encoded once
+        for subscriber in subscribers:
+            data = encoded.get(subscriber.resp)
+            if data is None:
+                data = encoded[subscriber.resp] = encode_reply(message, subscriber.resp)
+            if len(subscriber.outbuf) > self.pubsub_output_limit:
+                self.drop_subscriber(subscriber)
+                continue
+            subscriber.push(data)
+            if self.mode == "eventloop":
+                self.clients_with_replies.append(subscriber)
+        return len(subscribers)
+
+    def drop_subscriber(self, client):
+        # a subscriber that stopped reading would make the server buffer messages forever
+        print(f"Closing subscriber {client.address}, it has {len(client.outbuf)} bytes of messages it did not read")
+        if self.mode == "eventloop":
+            self.close_client(client)
         else:
-            client_socket.send(b"Invalid INCR command\n")
+            try:
+                client.socket.shutdown(socket.SHUT_RDWR)  # its thread sees the connection end and cleans up
+            except OSError:
+                pass
 
-    def handle_decr(self, client_socket, parts):
-        if len(parts) == 2:
-            key = parts[1]
-            with self.lock:
-                if key in self.data:
+    def wait_as_subscriber(self, client):
+        # threaded mode, a subscribed connection's thread waits for its socket and for publishers at the same time,
+        # sends what they queued and returns the next request
+        if client.push_selector is None:
+            client.push_wakeup_reader, client.push_wakeup = socket.socketpair()
+            client.push_wakeup_reader.setblocking(False)
+            client.push_selector = selectors.DefaultSelector()
+            client.push_selector.register(client.socket, selectors.EVENT_READ)
+            client.push_selector.register(client.push_wakeup_reader, selectors.EVENT_READ)
+        while True:
+            client.push_pending = False  # before the flush, a message queued after it pokes the wakeup again
+            self.send_replies(client)
+            for key, _ in client.push_selector.select():
+                if key.fileobj is client.socket:
+                    return client.socket.recv(65536)
+                try:
+                    client.push_wakeup_reader.recv(4096)
+                except BlockingIOError:
+                    pass
+
+    @command("PUBSUB", -2, "pubsub", 0, 0, 0)
+    def handle_pubsub(self, client, parts):
+        # PUBSUB CHANNELS [pattern] | NUMSUB [channel ...] | NUMPAT
+        subcommand = parts[1].upper()
+        if subcommand == "CHANNELS" and len(parts) <= 3:
+            channels = list(self.pubsub_channels)
+            if len(parts) == 3:
+                channels = [channel for channel in channels if fnmatch.fnmatchcase(channel, parts[2])]
+            return channels
+        if subcommand == "NUMSUB":
+            return [item for channel in parts[2:] for item in (channel, len(self.pubsub_channels.get(channel, ())))]
+        if subcommand == "NUMPAT" and len(parts) == 2:
+            return self.pubsub_patterns.count
+        return CommandError(f"ERROR: unknown PUBSUB subcommand or wrong number of arguments for '{parts[1]}'")
+
+    ##################### replication, the primary side (PSYNC and the link threads) and the replica side (REPLICAOF and
+    # the sync thread). a replica applies the stream through dispatch_command like an AOF replay
+
+    @command("REPLICAOF", 3, "admin noscript stale", 0, 0, 0)
+    def handle_replicaof(self, client, parts):
+        # REPLICAOF host port | REPLICAOF NO ONE
+        if parts[1].upper() == "NO" and parts[2].upper() == "ONE":
+            if self.master_host is not None:
+                print(f"Stopped replicating {self.master_host}:{self.master_port}, this server takes writes again")
+                self.stop_replication()
+            return SimpleString("OK")
+        port = self.parse_int(parts[2])
+        if (parts[1], port) != (self.master_host, self.master_port):
+            self.replicate_from(parts[1], port)
+        return SimpleString("OK")
+
+    @command("REPLCONF", -3, "admin noscript stale", 0, 0, 0)
+    def handle_replconf(self, client, parts):
+        # REPLCONF listening-port <port>. ACKs only come once the link thread reads the connection, see read_acks
+        if parts[1].lower() == "listening-port" and len(parts) == 3 and client is not None:
+            client.listening_port = self.parse_int(parts[2])
+        return SimpleString("OK")
+
+    @command("PSYNC", 3, "admin noscript", 0, 0, 0)
+    def handle_psync(self, client, parts):
+        if client is None or client.in_exec:
+            return CommandError("ERROR: PSYNC can only be sent by a replica on its own connection")
+        if self.master_host is not None:
+            return CommandError("ERROR: this server is a replica itself, it does not serve PSYNC")
+        client.replica = ReplicaLink(client, parts[1], self.parse_int(parts[2]))
+        return BLOCKED  # the connection's (new) thread answers, see serve_replica
+
+    @command("ROLE", 1, "noscript fast stale", 0, 0, 0)
+    def handle_role(self, client, parts):
+        if self.master_host is not None:
+            return ["slave", self.master_host, self.master_port, self.master_link_status, self.master_repl_offset]
+        with self.repl_lock:
+            replicas = [[link.client.address[0], str(link.client.listening_port or link.client.address[1]),
+                         str(link.ack_offset)] for link in self.replicas]
+        return ["master", self.master_repl_offset, replicas]
+
+    def feed_replicas(self, record):
+        # caller holds the shard locks of the write, so a key's records reach the stream in the order they happened
+        with self.repl_lock:
+            self.repl_backlog.append(record)
+            self.master_repl_offset += len(record)
+            if not self.replicas:
+                return
+            for link in self.replicas:
+                link.buffer += record
+                if len(link.buffer) > self.repl_output_limit:
+                    print(f"Closing replica {link.client.address}, it is {len(link.buffer)} bytes behind")
+                    link.close()
+            if any(link.closed for link in self.replicas):
+                self.replicas = [link for link in self.replicas if not link.closed]
+            self.repl_condition.notify_all()
+
+    def serve_replica(self, link):
+        # runs on the replica connection's own thread for as long as the replica stays connected
+        sock = link.client.socket
+        try:
+            if link.client.outbuf:
+                sock.sendall(link.client.outbuf)  # the replies to what came before PSYNC
+                link.client.outbuf.clear()
+            self.sync_replica(link)
+            while True:
+                with self.repl_condition:
+                    if not link.buffer and not link.closed:
+                        self.repl_condition.wait(1)
+                    if link.closed:
+                        break
+                    data, link.buffer = link.buffer, bytearray()
+                if data:
+                    sock.sendall(data)
+                self.read_acks(link)
+        except (OSError, ProtocolError, SnapshotError) as e:
+            if not link.closed:
+                print(f"Replica {link.client.address} link failed: {e}")
+        finally:
+            with self.repl_lock:
+                if link in self.replicas:
+                    self.replicas.remove(link)
+            link.closed = True
+            link.selector.close()
+            sock.close()
+            print(f"Replica {link.client.address} disconnected")
+
+    def sync_replica(self, link):
+        sock = link.client.socket
+        with self.repl_lock:
+            if self.repl_backlog is None:
+                self.repl_backlog = ReplicationBacklog(self.repl_backlog_size)
+            missing = self.master_repl_offset - link.offset
+            if link.replid == self.replid and 0 <= missing <= self.repl_backlog.length:
+                # partial resync, the link is attached in the same step so not a byte is lost or sent twice.
+                # serve_replica sends it, nothing waits on a socket while repl_lock is held
+                link.buffer += b"+CONTINUE %s\r\n" % self.replid.encode() + self.repl_backlog.tail(missing)
+                self.replicas.append(link)
+                print(f"Partial resync with replica {link.client.address}, {missing} bytes from the backlog")
+                return
+
+        # full resync. the view is taken with every shard locked and the link attached at that same moment,
+        # so each write is either in the snapshot or in the link's buffer
+        functions = []
+        offset = []
+
+        def attach():
+            functions.extend(self.functions.values())
+            with self.repl_lock:
+                offset.append(self.master_repl_offset)
+                self.replicas.append(link)
+        items = self.point_in_time_view(attach)
+        sock.sendall(b"+FULLRESYNC %s %d\r\n" % (self.replid.encode(), offset[0]))
+        filename = f"replica-sync-{os.getpid()}-{threading.get_ident()}.crdb"
+        writer = SnapshotWriter(filename)
+        try:
+            for i in range(0, len(items), 10000):
+                writer.write_entries(items[i:i + 10000])
+            writer.close()
+        except Exception:
+            writer.abort()
+            raise
+        try:
+            with open(filename, 'rb') as snapshot_file:
+                sock.sendall(b"$%d\r\n" % os.fstat(snapshot_file.fileno()).st_size)
+                sock.sendfile(snapshot_file)
+        finally:
+            os.remove(filename)
+        records = b"".join(encode_command(["FUNCTION", "LOAD", "REPLACE", function.name, function.body])
+                           for function in functions)
+        sock.sendall(b"$%d\r\n" % len(records) + records)
+        print(f"Full resync with replica {link.client.address}, {len(items)} keys at offset {offset[0]}")
+
+    def read_acks(self, link):
+        # REPLCONF ACK <offset>, how far the replica got, for ROLE
+        while link.selector.select(0):
+            data = link.client.socket.recv(4096)
+            if not data:
+                raise ConnectionError("connection closed by the replica")
+            link.client.feed(data)
+            while link.client.pending:
+                parts, _ = link.client.pending.popleft()
+                if len(parts) == 3 and parts[0].upper() == "REPLCONF" and parts[1].upper() == "ACK":
                     try:
-                        current_value = int(self.data[key])
+                        link.ack_offset = int(parts[2])
                     except ValueError:
-                        client_socket.send(b"ERROR: Value is not an integer\n")
-                        return
-                    self.data[key] = str(current_value - 1)
-                    client_socket.send(f"{self.data[key]}\n".encode('utf-8'))
-                else:
-                    client_socket.send(b"0\n")  # Key not found
-        else:
-            client_socket.send(b"Invalid DECR command\n")
+                        pass
 
-            
-########## this are is for our persistance funtionality , like snapshot and AOF ,big bois stuff hehe
+    def replicate_from(self, host, port):
+        self.stop_replication()
+        # a replica has no stream of its own, attached replicas resync with whoever takes writes now
+        with self.repl_lock:
+            links, self.replicas = self.replicas, []
+            self.repl_backlog = None
+        for link in links:
+            link.close()
+        self.master_host, self.master_port = host, port
+        self.master_replid = None  # a new master is always a full sync
+        epoch = self.replication_epoch
+        threading.Thread(target=self.replication_loop, args=(epoch,), daemon=True).start()
+        print(f"Replicating {host}:{port}")
 
-    def handle_save(self, client_socket):
-        with self.lock:
-            self.save_snapshot()
-        client_socket.send(b"Data saved to snapshot file\n")
+    def stop_replication(self):
+        self.replication_epoch += 1
+        self.master_host = self.master_port = None
+        self.master_link_status = "connect"
+        if self.master_socket is not None:
+            try:
+                self.master_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        # a stream of our own starts here, replicas of this server do one full sync to get on it
+        self.replid = os.urandom(20).hex()
 
-    def save_snapshot(self):
-        with open('redis_snapshot.txt', 'w') as snapshot_file:
-            for key, value in self.data.items():
-                snapshot_file.write(f"SET {key} {value}\n")
+    def replication_loop(self, epoch):
+        # the replica's sync thread, reconnects (with a partial resync if the master still has our offset) until
+        # REPLICAOF points somewhere else
+        while self.replication_epoch == epoch:
+            try:
+                self.sync_with_master(epoch)
+            except (OSError, ProtocolError, SnapshotError, ValueError) as e:
+                if self.replication_epoch == epoch:
+                    print(f"Replication link to {self.master_host}:{self.master_port} failed: {e}")
+            finally:
+                if self.master_socket is not None:
+                    self.master_socket.close()
+                    self.master_socket = None
+            if self.replication_epoch == epoch:
+                self.master_link_status = "connect"
+                time.sleep(1)
 
-    def load_snapshot(self):
+    def sync_with_master(self, epoch):
+        self.master_link_status = "connecting"
+        sock = socket.create_connection((self.master_host, self.master_port), timeout=60)
+        self.master_socket = sock
+        link = ServerConnection(sock)
+        replid, offset = (self.master_replid, self.master_repl_offset) if self.master_replid else ("?", -1)
+        sock.sendall(encode_command(["REPLCONF", "listening-port", self.port]) + encode_command(["PSYNC", replid, offset]))
+        link.read_line()  # REPLCONF's +OK
+        reply = link.read_line()
+        if reply.startswith("+FULLRESYNC "):
+            _, replid, offset = reply.split()
+            self.master_link_status = "sync"
+            self.full_sync_from_master(link, replid, int(offset))
+        elif reply.startswith("+CONTINUE"):
+            print(f"Partial resync with master {self.master_host}:{self.master_port} from offset {offset}")
+        else:
+            raise ProtocolError(f"unexpected PSYNC reply '{reply}'")
+        if self.replication_epoch != epoch:
+            return
+        self.master_link_status = "connected"
+        sock.settimeout(1)  # wakes the loop up for the ACKs when the master has nothing to send
+        last_ack = 0
+        while self.replication_epoch == epoch:
+            try:
+                link.fill()
+            except socket.timeout:
+                pass
+            commands, consumed = parse_commands(link.buffer)
+            if consumed:
+                del link.buffer[:consumed]
+                for parts, _ in commands:
+                    reply = self.dispatch_command(None, parts)
+                    if isinstance(reply, CommandError):
+                        print(f"Error applying replicated command {parts[0]}: {reply}")
+                self.master_repl_offset += consumed
+            if time.time() - last_ack >= 1:
+                last_ack = time.time()
+                sock.sendall(encode_command(["REPLCONF", "ACK", self.master_repl_offset]))
+
+    def full_sync_from_master(self, link, replid, offset):
+        filename = f"temp-sync-{os.getpid()}.crdb"
         try:
-            with open('redis_snapshot.txt', 'r') as snapshot_file:
-                for line in snapshot_file:
-                    parts = line.strip().split()
-                    if len(parts) >= 3 and parts[0] == "SET":
-                        key, value = parts[1], ' '.join(parts[2:])
-                        self.data[key] = value
-        except FileNotFoundError:
-            pass
+            with open(filename, 'wb') as snapshot_file:
+                link.read_bulk(snapshot_file)
+            functions, _ = parse_commands(link.read_bulk())
+            self.load_binary_snapshot(filename, replace=True)
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+        self.functions = {}
+        for parts, _ in functions:
+            self.dispatch_command(None, parts)
+        self.master_replid, self.master_repl_offset = replid, offset
+        # the old AOF describes the data we just threw away
+        if self.aof_writer is not None and not self.start_aof_rewrite():
+            print("AOF rewrite already in progress, the AOF may not match the synced data until the next one")
+        print(f"Full resync with master {self.master_host}:{self.master_port} done, offset {offset}")
 
-    def load_aof(self):
+    ##################### cluster mode. every node keeps the whole slot table, a command for a key in somebody else's slot
+    # gets MOVED (or ASK while the slot is being migrated). nodes find each other and the slots they serve by asking
+    # every known node for CLUSTER NODES once a second, a node is only believed about its own slots
+
+    def enable_cluster(self, config_file='nodes.conf'):
+        self.cluster_enabled = True
+        self.cluster_config_file = config_file
+        with self.cluster_lock:
+            if os.path.exists(config_file):
+                self.load_cluster_config()
+            else:
+                host = self.host if self.host not in ("", "0.0.0.0") else "127.0.0.1"
+                self.myself = ClusterNode(os.urandom(20).hex(), host, self.port)
+                self.cluster_nodes[self.myself.id] = self.myself
+                self.save_cluster_config()
+        self.data.enable_slot_index()
+        threading.Thread(target=self.cluster_loop, daemon=True).start()
+        print(f"Cluster node {self.myself.id}, {self.cluster_slots_assigned()} slots assigned")
+
+    def cluster_redirect(self, client, spec, keys):
+        # None when this node serves the keys, otherwise the MOVED/ASK/CROSSSLOT/... error for the client
+        asking = client.asking or spec.name == "RESTORE-ASKING"
+        client.asking = False
+        if not keys:
+            return None
+        slot = key_hash_slot(keys[0])
+        for key in keys[1:]:
+            if key_hash_slot(key) != slot:
+                return CommandError("CROSSSLOT Keys in request don't hash to the same slot")
+        owner = self.slots[slot]
+        if owner is self.myself:
+            target = self.migrating_slots.get(slot)
+            if target is not None:
+                # keys that are gone already moved to target, new keys are created there too
+                missing = sum(1 for key in keys if key not in self.data)
+                if missing == len(keys):
+                    return CommandError(f"ASK {slot} {target.address()}")
+                if missing:
+                    return CommandError("TRYAGAIN Multiple keys request during rehashing of slot")
+            return None
+        if asking and slot in self.importing_slots:
+            return None
+        if owner is None:
+            return CommandError("CLUSTERDOWN Hash slot not served")
+        return CommandError(f"MOVED {slot} {owner.address()}")
+
+    @command("ASKING", 1, "fast", 0, 0, 0)
+    def handle_asking(self, client, parts):
+        if not self.cluster_enabled:
+            return CommandError("ERROR: This instance has cluster support disabled")
+        client.asking = True
+        return SimpleString("OK")
+
+    @command("CLUSTER", -2, "admin stale", 0, 0, 0)
+    def handle_cluster(self, client, parts):
+        if not self.cluster_enabled:
+            return CommandError("ERROR: This instance has cluster support disabled")
+        subcommand, args = parts[1].upper(), parts[2:]
+        if subcommand == "KEYSLOT" and len(args) == 1:
+            return key_hash_slot(args[0])
+        if subcommand == "MYID" and not args:
+            return self.myself.id
+        if subcommand == "INFO" and not args:
+            return self.cluster_info()
+        if subcommand == "NODES" and not args:
+            return self.cluster_nodes_text()
+        if subcommand == "SLOTS" and not args:
+            return self.cluster_slots_reply()
+        if subcommand == "COUNTKEYSINSLOT" and len(args) == 1:
+            return len(self.data.keys_in_slot(self.parse_slot(args[0])))
+        if subcommand == "GETKEYSINSLOT" and len(args) == 2:
+            count = self.parse_int(args[1])
+            if count < 0:
+                return CommandError("ERROR: Invalid number of keys")
+            return self.data.keys_in_slot(self.parse_slot(args[0]), count)
+        if subcommand == "MEET" and len(args) == 2:
+            with self.cluster_lock:
+                self.cluster_meets.add((args[0], self.parse_int(args[1])))
+            return SimpleString("OK")
+        with self.cluster_lock:
+            if subcommand in ("ADDSLOTS", "DELSLOTS") and args:
+                reply = self.cluster_assign_slots([self.parse_slot(arg) for arg in args], subcommand == "ADDSLOTS")
+            elif subcommand in ("ADDSLOTSRANGE", "DELSLOTSRANGE") and args and len(args) % 2 == 0:
+                slots = []
+                for i in range(0, len(args), 2):
+                    slots.extend(range(self.parse_slot(args[i]), self.parse_slot(args[i + 1]) + 1))
+                reply = self.cluster_assign_slots(slots, subcommand == "ADDSLOTSRANGE")
+            elif subcommand == "SETSLOT" and len(args) in (2, 3):
+                reply = self.cluster_setslot(self.parse_slot(args[0]), args[1].upper(), args[2:])
+            elif subcommand == "SET-CONFIG-EPOCH" and len(args) == 1:
+                epoch = self.parse_int(args[0])
+                if epoch < 0:
+                    return CommandError(f"ERROR: Invalid config epoch specified: {epoch}")
+                if self.myself.config_epoch:
+                    return CommandError("ERROR: Node config epoch is already non-zero")
+                self.myself.config_epoch = epoch
+                self.current_epoch = max(self.current_epoch, epoch)
+                reply = SimpleString("OK")
+            else:
+                return CommandError(f"ERROR: unknown CLUSTER subcommand or wrong number of arguments for '{parts[1]}'")
+            if not isinstance(reply, CommandError):
+                self.save_cluster_config()
+            return reply
+
+    def parse_slot(self, value):
+        slot = self.parse_int(value)
+        if not 0 <= slot < CLUSTER_SLOTS:
+            raise CommandError("ERROR: Invalid or out of range slot")
+        return slot
+
+    def cluster_assign_slots(self, slots, add):
+        # caller holds cluster_lock. ADDSLOTS claims free slots for this node, DELSLOTS gives slots up
+        for slot in slots:
+            if add and self.slots[slot] is not None:
+                return CommandError(f"ERROR: Slot {slot} is already busy")
+            if not add and self.slots[slot] is None:
+                return CommandError(f"ERROR: Slot {slot} is already unassigned")
+        for slot in slots:
+            self.slots[slot] = self.myself if add else None
+            self.importing_slots.pop(slot, None)
+            self.migrating_slots.pop(slot, None)
+        return SimpleString("OK")
+
+    def cluster_setslot(self, slot, action, args):
+        # caller holds cluster_lock. SETSLOT slot MIGRATING|IMPORTING|NODE node-id, SETSLOT slot STABLE
+        if action == "STABLE" and not args:
+            self.migrating_slots.pop(slot, None)
+            self.importing_slots.pop(slot, None)
+            return SimpleString("OK")
+        if action not in ("MIGRATING", "IMPORTING", "NODE") or len(args) != 1:
+            return CommandError("ERROR: Invalid CLUSTER SETSLOT action or number of arguments")
+        node = self.cluster_nodes.get(args[0])
+        if node is None:
+            return CommandError(f"ERROR: I don't know about node {args[0]}")
+        if action == "MIGRATING":
+            if self.slots[slot] is not self.myself:
+                return CommandError(f"ERROR: I'm not the owner of hash slot {slot}")
+            self.migrating_slots[slot] = node
+        elif action == "IMPORTING":
+            if self.slots[slot] is self.myself:
+                return CommandError(f"ERROR: I'm already the owner of hash slot {slot}")
+            self.importing_slots[slot] = node
+        else:
+            if self.slots[slot] is self.myself and node is not self.myself and self.data.keys_in_slot(slot, 1):
+                return CommandError(f"ERROR: Can't assign hashslot {slot} to a different node while I still hold "
+                                    "keys for this hash slot.")
+            self.migrating_slots.pop(slot, None)
+            if node is self.myself and self.importing_slots.pop(slot, None) is not None:
+                # the end of a migration, a new epoch makes this node's claim beat the old owner's everywhere
+                self.current_epoch += 1
+                self.myself.config_epoch = self.current_epoch
+            self.slots[slot] = node
+        return SimpleString("OK")
+
+    def cluster_slots_assigned(self):
+        return sum(1 for owner in self.slots if owner is not None)
+
+    def cluster_info(self):
+        assigned = self.cluster_slots_assigned()
+        owners = {owner.id for owner in self.slots if owner is not None}
+        lines = ["cluster_enabled:1",
+                 f"cluster_state:{'ok' if assigned == CLUSTER_SLOTS else 'fail'}",
+                 f"cluster_slots_assigned:{assigned}",
+                 f"cluster_known_nodes:{len(self.cluster_nodes)}",
+                 f"cluster_size:{len(owners)}",
+                 f"cluster_current_epoch:{self.current_epoch}",
+                 f"cluster_my_epoch:{self.myself.config_epoch}"]
+        return "\r\n".join(lines) + "\r\n"
+
+    def slot_ranges_by_node(self):
+        slots = {}
+        for slot, owner in enumerate(self.slots):
+            if owner is not None:
+                slots.setdefault(owner.id, []).append(slot)
+        return {node_id: slot_ranges(node_slots) for node_id, node_slots in slots.items()}
+
+    def cluster_nodes_text(self):
+        # redis' CLUSTER NODES format, one line per node, also what nodes.conf holds
+        ranges = self.slot_ranges_by_node()
+        lines = []
+        for node in list(self.cluster_nodes.values()):
+            flags = "myself,master" if node is self.myself else "master" if node.connected else "master,fail?"
+            items = [f"{first}-{last}" if first != last else str(first) for first, last in ranges.get(node.id, ())]
+            if node is self.myself:
+                items += [f"[{slot}->-{target.id}]" for slot, target in list(self.migrating_slots.items())]
+                items += [f"[{slot}-<-{source.id}]" for slot, source in list(self.importing_slots.items())]
+            lines.append(" ".join([node.id, f"{node.address()}@{node.port + 10000}", flags, "-", "0",
+                                   str(node.pong_received), str(node.config_epoch),
+                                   "connected" if node.connected else "disconnected"] + items))
+        return "\n".join(lines) + "\n"
+
+    def cluster_slots_reply(self):
+        reply = []
+        for node_id, ranges in self.slot_ranges_by_node().items():
+            node = self.cluster_nodes[node_id]
+            reply.extend([first, last, [node.host, node.port, node.id]] for first, last in ranges)
+        return sorted(reply)
+
+    def save_cluster_config(self):
+        # caller holds cluster_lock
+        temp_filename = f"{self.cluster_config_file}.tmp-{os.getpid()}"
+        with open(temp_filename, 'w') as config_file:
+            config_file.write(self.cluster_nodes_text())
+            config_file.write(f"vars currentEpoch {self.current_epoch}\n")
+        os.replace(temp_filename, self.cluster_config_file)
+
+    def load_cluster_config(self):
+        # caller holds cluster_lock
+        with open(self.cluster_config_file) as config_file:
+            lines = [line.split() for line in config_file if line.strip()]
+        for fields in lines:
+            if fields[0] == "vars":
+                self.current_epoch = int(fields[fields.index("currentEpoch") + 1])
+                continue
+            host, port = fields[1].split("@")[0].rsplit(":", 1)
+            node = ClusterNode(fields[0], host, int(port), int(fields[6]))
+            self.cluster_nodes[node.id] = node
+            if "myself" in fields[2].split(","):
+                self.myself = node
+                node.port = self.port
+        for fields in lines:
+            if fields[0] == "vars":
+                continue
+            for item in fields[8:]:
+                if item.startswith("["):
+                    slot, direction, other = re.match(r"\[(\d+)-([<>])-(\w+)\]", item).groups()
+                    table = self.migrating_slots if direction == ">" else self.importing_slots
+                    table[int(slot)] = self.cluster_nodes[other]
+                    continue
+                first, _, last = item.partition("-")
+                for slot in range(int(first), int(last or first) + 1):
+                    self.slots[slot] = self.cluster_nodes[fields[0]]
+
+    def cluster_loop(self):
+        # the cluster thread: pending MEETs, then one CLUSTER NODES from every other node
+        connections = {}  # node id -> ServerConnection, only this thread uses them
+        while True:
+            with self.cluster_lock:
+                meets, self.cluster_meets = self.cluster_meets, set()
+            for host, port in meets:
+                self.cluster_meet(host, port)
+            for node in list(self.cluster_nodes.values()):
+                if node is self.myself:
+                    continue
+                try:
+                    connection = connections.get(node.id)
+                    if connection is None:
+                        connection = connections[node.id] = ServerConnection.connect(node.host, node.port)
+                    reply = connection.call("CLUSTER", "NODES")
+                    if isinstance(reply, CommandError):
+                        raise ProtocolError(str(reply))
+                    self.merge_cluster_view(node, reply)
+                except (OSError, ProtocolError, ValueError) as e:
+                    if node.connected:
+                        print(f"Cluster node {node.id} at {node.address()} is not reachable: {e}")
+                    node.connected = False
+                    connection = connections.pop(node.id, None)
+                    if connection is not None:
+                        connection.close()
+                    continue
+                if not node.connected:
+                    print(f"Cluster node {node.id} at {node.address()} is reachable again")
+                node.connected = True
+                node.pong_received = int(time.time() * 1000)
+            time.sleep(self.cluster_poll_interval)
+
+    def cluster_meet(self, host, port):
         try:
-            with open(self.aof_filename, 'r') as aof_file:
-                commands = aof_file.readlines()
-                for command in commands:
-                    self.handle_command(command.strip())
-        except FileNotFoundError:
-            pass
+            connection = ServerConnection.connect(host, port)
+            try:
+                node_id = connection.call("CLUSTER", "MYID")
+                if isinstance(node_id, CommandError):
+                    raise ProtocolError(str(node_id))
+                if node_id == self.myself.id:
+                    return
+                with self.cluster_lock:
+                    known = node_id in self.cluster_nodes
+                    if not known:
+                        self.cluster_nodes[node_id] = ClusterNode(node_id, host, port)
+                        self.save_cluster_config()
+                if not known:
+                    # so the other side polls us too, it already knows us by the time it sends its MEET back
+                    connection.call("CLUSTER", "MEET", self.myself.host, self.myself.port)
+                    print(f"Met cluster node {node_id} at {host}:{port}")
+            finally:
+                connection.close()
+        except (OSError, ProtocolError, ValueError) as e:
+            print(f"CLUSTER MEET {host}:{port} failed: {e}")
 
-    def handle_command(self, command):
-        parts = command.strip().split()
-        cmd = parts[0].upper()
-
-        if cmd == "SET":
-            key, value = parts[1], ' '.join(parts[2:])
-            with self.lock:
-                self.data[key] = value
-        elif cmd == "DEL":
-            key = parts[1]
-            with self.lock:
-                if key in self.data:
-                    del self.data[key]
+    def merge_cluster_view(self, sender, text):
+        # nodes we did not know yet are added, and the sender's own slots are taken over where its config epoch is
+        # newer than the one of the node we think serves them
+        changed = False
+        with self.cluster_lock:
+            for line in text.splitlines():
+                fields = line.split()
+                if len(fields) < 8 or fields[0] == self.myself.id:
+                    continue
+                node = self.cluster_nodes.get(fields[0])
+                if node is None:
+                    host, port = fields[1].split("@")[0].rsplit(":", 1)
+                    node = self.cluster_nodes[fields[0]] = ClusterNode(fields[0], host, int(port), int(fields[6]))
+                    changed = True
+                if "myself" not in fields[2].split(",") or node is not sender:
+                    continue
+                epoch = int(fields[6])
+                if node.config_epoch != epoch:
+                    node.config_epoch = epoch
+                    changed = True
+                self.current_epoch = max(self.current_epoch, epoch)
+                for item in fields[8:]:
+                    if item.startswith("["):
+                        continue
+                    first, _, last = item.partition("-")
+                    for slot in range(int(first), int(last or first) + 1):
+                        owner = self.slots[slot]
+                        if owner is not node and (owner is None or owner.config_epoch < epoch):
+                            self.slots[slot] = node
+                            self.migrating_slots.pop(slot, None)
+                            self.importing_slots.pop(slot, None)
+                            changed = True
+            if changed:
+                self.save_cluster_config()
 
-    def enable_aof(self):
-        self.aof_enabled = True
+    ##################### DUMP/RESTORE/MIGRATE, a key moves between nodes as its snapshot entry
 
-    def disable_aof(self):
-        self.aof_enabled = False
+    def dump_payload(self, key, value):
+        # the key's snapshot entry plus the snapshot version and a CRC32, so RESTORE can tell a damaged payload
+        data = encode_snapshot_entries([(key, value, None)]) + bytes([SNAPSHOT_VERSION])
+        return (data + struct.pack("<I", zlib.crc32(data))).decode(ENCODING, ENCODING_ERRORS)
+
+    def load_payload(self, payload):
+        data = payload.encode(ENCODING, ENCODING_ERRORS)
+        if len(data) < 6 or data[-5] != SNAPSHOT_VERSION or zlib.crc32(data[:-4]) != struct.unpack("<I", data[-4:])[0]:
+            raise CommandError("ERROR: DUMP payload version or checksum are wrong")
+        try:
+            _, value, _ = next(decode_snapshot_entries(data, 0, len(data) - 5))
+        except (StopIteration, struct.error, IndexError, SnapshotError):
+            raise CommandError("ERROR: Bad data format")
+        return value
 
-    def append_to_aof(self, command):
-        if self.aof_enabled:
-            with open(self.aof_filename, 'a') as aof_file:
-                aof_file.write(command + '\n')
+    @command("DUMP", 2, "readonly")
+    def handle_dump(self, client, parts):
+        key = parts[1]
+        with self.data.lock_for(key):
+            value = self.data.get(key)
+            return self.dump_payload(key, value) if value is not None else None
 
-    def recover_from_aof(self):
-        if self.aof_enabled:
+    @command("RESTORE-ASKING", -4, "write denyoom")
+    @command("RESTORE", -4, "write denyoom")
+    def handle_restore(self, client, parts):
+        # RESTORE key ttl payload [REPLACE] [ABSTTL], ttl in milliseconds and 0 = no TTL
+        key = parts[1]
+        ttl = self.parse_int(parts[2])
+        options = {option.upper() for option in parts[4:]}
+        if not options <= {"REPLACE", "ABSTTL"}:
+            return CommandError("ERROR: syntax error")
+        if ttl < 0:
+            return CommandError("ERROR: Invalid TTL value, must be >= 0")
+        value = self.load_payload(parts[3])
+        expire_at = None
+        if ttl:
+            expire_at = ttl / 1000 if "ABSTTL" in options else time.time() + ttl / 1000
+        with self.data.lock_for(key):
+            if key in self.data and "REPLACE" not in options:
+                return CommandError("BUSYKEY Target key name already exists.")
+            self.clear_expiry(key)
+            if expire_at is not None and expire_at <= time.time():
+                if self.data.pop(key, None) is not None:
+                    self.append_to_aof(["DEL", key])
+                return SimpleString("OK")
+            self.data[key] = value
+            if expire_at is not None:
+                self.set_expiry(key, expire_at)
+            # logged with an absolute TTL, a replay later must not make the key live longer
+            self.append_to_aof(["RESTORE", key, str(int(expire_at * 1000)) if expire_at else "0", parts[3],
+                                "REPLACE", "ABSTTL"])
+            if isinstance(value, collections.deque):
+                self.signal_key_ready(key)
+        return SimpleString("OK")
+
+    @command("MIGRATE", -6, "write", 0, 0, 0)
+    def handle_migrate(self, client, parts):
+        # MIGRATE host port key|"" destination-db timeout [COPY] [REPLACE] [KEYS key ...]. the keys stay locked from
+        # the dump to the delete, so nothing changes them on the way and no command sees them on both nodes
+        host, port, timeout = parts[1], self.parse_int(parts[2]), self.parse_int(parts[5])
+        keys = [parts[3]] if parts[3] else []
+        copy = replace = False
+        for i in range(6, len(parts)):
+            option = parts[i].upper()
+            if option == "COPY":
+                copy = True
+            elif option == "REPLACE":
+                replace = True
+            elif option == "KEYS" and not parts[3]:
+                keys = parts[i + 1:]
+                break
+            else:
+                return CommandError("ERROR: syntax error")
+        if not keys:
+            return CommandError("ERROR: syntax error")
+        for key in keys:
+            self.expire_if_needed(key)
+        with self.data.locked(keys), self.memory_accounting(keys):
+            records = []
+            moved = []
+            for key in dict.fromkeys(keys):
+                value = self.data.get(key)
+                if value is None:
+                    continue
+                expire_at = self.ttl_data.get(key)
+                ttl = max(1, int((expire_at - time.time()) * 1000)) if expire_at is not None else 0
+                records.append(encode_command(["RESTORE-ASKING", key, ttl, self.dump_payload(key, value)]
+                                              + (["REPLACE"] if replace else [])))
+                moved.append(key)
+            if not moved:
+                return SimpleString("NOKEY")
             try:
-                with open(self.aof_filename, 'r') as aof_file:
-                    for line in aof_file:
-                        self.handle_command(line)
+                connection = ServerConnection.connect(host, port, timeout / 1000 or 1)
+                try:
+                    connection.socket.sendall(b"".join(records))
+                    replies = [connection.read_reply() for _ in records]
+                finally:
+                    connection.close()
+            except (OSError, ProtocolError, ValueError) as e:
+                return CommandError(f"IOERR error or timeout migrating to target instance: {e}")
+            for reply in replies:
+                if isinstance(reply, CommandError):
+                    return CommandError(f"ERROR: Target instance replied with error: {reply}")
+            if not copy:
+                self.delete_keys(moved, "DEL")
+                for key in moved:
+                    self.signal_modified_key(key)
+        return SimpleString("OK")
+
+    ##################### INFO and the prometheus endpoint, both read the same sections
+
+    @command("INFO", -1, "loading stale", 0, 0, 0)
+    def handle_info(self, client, parts):
+        # INFO [section ...], without a section everything but commandstats like redis, 'all' adds commandstats
+        requested = [section.lower() for section in parts[1:]] or ["default"]
+        sections = []
+        for section in INFO_SECTIONS:
+            if (section in requested or "all" in requested or "everything" in requested
+                    or ("default" in requested and section != "commandstats")):
+                fields = self.info_fields(section)
+                lines = [f"# {INFO_SECTIONS[section]}"] + [f"{name}:{value}" for name, value in fields]
+                sections.append("\r\n".join(lines) + "\r\n")
+        return "\r\n".join(sections)
+
+    def info_fields(self, section):
+        # (name, value) pairs of one INFO section
+        if section == "server":
+            uptime = int(time.time() - self.start_time)
+            return [("crowredis_mode", "cluster" if self.cluster_enabled else "standalone"),
+                    ("io_mode", self.mode), ("python_version", sys.version.split()[0]),
+                    ("process_id", os.getpid()), ("tcp_port", self.port),
+                    ("uptime_in_seconds", uptime), ("uptime_in_days", uptime // 86400),
+                    ("shards", len(self.data.shards))]
+        if section == "clients":
+            clients = list(self.clients)
+            with self.blocked_lock:
+                blocked = len({id(waiter.client) for waiters in self.blocked_keys.values() for waiter in waiters})
+            return [("connected_clients", len(clients)), ("blocked_clients", blocked),
+                    ("pubsub_clients", sum(1 for client in clients if client.channels or client.patterns)),
+                    ("watching_clients", sum(1 for client in clients if client.watched))]
+        if section == "memory":
+            rss = process_rss()
+            # the per key estimate is only kept up to date while a maxmemory limit is set
+            fields = [("used_memory", self.used_memory() if self.maxmemory else rss),
+                      ("used_memory_rss", rss)]
+            if self.maxmemory:
+                fields.append(("used_memory_dataset", self.used_memory()))
+            return fields + [("maxmemory", self.maxmemory), ("maxmemory_policy", self.maxmemory_policy)]
+        if section == "persistence":
+            writer = self.aof_writer
+            return [("rdb_changes_since_last_save", self.dirty),
+                    ("rdb_bgsave_in_progress", int(self.bgsave_in_progress)),
+                    ("rdb_last_save_time", int(self.last_save_time)),
+                    ("rdb_last_bgsave_status", self.last_bgsave_status),
+                    ("aof_enabled", int(self.aof_enabled)),
+                    ("aof_rewrite_in_progress", int(self.aof_rewrite_in_progress)),
+                    ("aof_current_size", writer.size if writer is not None else 0),
+                    ("aof_base_size", writer.base_size if writer is not None else 0)]
+        if section == "stats":
+            return [("total_connections_received", self.total_connections_received),
+                    ("total_commands_processed", sum(spec.calls for spec in COMMANDS.values())),
+                    ("total_net_input_bytes", self.net_input_bytes),
+                    ("total_net_output_bytes", self.net_output_bytes),
+                    ("expired_keys", self.expired_keys), ("evicted_keys", self.evicted_keys),
+                    ("keyspace_hits", self.keyspace_hits), ("keyspace_misses", self.keyspace_misses),
+                    ("pubsub_channels", len(self.pubsub_channels)), ("pubsub_patterns", self.pubsub_patterns.count),
+                    ("total_error_replies", sum(spec.failed_calls + spec.rejected_calls for spec in COMMANDS.values()))]
+        if section == "replication":
+            if self.master_host is not None:
+                return [("role", "slave"), ("master_host", self.master_host), ("master_port", self.master_port),
+                        ("master_link_status", self.master_link_status),
+                        ("slave_repl_offset", self.master_repl_offset)]
+            with self.repl_lock:
+                replicas = [(link.client.address[0], link.client.listening_port or link.client.address[1],
+                             link.ack_offset) for link in self.replicas]
+                backlog = self.repl_backlog
+            fields = [("role", "master"), ("connected_slaves", len(replicas))]
+            fields += [(f"slave{i}", f"ip={host},port={port},state=online,offset={offset}")
+                       for i, (host, port, offset) in enumerate(replicas)]
+            return fields + [("master_replid", self.replid), ("master_repl_offset", self.master_repl_offset),
+                             ("repl_backlog_active", int(backlog is not None)),
+                             ("repl_backlog_size", backlog.size if backlog is not None else self.repl_backlog_size),
+                             ("repl_backlog_histlen", backlog.length if backlog is not None else 0)]
+        if section == "cpu":
+            times = os.times()
+            return [("used_cpu_sys", round(times.system, 6)), ("used_cpu_user", round(times.user, 6))]
+        if section == "cluster":
+            return [("cluster_enabled", int(self.cluster_enabled))]
+        if section == "keyspace":
+            keys = len(self.data)
+            return [("db0", f"keys={keys},expires={len(self.ttl_data)}")] if keys else []
+        if section == "commandstats":
+            return [(f"cmdstat_{spec.name.lower()}",
+                     f"calls={spec.calls},usec={spec.nanoseconds // 1000},"
+                     f"usec_per_call={spec.nanoseconds / 1000 / spec.calls if spec.calls else 0:.2f},"
+                     f"rejected_calls={spec.rejected_calls},failed_calls={spec.failed_calls}")
+                    for spec in COMMANDS.values() if spec.calls or spec.rejected_calls]
+        return []
+
+    def prometheus_metrics(self):
+        # the numeric INFO fields in the prometheus text format, commandstats and the keyspace as labeled series
+        lines = []
+        for section in INFO_SECTIONS:
+            if section in ("commandstats", "keyspace"):
+                continue
+            for name, value in self.info_fields(section):
+                if not isinstance(value, (int, float)) or name in PROMETHEUS_SKIPPED:
+                    continue
+                metric, kind = prometheus_name(name)
+                lines += [f"# TYPE {metric} {kind}", f"{metric} {value}"]
+        lines += ["# TYPE crowredis_db_keys gauge", f'crowredis_db_keys{{db="db0"}} {len(self.data)}',
+                  "# TYPE crowredis_db_keys_expiring gauge", f'crowredis_db_keys_expiring{{db="db0"}} {len(self.ttl_data)}']
+        specs = [spec for spec in COMMANDS.values() if spec.calls or spec.rejected_calls]
+        for metric, kind, value in (("crowredis_commands_total", "counter", lambda spec: spec.calls),
+                                    ("crowredis_commands_duration_seconds_total", "counter", lambda spec: spec.nanoseconds / 1e9),
+                                    ("crowredis_commands_rejected_calls_total", "counter", lambda spec: spec.rejected_calls),
+                                    ("crowredis_commands_failed_calls_total", "counter", lambda spec: spec.failed_calls)):
+            lines.append(f"# TYPE {metric} {kind}")
+            lines += [f'{metric}{{cmd="{spec.name.lower()}"}} {value(spec)}' for spec in specs]
+        return "\n".join(lines) + "\n"
+
+    def start_metrics_server(self, port):
+        # prometheus scrapes GET /metrics, served by its own threads so a scrape never waits for the event loop
+        self.metrics_server = http.server.ThreadingHTTPServer((self.host, port), MetricsRequestHandler)
+        self.metrics_server.redis_server = self
+        threading.Thread(target=self.metrics_server.serve_forever, daemon=True).start()
+        print(f"Metrics on http://{self.host}:{port}/metrics")
 
-            except FileNotFoundError:
-                pass
-            
-################################ ayo, this is to handle those complex transactions, dont you dare mess this up 
 
-    def handle_transaction(self, client_socket):
-        if self.in_transaction:
-            client_socket.send(b"ERROR: Nested transactions are not supported\n")
+############# metrics helpers #################################################################################################
+
+INFO_SECTIONS = {"server": "Server", "clients": "Clients", "memory": "Memory", "persistence": "Persistence",
+                 "stats": "Stats", "replication": "Replication", "cpu": "CPU", "cluster": "Cluster",
+                 "keyspace": "Keyspace", "commandstats": "Commandstats"}
+# INFO fields that only ever go up, prometheus counters, the rest are gauges
+PROMETHEUS_COUNTERS = {"total_connections_received", "total_commands_processed", "total_net_input_bytes",
+                       "total_net_output_bytes", "expired_keys", "evicted_keys", "keyspace_hits", "keyspace_misses",
+                       "total_error_replies", "used_cpu_sys", "used_cpu_user"}
+PROMETHEUS_SKIPPED = {"process_id", "tcp_port", "uptime_in_days"}  # numbers, but nothing to graph
+
+
+def prometheus_name(field):
+    # INFO field -> (metric name, type), counters end in _total like the prometheus naming rules want
+    if field not in PROMETHEUS_COUNTERS:
+        return f"crowredis_{field}", "gauge"
+    if field.startswith("total_"):
+        field = field[len("total_"):]
+    return f"crowredis_{field}_total", "counter"
+
+
+def process_rss():
+    # resident memory of the server process in bytes, from /proc where there is one, else the peak from getrusage
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else 0
+        return peak if sys.platform == "darwin" else peak * 1024  # bytes on macOS, kilobytes elsewhere
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
             return
+        body = self.server.redis_server.prometheus_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-        self.in_transaction = True
-        self.transaction_commands = []
-        self.current_transaction = []  # Initialize the current transaction
+    def log_message(self, format, *args):
+        pass  # a scrape every few seconds would flood the server's output
 
-        client_socket.send(b"OK\n")
 
-        while True:
-            request = client_socket.recv(1024).decode('utf-8')
-            if not request:
-                break
+############# cluster admin, what redis-cli --cluster does: make a cluster out of empty nodes, move slots between nodes #####
 
-            parts = request.strip().split()
-            command = parts[0].upper()
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
 
-            if command == "EXEC":
-                print("Received EXEC command")
-                # Execute the transaction commands
-                result = self.execute_transaction()
-                if result != "ERROR: Transaction contains unsupported commands\n":
-                    client_socket.send(result.encode('utf-8'))
-                    print(f"Sent result: {result}")
-                else:
-                    # Rollback the current transaction and discard it
-                    self.transaction_commands = []
-                    self.current_transaction = []
-                    client_socket.send(b"ERROR: Transaction failed and discarded\n")
-                    self.in_transaction = False
-                return
-            elif command == "DISCARD":
-                print("Received DISCARD command")
-                # Discard the current transaction
-                self.transaction_commands = []
-                self.current_transaction = []
-                client_socket.send(b"OK\n")
-                self.in_transaction = False
-                return
-            elif command in ["LPUSH", "RPUSH", "LPOP", "RPOP"]:
-                print(f"Received transaction command: {request}")
-                # Add the command to the transaction
-                self.transaction_commands.append(request)
-                self.current_transaction.append(request)
-            else:
-                client_socket.send(b"ERROR: Transaction contains unsupported commands\n")
 
+def checked(reply):
+    if isinstance(reply, CommandError):
+        raise reply
+    return reply
 
-    def execute_transaction(self,client_socket):
-        if not self.in_transaction:
-            return "NO TRANSACTION\n"
 
-        result = ""
-        with self.lock:
-            for command in self.transaction_commands:
-                parts = command.strip().split()
-                cmd = parts[0].upper()
+def cluster_create(addresses):
+    # the slots are split evenly, every node gets its own config epoch, and the first node meets the others
+    connections = [ServerConnection.connect(*parse_address(address)) for address in addresses]
+    for i, connection in enumerate(connections):
+        first, last = i * CLUSTER_SLOTS // len(connections), (i + 1) * CLUSTER_SLOTS // len(connections) - 1
+        checked(connection.call("CLUSTER", "ADDSLOTSRANGE", first, last))
+        checked(connection.call("CLUSTER", "SET-CONFIG-EPOCH", i + 1))
+        print(f"{addresses[i]}: slots {first}-{last}")
+    for address in addresses[1:]:
+        checked(connections[0].call("CLUSTER", "MEET", *parse_address(address)))
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        infos = [checked(connection.call("CLUSTER", "INFO")) for connection in connections]
+        if all("cluster_state:ok" in info and f"cluster_known_nodes:{len(addresses)}" in info for info in infos):
+            print(f"Cluster of {len(addresses)} nodes is up")
+            return 0
+        time.sleep(0.5)
+    print("Nodes did not agree on the cluster within 30 seconds, check CLUSTER NODES on each of them")
+    return 1
 
-                if cmd == "DISCARD":
-                # Rollback the current transaction and discard it
-                    self.transaction_commands = []
-                    self.current_transaction = []  # Add this line
-                    client_socket.send(b"DISCARDED\n")
-                    self.in_transaction = False
-                    return
-                elif cmd == "SET":
-                    key, value = parts[1], ' '.join(parts[2:])
-                    self.data[key] = value
-                elif cmd == "GET":
-                    key = parts[1]
-                    value = self.data.get(key, "nil")
-                    result += f"{value}\n"
-                elif cmd == "DEL":
-                    key = parts[1]
-                    if key in self.data:
-                        del self.data[key]
-                elif cmd == "LPUSH":
-                    key, *values = parts[1:]
-                    if key not in self.data:
-                        self.data[key] = []
-                    self.data[key] = values + self.data[key]
-                elif cmd == "RPUSH":
-                    key, *values = parts[1:]
-                    if key not in self.data:
-                        self.data[key] = []
-                    self.data[key].extend(values)
-                elif cmd == "LPOP":
-                    key = parts[1]
-                    if key in self.data and self.data[key]:
-                        popped_value = self.data[key].pop(0)
-                        result += f"{popped_value}\n"
-                elif cmd == "RPOP":
-                    key = parts[1]
-                    if key in self.data and self.data[key]:
-                        popped_value = self.data[key].pop()
-                        result += f"{popped_value}\n"
-                else:
-                    return "ERROR: Transaction contains unsupported commands\n"
 
-        self.transaction_commands = []
-        self.current_transaction = []  # Clear current transaction
-        return result
-    
-    ##################### funtions for LPUSH,RPUSH,LPOP,RPOP,LRANGE with flages , ^^w^^
+def cluster_reshard(first, last, target_address):
+    # moves slots first..last to the target node, one slot at a time the way redis does it: IMPORTING on the target,
+    # MIGRATING on the owner, MIGRATE the keys in batches, then SETSLOT NODE everywhere. clients keep working,
+    # they get ASK for keys that already moved
+    target = ServerConnection.connect(*parse_address(target_address))
+    target_id = checked(target.call("CLUSTER", "MYID"))
+    owners = {}
+    for range_first, range_last, (host, port, node_id) in checked(target.call("CLUSTER", "SLOTS")):
+        for slot in range(max(range_first, first), min(range_last, last) + 1):
+            owners[slot] = (host, port, node_id)
+    nodes = [line.split() for line in checked(target.call("CLUSTER", "NODES")).splitlines()]
+    connections = {target_id: target}
+
+    def connection_to(node_id, host, port):
+        if node_id not in connections:
+            connections[node_id] = ServerConnection.connect(host, port)
+        return connections[node_id]
+    target_host, target_port = parse_address(target_address)
+    moved_slots = moved_keys = 0
+    for slot in range(first, last + 1):
+        if slot not in owners:
+            print(f"Slot {slot} is not served by any node, skipped")
+            continue
+        host, port, source_id = owners[slot]
+        if source_id == target_id:
+            continue
+        source = connection_to(source_id, host, port)
+        checked(target.call("CLUSTER", "SETSLOT", slot, "IMPORTING", source_id))
+        checked(source.call("CLUSTER", "SETSLOT", slot, "MIGRATING", target_id))
+        while True:
+            keys = checked(source.call("CLUSTER", "GETKEYSINSLOT", slot, 100))
+            if not keys:
+                break
+            checked(source.call("MIGRATE", target_host, target_port, "", 0, 5000, "REPLACE", "KEYS", *keys))
+            moved_keys += len(keys)
+        # the target first, its new epoch is what makes the other nodes switch over
+        checked(target.call("CLUSTER", "SETSLOT", slot, "NODE", target_id))
+        checked(source.call("CLUSTER", "SETSLOT", slot, "NODE", target_id))
+        for fields in nodes:
+            if fields[0] not in (target_id, source_id):
+                try:
+                    connection_to(fields[0], *parse_address(fields[1].split("@")[0])).call(
+                        "CLUSTER", "SETSLOT", slot, "NODE", target_id)
+                except OSError:
+                    pass  # an unreachable node learns it from the target later
+        moved_slots += 1
+    print(f"Moved {moved_slots} slots and {moved_keys} keys to {target_address}")
+    return 0
 
-    def handle_lpush(self, client_socket, parts):
-        if len(parts) >= 3:
-            key = parts[1]
-            values = parts[2:]
-            with self.lock:
-                if key not in self.data:
-                    self.data[key] = []
-                self.data[key] = values + self.data[key]
-                self.append_to_aof(f"LPUSH {key} {' '.join(values)}")
-            client_socket.send(b"OK\n")
-        else:
-            client_socket.send(b"Invalid LPUSH command\n")
-
-    def handle_rpush(self, client_socket, parts):
-        if len(parts) >= 3:
-            key = parts[1]
-            values = parts[2:]
-            with self.lock:
-                if key not in self.data:
-                    self.data[key] = []
-                self.data[key].extend(values)
-                self.append_to_aof(f"RPUSH {key} {' '.join(values)}")
-            client_socket.send(b"OK\n")
-        else:
-            client_socket.send(b"Invalid RPUSH command\n")
-
-    def handle_lpop(self, client_socket, parts):
-        if len(parts) == 2:
-            key = parts[1]
-            with self.lock:
-                if key in self.data and self.data[key]:
-                    popped_value = self.data[key].pop(0)
-                    self.append_to_aof(f"LPOP {key}")
-                    client_socket.send(f"{popped_value}\n".encode('utf-8'))
-                else:
-                    client_socket.send(b"nil\n")
-        else:
-            client_socket.send(b"Invalid LPOP command\n")
-
-    def handle_rpop(self, client_socket, parts):
-        if len(parts) == 2:
-            key = parts[1]
-            with self.lock:
-                if key in self.data and self.data[key]:
-                    popped_value = self.data[key].pop()
-                    self.append_to_aof(f"RPOP {key}")
-                    client_socket.send(f"{popped_value}\n".encode('utf-8'))
-                else:
-                    client_socket.send(b"nil\n")
-        else:
-            client_socket.send(b"Invalid RPOP command\n")
-
-    def handle_lrange(self, client_socket, parts):
-        if len(parts) == 4:
-            key = parts[1]
-            start = int(parts[2])
-            stop = int(parts[3])
-            with self.lock:
-                if key in self.data and isinstance(self.data[key], list):
-                    values = self.data[key][start:stop+1]
-                    result = ' '.join(map(str, values))
-                    client_socket.send(f"{result}\n".encode('utf-8'))
-                else:
-                    client_socket.send(b"Invalid LRANGE command\n")
-        else:
-            client_socket.send(b"Invalid LRANGE command\n")
 
 if __name__ == "__main__":
-    redis_server = RedisServer('127.0.0.1', 6381)
+    parser = argparse.ArgumentParser(description="crowRedis server")
+    parser.add_argument("--host", default="127.0.0.1", help="Server hostname (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=6381, help="Server port (default: 6381)")
+    parser.add_argument("--mode", choices=["threaded", "eventloop"], default="threaded",
+                        help="threaded = one thread per client, eventloop = single threaded selector loop (default: threaded)")
+    parser.add_argument("--auto-aof-rewrite-min-size", type=int, default=64 * 1024 * 1024,
+                        help="Smallest AOF size in bytes that can trigger an automatic rewrite (default: 64mb)")
+    parser.add_argument("--shards", type=int, default=16, help="Number of lock striped keyspace shards (default: 16)")
+    parser.add_argument("--maxmemory", type=parse_memory, default=0,
+                        help="Memory limit for the data, like 100mb or 1gb, 0 = no limit (default: 0)")
+    parser.add_argument("--maxmemory-policy", choices=EVICTION_POLICIES, default="noeviction",
+                        help="What to evict once maxmemory is reached (default: noeviction)")
+    parser.add_argument("--maxmemory-samples", type=int, default=5,
+                        help="Keys sampled per eviction, more is closer to exact LRU/LFU but slower (default: 5)")
+    parser.add_argument("--appendfsync", choices=AofWriter.FSYNC_POLICIES, default="everysec",
+                        help="always = fsync before replying, everysec = fsync once a second, no = leave it to the OS (default: everysec)")
+    parser.add_argument("--replicaof", nargs=2, metavar=("HOST", "PORT"),
+                        help="Start as a read only replica of HOST PORT (default: start as a primary)")
+    parser.add_argument("--repl-backlog-size", type=parse_memory, default=1024 * 1024,
+                        help="How much of the write stream is kept for replicas that reconnect (default: 1mb)")
+    parser.add_argument("--cluster-enabled", action="store_true",
+                        help="Run as a cluster node, keys are routed by hash slot (default: off)")
+    parser.add_argument("--cluster-config-file", default="nodes.conf",
+                        help="Where a cluster node keeps its view of the cluster (default: nodes.conf)")
+    parser.add_argument("--cluster-create", nargs="+", metavar="HOST:PORT",
+                        help="Make a cluster out of these running empty cluster nodes and exit")
+    parser.add_argument("--cluster-reshard", nargs=2, metavar=("FIRST-LAST", "HOST:PORT"),
+                        help="Move the slots FIRST-LAST to the cluster node at HOST:PORT and exit")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="Serve the INFO data for prometheus at http://host:PORT/metrics, 0 = off (default: 0)")
+    args = parser.parse_args()
+
+    if args.cluster_create or args.cluster_reshard:
+        try:
+            if args.cluster_create:
+                raise SystemExit(cluster_create(args.cluster_create))
+            first_slot, _, last_slot = args.cluster_reshard[0].partition("-")
+            raise SystemExit(cluster_reshard(int(first_slot), int(last_slot or first_slot), args.cluster_reshard[1]))
+        except (CommandError, ProtocolError, OSError) as e:
+            print(f"Cluster command failed: {e}")
+            raise SystemExit(1)
+
+    redis_server = RedisServer(args.host, args.port, args.shards, args.appendfsync)
+    redis_server.aof_rewrite_min_size = args.auto_aof_rewrite_min_size
+    redis_server.configure_maxmemory(args.maxmemory, args.maxmemory_policy, args.maxmemory_samples)
     redis_server.enable_aof()  # Enable AOF for logging and recovery
     redis_server.recover_from_aof()  # Recover data from the AOF file
-    redis_server.start()
+    redis_server.repl_backlog_size = args.repl_backlog_size
+    if args.replicaof:
+        redis_server.replicate_from(args.replicaof[0], int(args.replicaof[1]))
+    if args.cluster_enabled:
+        redis_server.enable_cluster(args.cluster_config_file)
+    if args.metrics_port:
+        redis_server.start_metrics_server(args.metrics_port)
+    try:
+        redis_server.start(args.mode)
+    finally:
+        redis_server.disable_aof()
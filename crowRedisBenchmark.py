@@ -1,130 +1,289 @@
 import argparse
+import bisect
+import collections
+import contextlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shlex
 import socket
+import subprocess
+import sys
+import tempfile
 import time
-import threading
-import timeit
-from crowRedis import RedisServer
-
-class RedisBenchmark:
-    def __init__(self, host, port, num_clients, num_requests, num_transactions, socket_pool_size):
-        self.host = host
-        self.port = port
-        self.num_clients = num_clients
-        self.num_requests = num_requests
-        self.num_transactions = num_transactions
-        self.socket_pool_size = socket_pool_size
-        self.clients = []
-
-    def run_benchmark(self):
-        for _ in range(self.num_clients):
-            client = RedisClient(self.host, self.port, self.num_requests, self.num_transactions)
-            self.clients.append(client)
-
-        start_time = time.time()
-        threads = []
-
-        for client in self.clients:
-            thread = threading.Thread(target=client.run)
-            threads.append(thread)
-            thread.start()
-
-        for thread in threads:
-            thread.join()
-
-        end_time = time.time()
-        total_time = end_time - start_time
-        total_transactions = self.num_clients * self.num_transactions
-        throughput = total_transactions / total_time  # Transactions per second
-        average_response_time = total_time / total_transactions  # Average response time per transaction
-
-        print(f"Total time taken: {total_time} seconds")
-        print(f"Throughput: {throughput:.2f} transactions per second")
-        print(f"Average response time: {average_response_time:.4f} seconds")
-
-class RedisClient:
-    def __init__(self, host, port, num_requests, num_transactions):
-        self.host = host
-        self.port = port
-        self.num_requests = num_requests
-        self.num_transactions = num_transactions
-
-    def run(self):
-        for _ in range(self.num_transactions):
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-                client_socket.connect((self.host, self.port))
-                self.run_transactions(client_socket)
-
-    def run_transactions(self, client_socket):
-        for _ in range(self.num_requests):
-            self.send_request(client_socket)
-
-    def send_request(self, client_socket):
-        # Implement your request sending logic here
-        pass
-
-def create_socket_pool(redis_server, pool_size):
-    socket_pool = []
-    for _ in range(pool_size):
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((redis_server.host, redis_server.port))
-        socket_pool.append(client_socket)
-    return socket_pool
-
-def benchmark_set(redis_server, socket_pool, num_requests):
-    def set_command():
-        client_socket = socket_pool.pop()
-        request = "SET key value\n"
-        client_socket.send(request.encode('utf-8'))
-        response = client_socket.recv(1024).decode('utf-8')
-        socket_pool.append(client_socket)
-    
-    return timeit.timeit(set_command, number=num_requests)
-
-def benchmark_get(redis_server, socket_pool, num_requests):
-    def get_command():
-        client_socket = socket_pool.pop()
-        request = "GET key\n"
-        client_socket.send(request.encode('utf-8'))
-        response = client_socket.recv(1024).decode('utf-8')
-        socket_pool.append(client_socket)
-    
-    return timeit.timeit(get_command, number=num_requests)
-
-def benchmark_del(redis_server, socket_pool, num_requests):
-    def del_command():
-        client_socket = socket_pool.pop()
-        request = "DEL key\n"
-        client_socket.send(request.encode('utf-8'))
-        response = client_socket.recv(1024).decode('utf-8')
-        socket_pool.append(client_socket)
-    
-    return timeit.timeit(del_command, number=num_requests)
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Redis-like server benchmark")
-    parser.add_argument("--host", default="127.0.0.1", help="Server hostname (default: 127.0.0.1)")
-    parser.add_argument("--port", type=int, default=6381, help="Server port (default: 6381)")
-    parser.add_argument("--num_clients", type=int, default=10, help="Number of concurrent clients")
-    parser.add_argument("--num_requests", type=int, default=1000, help="Number of requests per client")
-    parser.add_argument("--num_transactions", type=int, default=10, help="Number of transactions per client")
-    parser.add_argument("--socket_pool_size", type=int, default=10, help="Socket pool size for SET, GET, DEL benchmark")
+from client import Connection, ReplyError
 
-    args = parser.parse_args()
-    benchmark = RedisBenchmark(args.host, args.port, args.num_clients, args.num_requests, args.num_transactions, args.socket_pool_size)
-    benchmark.run_benchmark()
+# what one operation of a workload mix sends, key is picked by the key distribution, value is value-size bytes
+OPERATIONS = {
+    "get": lambda key, value: ("GET", key),
+    "set": lambda key, value: ("SET", key, value),
+    "incr": lambda key, value: ("INCR", "counter:" + key),
+    "del": lambda key, value: ("DEL", key),
+    "lpush": lambda key, value: ("LPUSH", "list:" + key[-2:], value),
+    "lpop": lambda key, value: ("LPOP", "list:" + key[-2:]),
+    "hset": lambda key, value: ("HSET", "hash:" + key[-3:], key, value),
+    "hget": lambda key, value: ("HGET", "hash:" + key[-3:], key),
+    "zadd": lambda key, value: ("ZADD", "zset:" + key[-2:], len(value), key),
+}
+
+
+############# latency histogram, log buckets 1% wide so percentiles are exact enough and merging is cheap ######################
+
+class LatencyHistogram:
+    BUCKET_BASE = math.log(1.01)
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.total = 0
+        self.max = 0.0
+
+    def record(self, microseconds, count=1):
+        bucket = int(math.log(max(microseconds, 1.0)) / self.BUCKET_BASE)
+        self.counts[bucket] += count
+        self.total += count
+        self.max = max(self.max, microseconds)
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        # upper edge of the bucket the percentile falls in, in microseconds
+        if not self.total:
+            return 0.0
+        rank = math.ceil(self.total * percent / 100)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(math.exp((bucket + 1) * self.BUCKET_BASE), self.max)
+        return self.max
+
+    def summary(self):
+        return {"count": self.total,
+                "p50_us": round(self.percentile(50), 1),
+                "p99_us": round(self.percentile(99), 1),
+                "p999_us": round(self.percentile(99.9), 1),
+                "max_us": round(self.max, 1)}
+
+    def to_dict(self):
+        return {"counts": dict(self.counts), "total": self.total, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        histogram.counts.update(data["counts"])
+        histogram.total = data["total"]
+        histogram.max = data["max"]
+        return histogram
+
+
+############# workload, what the clients send ###############################################################################
+
+def parse_mix(text):
+    # 'get:90,set:10' -> {'get': 90, 'set': 10}
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.strip().partition(":")
+        name = name.lower()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation '{name}', known: {', '.join(OPERATIONS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class KeyChooser:
+    # uniform or zipfian pick of key:0 .. key:N-1. zipf keeps the cumulative weights so a pick is one bisect
+    def __init__(self, keyspace, distribution="uniform", exponent=0.99, seed=None):
+        self.keyspace = keyspace
+        self.random = random.Random(seed)
+        self.cumulative = None
+        if distribution == "zipf":
+            self.cumulative = list(itertools.accumulate(1.0 / (rank ** exponent) for rank in range(1, keyspace + 1)))
 
-    # Create socket pool for SET, GET, DEL benchmark
-    redis_server = RedisServer(args.host, args.port)
-    socket_pool = create_socket_pool(redis_server, args.socket_pool_size)
+    def next(self):
+        if self.cumulative is None:
+            return f"key:{self.random.randrange(self.keyspace)}"
+        point = self.random.random() * self.cumulative[-1]
+        return f"key:{bisect.bisect_left(self.cumulative, point)}"
 
-    # Benchmark SET operation
-    set_time = benchmark_set(redis_server, socket_pool, args.num_requests)
-    print(f"Benchmark SET: {args.num_requests} requests in {set_time:.4f} seconds")
 
-    # Benchmark GET operation
-    get_time = benchmark_get(redis_server, socket_pool, args.num_requests)
-    print(f"Benchmark GET: {args.num_requests} requests in {get_time:.4f} seconds")
+def run_client(config, mix, requests, barrier, results):
+    # one client process: one connection, pipeline-depth commands per round trip, every command of a round trip
+    # gets the round trip's latency, like redis-benchmark does
+    connection = Connection(config["host"], config["port"])
+    chooser = KeyChooser(config["keyspace"], config["distribution"], config["zipf_exponent"], seed=os.getpid())
+    value = "x" * config["value_size"]
+    names = list(mix)
+    cumulative = list(itertools.accumulate(mix.values()))
+    depth = config["pipeline"]
+    histograms = {name: LatencyHistogram() for name in names}
+    errors = 0
+    done = 0
+    barrier.wait()
+    start = time.monotonic()
+    deadline = start + config["duration"] if config["duration"] else None
+    while (time.monotonic() < deadline) if deadline is not None else done < requests:
+        batch = chooser.random.choices(names, cum_weights=cumulative, k=depth)
+        commands = [OPERATIONS[name](chooser.next(), value) for name in batch]
+        sent = time.perf_counter()
+        replies = connection.execute(commands)
+        latency = (time.perf_counter() - sent) * 1e6
+        for name in batch:
+            histograms[name].record(latency)
+        errors += sum(1 for reply in replies if isinstance(reply, ReplyError))
+        done += depth
+    end = time.monotonic()
+    connection.close()
+    results.put({"start": start, "end": end, "ops": done, "errors": errors,
+                 "histograms": {name: histogram.to_dict() for name, histogram in histograms.items()}})
+
+
+def preload(host, port, keyspace, value_size):
+    # every key exists before the measured run, so GET hits and the data set size is what --keyspace says
+    connection = Connection(host, port)
+    value = "x" * value_size
+    for first in range(0, keyspace, 1000):
+        connection.execute([("SET", f"key:{n}", value) for n in range(first, min(first + 1000, keyspace))])
+    connection.close()
+
+
+def run_workload(config, mix):
+    clients = config["clients"]
+    requests = max(config["requests"] // clients // config["pipeline"], 1) * config["pipeline"]
+    context = multiprocessing.get_context()
+    barrier = context.Barrier(clients)
+    results = context.Queue()
+    processes = [context.Process(target=run_client, args=(config, mix, requests, barrier, results))
+                 for _ in range(clients)]
+    for process in processes:
+        process.start()
+    reports = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    elapsed = max(report["end"] for report in reports) - min(report["start"] for report in reports)
+    ops = sum(report["ops"] for report in reports)
+    total = LatencyHistogram()
+    per_operation = {}
+    for name in mix:
+        histogram = LatencyHistogram()
+        for report in reports:
+            histogram.merge(LatencyHistogram.from_dict(report["histograms"][name]))
+        total.merge(histogram)
+        per_operation[name] = dict(histogram.summary(), ops_per_sec=round(histogram.total / elapsed, 1))
+    return {"mix": ",".join(f"{name}:{weight:g}" for name, weight in mix.items()),
+            "ops": ops,
+            "errors": sum(report["errors"] for report in reports),
+            "seconds": round(elapsed, 3),
+            "ops_per_sec": round(ops / elapsed, 1),
+            "latency": total.summary(),
+            "operations": per_operation}
+
+
+############# the server under test, a fresh crowRedis in a temp dir unless --port points at a running one ###################
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def spawned_server(server_args):
+    # started in an empty temp dir, so no AOF or snapshot from an earlier run is loaded and nothing is left behind
+    port = free_port()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "crowRedis.py")
+    with tempfile.TemporaryDirectory(prefix="crowredis-bench-") as workdir:
+        process = subprocess.Popen([sys.executable, script, "--port", str(port)] + server_args, cwd=workdir,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            deadline = time.monotonic() + 10
+            while True:
+                try:
+                    Connection("127.0.0.1", port).close()
+                    break
+                except OSError:
+                    if process.poll() is not None or time.monotonic() > deadline:
+                        raise RuntimeError(f"crowRedis did not start ({' '.join(server_args)})")
+                    time.sleep(0.05)
+            yield "127.0.0.1", port
+        finally:
+            process.terminate()
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def print_report(result):
+    print(f"== {result['mix']}: {result['ops']} ops in {result['seconds']:.2f} seconds, "
+          f"{result['ops_per_sec']:.0f} ops/sec, {result['errors']} errors")
+    rows = [("all", dict(result["latency"], ops_per_sec=result["ops_per_sec"]))] + list(result["operations"].items())
+    print(f"  {'op':<6} {'ops/sec':>10} {'p50 us':>10} {'p99 us':>10} {'p99.9 us':>10} {'max us':>10}")
+    for name, stats in rows:
+        print(f"  {name:<6} {stats['ops_per_sec']:>10.0f} {stats['p50_us']:>10.1f} {stats['p99_us']:>10.1f} "
+              f"{stats['p999_us']:>10.1f} {stats['max_us']:>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator for crowRedis (or any redis compatible server)")
+    parser.add_argument("--host", default="127.0.0.1", help="Server hostname, used with --port (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=None,
+                        help="Benchmark a running server on this port, e.g. 6379 for real Redis. Without it a fresh "
+                             "crowRedis is started for the run")
+    parser.add_argument("--server-args", default="",
+                        help="Options for the started crowRedis, e.g. \"--mode eventloop --shards 32\"")
+    parser.add_argument("--clients", type=int, default=8, help="Number of client processes (default: 8)")
+    parser.add_argument("--requests", type=int, default=100000, help="Total number of commands per mix (default: 100000)")
+    parser.add_argument("--duration", type=float, default=0,
+                        help="Run every mix for this many seconds instead of a fixed number of requests")
+    parser.add_argument("--mix", type=parse_mix, action="append",
+                        help=f"Operations and weights, e.g. get:90,set:10, can be given more than once. "
+                             f"Operations: {', '.join(OPERATIONS)} (default: get:90,set:10)")
+    parser.add_argument("--keyspace", type=int, default=100000, help="Number of distinct keys (default: 100000)")
+    parser.add_argument("--distribution", choices=["uniform", "zipf"], default="uniform",
+                        help="How keys are picked, zipf makes a few keys hot (default: uniform)")
+    parser.add_argument("--zipf-exponent", type=float, default=0.99, help="Skew of the zipf distribution (default: 0.99)")
+    parser.add_argument("--value-size", type=int, default=100, help="Bytes per value (default: 100)")
+    parser.add_argument("--pipeline", type=int, default=1, help="Commands per round trip (default: 1)")
+    parser.add_argument("--no-preload", action="store_true", help="Don't SET every key of the keyspace before the run")
+    parser.add_argument("--json", metavar="FILE", help="Also write the results as JSON to FILE, - for stdout")
+    args = parser.parse_args()
+    mixes = args.mix or [parse_mix("get:90,set:10")]
+
+    with contextlib.ExitStack() as stack:
+        if args.port is None:
+            host, port = stack.enter_context(spawned_server(shlex.split(args.server_args)))
+        else:
+            host, port = args.host, args.port
+        config = {"host": host, "port": port, "clients": args.clients, "requests": args.requests,
+                  "duration": args.duration, "keyspace": args.keyspace, "distribution": args.distribution,
+                  "zipf_exponent": args.zipf_exponent, "value_size": args.value_size, "pipeline": args.pipeline}
+        if not args.no_preload:
+            preload(host, port, args.keyspace, args.value_size)
+        results = []
+        for mix in mixes:
+            results.append(run_workload(config, mix))
+            if args.json != "-":
+                print_report(results[-1])
 
-    # Benchmark DEL operation
-    del_time = benchmark_del(redis_server, socket_pool, args.num_requests)
-    print(f"Benchmark DEL: {args.num_requests} requests in {del_time:.4f} seconds")
+    if args.json:
+        server = f"crowRedis {args.server_args}".strip() if args.port is None else f"{args.host}:{args.port}"
+        report = {"config": dict(config, server=server, preload=not args.no_preload),
+                  "python": platform.python_version(),
+                  "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "results": results}
+        if args.json == "-":
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, "w") as json_file:
+                json.dump(report, json_file, indent=2)
+            print(f"Results written to {args.json}")